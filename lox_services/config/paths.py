@@ -13,3 +13,6 @@ CLOUD_ROOT_PATH = _cloud_root_path if _cloud_root_path is not None else ROOT_PAT
 OUTPUT_FOLDER: str = path.join(CLOUD_ROOT_PATH, "output_folder")
 
 CHROMEDRIVER_PATH: str = path.join(ROOT_PATH, "chromedriver")
+
+# Folder where the database services keep their local files (spool, caches, indexes).
+DATABASE_CACHE_FOLDER: str = path.join(CLOUD_ROOT_PATH, "database_cache")
@@ -0,0 +1,233 @@
+"""Vectorized currency conversion with the rates of the Utils.CurrencyConversion table.
+
+The rates are loaded once into sorted arrays per currency pair. A conversion is an as-of
+join: every amount uses the last rate published on or before its date.
+"""
+
+from datetime import timedelta
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from lox_services.persistence.database.datasets import Utils_dataset
+from lox_services.persistence.database.reference_cache import get_reference_table
+from lox_services.utils.general_python import print_info
+
+# Column of the CurrencyConversion table holding the value of 1 `currency_code_from`
+# in `currency_code_to`
+RATE_COLUMN = "rate"
+
+# A rate older than this is not used, the amount is reported as without rate
+MAX_RATE_AGE = timedelta(days=7)
+
+
+class ConversionResult(NamedTuple):
+    """Result of `CurrencyRates.convert`, every series has the index of the amounts.
+    - `amounts`: The converted amounts, NaN for the rows without rate.
+    - `rates`: The rates used.
+    - `missing_rate`: Tells which rows have an amount and a currency but no rate.
+    """
+
+    amounts: pd.Series
+    rates: pd.Series
+    missing_rate: pd.Series
+
+
+class CurrencyRates:
+    """Rates of currency pairs by date, held as sorted NumPy arrays.
+    A pair missing from the table is computed from the opposite pair.
+    ## Arguments
+    - `rates`: The rates, with the `date`, `currency_code_from` and `currency_code_to` columns.
+    - `rate_column`: The column of the rates.
+
+    ## Example
+        >>> rates = CurrencyRates.from_database()
+        >>> result = rates.convert(df["original_net_amount"], df["original_currency_code"], df["invoice_date"])
+        >>> df["net_amount"] = result.amounts
+    """
+
+    def __init__(self, rates: pd.DataFrame, rate_column: str = RATE_COLUMN):
+        rates = rates.dropna(
+            subset=["date", "currency_code_from", "currency_code_to", rate_column]
+        )
+        rates = rates.assign(
+            date=pd.to_datetime(rates["date"]).to_numpy(dtype="datetime64[D]")
+        ).sort_values("date", kind="stable")
+        self._pairs: Dict[Tuple[str, str], Tuple[np.ndarray, np.ndarray]] = {}
+        self._daily_rates: Dict[
+            Tuple[str, str], Tuple[int, np.ndarray, np.ndarray]
+        ] = {}
+        for (currency_from, currency_to), pair_rates in rates.groupby(
+            ["currency_code_from", "currency_code_to"], sort=False
+        ):
+            # The last rate of a date wins when a date is saved twice
+            pair_rates = pair_rates.drop_duplicates(subset="date", keep="last")
+            self._pairs[(currency_from, currency_to)] = (
+                pair_rates["date"].to_numpy(dtype="datetime64[D]"),
+                pair_rates[rate_column].to_numpy(dtype=float),
+            )
+
+    @classmethod
+    def from_database(cls, rate_column: str = RATE_COLUMN) -> "CurrencyRates":
+        """Loads the rates from the cached copy of the CurrencyConversion table."""
+        return cls(
+            get_reference_table(Utils_dataset.CurrencyConversion).get_dataframe(),
+            rate_column,
+        )
+
+    def get_pair(
+        self, currency_from: str, currency_to: str
+    ) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+        """Gets the sorted dates and the rates of a currency pair, None if it has no rates."""
+        if (currency_from, currency_to) in self._pairs:
+            return self._pairs[(currency_from, currency_to)]
+        if (currency_to, currency_from) in self._pairs:
+            dates, rates = self._pairs[(currency_to, currency_from)]
+            return dates, 1 / rates
+        return None
+
+    def _get_daily_rates(
+        self, currency_from: str, currency_to: str
+    ) -> Optional[Tuple[int, np.ndarray, np.ndarray]]:
+        """Gets the rate of each day from the first rate of a pair to its last one, built once per pair.
+        ## Returns
+        The first day, as days since the epoch, the rate of each day and the day of this rate.
+        """
+        if (currency_from, currency_to) not in self._daily_rates:
+            pair = self.get_pair(currency_from, currency_to)
+            if pair is None:
+                return None
+            pair_days, pair_rates = pair[0].view(np.int64), pair[1]
+            positions = (
+                np.searchsorted(
+                    pair_days,
+                    np.arange(pair_days[0], pair_days[-1] + 1),
+                    side="right",
+                )
+                - 1
+            )
+            self._daily_rates[(currency_from, currency_to)] = (
+                int(pair_days[0]),
+                pair_rates[positions],
+                pair_days[positions],
+            )
+        return self._daily_rates[(currency_from, currency_to)]
+
+    def get_rates(
+        self,
+        currencies: pd.Series,
+        dates: pd.Series,
+        to_currency: str = "EUR",
+        max_rate_age: Optional[timedelta] = MAX_RATE_AGE,
+    ) -> pd.Series:
+        """Gets the rate of every row, with one vectorized as-of join per currency.
+        ## Arguments
+        - `currencies`: The currency code of each row.
+        - `dates`: The date of each row, the rate used is the last one on or before it.
+        - `to_currency`: The currency to convert to.
+        - `max_rate_age`: The maximum age of the rate used, None to use any older rate.
+
+        ## Returns
+        The rates, NaN for the rows without rate. The rows with a missing or invalid date have
+        no rate, unless their currency is already `to_currency`.
+        """
+        row_dates = pd.to_datetime(dates, errors="coerce").to_numpy(
+            dtype="datetime64[D]"
+        )
+        has_date = ~np.isnat(row_dates)
+        # Days since the epoch, only meaningful for the rows with a date
+        row_days = row_dates.view(np.int64)
+        codes, currency_codes = pd.factorize(currencies)
+        row_rates = np.full(len(codes), np.nan)
+        for code, currency in enumerate(currency_codes):
+            if currency == to_currency:
+                row_rates[codes == code] = 1.0
+                continue
+            rows = np.flatnonzero((codes == code) & has_date)
+            daily_rates = self._get_daily_rates(currency, to_currency)
+            if daily_rates is None:
+                continue
+            first_day, rates_by_day, rate_days = daily_rates
+            # The days after the last rate use the last rate
+            offsets = np.minimum(row_days[rows] - first_day, len(rates_by_day) - 1)
+            found = offsets >= 0
+            offsets[~found] = 0
+            if max_rate_age is not None:
+                found &= row_days[rows] - rate_days[offsets] <= max_rate_age.days
+            row_rates[rows[found]] = rates_by_day[offsets[found]]
+        return pd.Series(row_rates, index=currencies.index)
+
+    def convert(
+        self,
+        amounts: pd.Series,
+        currencies: pd.Series,
+        dates: pd.Series,
+        to_currency: str = "EUR",
+        max_rate_age: Optional[timedelta] = MAX_RATE_AGE,
+    ) -> ConversionResult:
+        """Converts amounts in several currencies to one currency, see `get_rates`.
+        ## Arguments
+        - `amounts`: The amounts to convert.
+        - `currencies`: The currency code of each amount.
+        - `dates`: The date of each amount.
+        - `to_currency`: The currency to convert to.
+        - `max_rate_age`: The maximum age of the rate used, None to use any older rate.
+
+        ## Returns
+        The converted amounts, the rates used and the rows without rate, see `ConversionResult`.
+        """
+        rates = pd.Series(
+            self.get_rates(currencies, dates, to_currency, max_rate_age).to_numpy(),
+            index=amounts.index,
+        )
+        amounts = pd.to_numeric(amounts, errors="coerce")
+        return ConversionResult(
+            amounts=amounts * rates,
+            rates=rates,
+            missing_rate=rates.isna() & currencies.notna().to_numpy() & amounts.notna(),
+        )
+
+
+def convert_dataframe_amounts(
+    dataframe: pd.DataFrame,
+    amount_columns: List[str],
+    currency_column: str,
+    date_column: str,
+    to_currency: str = "EUR",
+    rates: Optional[CurrencyRates] = None,
+) -> Tuple[pd.DataFrame, pd.Series]:
+    """Converts amount columns of a dataframe in place, see `CurrencyRates.get_rates`.
+    ## Arguments
+    - `dataframe`: The dataframe holding the amounts.
+    - `amount_columns`: The columns to convert.
+    - `currency_column`: The column of the currency codes of the amounts.
+    - `date_column`: The column of the dates of the amounts.
+    - `to_currency`: The currency to convert to.
+    - `rates`: The rates, loaded from the database if not given.
+
+    ## Example
+        >>> df, missing_rate = convert_dataframe_amounts(
+                df, ["net_amount", "amount"], "original_currency_code", "invoice_date"
+            )
+
+    ## Returns
+    The dataframe, and a boolean series telling which rows have no rate.
+    """
+    if rates is None:
+        rates = CurrencyRates.from_database()
+    row_rates = rates.get_rates(
+        dataframe[currency_column], dataframe[date_column], to_currency
+    )
+    missing_rate = pd.Series(False, index=dataframe.index)
+    for column in amount_columns:
+        amounts = pd.to_numeric(dataframe[column], errors="coerce")
+        dataframe[column] = amounts * row_rates
+        missing_rate |= amounts.notna()
+    missing_rate &= row_rates.isna() & dataframe[currency_column].notna()
+    if missing_rate.any():
+        print_info(
+            f"{int(missing_rate.sum())} rows have no rate to {to_currency}, currencies: "
+            f"{sorted(dataframe.loc[missing_rate, currency_column].unique())}"
+        )
+    return dataframe, missing_rate
@@ -0,0 +1,181 @@
+"""Columnar data quality engine used by the ingestion checks.
+
+Rules are declared as data and evaluated column by column with vectorized operations.
+All the rules are evaluated before reporting, so that a report lists every violation
+instead of stopping at the first one.
+"""
+
+from typing import Any, Iterable, List, Literal, NamedTuple, Optional, TypedDict
+
+import numpy as np
+import pandas as pd
+
+from lox_services.persistence.database.exceptions import (
+    DataQualityException,
+    MissingColumnsException,
+)
+
+RuleKind = Literal["required", "not_null", "allowed", "prefix", "range"]
+
+
+class QualityRule(NamedTuple):
+    """A data quality rule on one column.
+    - `required`: The column must exist.
+    - `not_null`: The column must not contain nulls.
+    - `allowed`: The populated values must be in `allowed_values`.
+    - `prefix`: The populated values must start with `prefix`.
+    - `range`: The populated values must be numbers between `minimum` and `maximum`, both included.
+    """
+
+    kind: RuleKind
+    column: str
+    allowed_values: Optional[frozenset] = None
+    prefix: Optional[str] = None
+    minimum: Optional[float] = None
+    maximum: Optional[float] = None
+
+    @property
+    def name(self) -> str:
+        return f"{self.kind}({self.column})"
+
+
+def required(*columns: str) -> List[QualityRule]:
+    """Rules checking that the columns exist and don't contain nulls."""
+    return [
+        rule
+        for column in columns
+        for rule in (QualityRule("required", column), QualityRule("not_null", column))
+    ]
+
+
+def allowed(column: str, values: Iterable[Any]) -> QualityRule:
+    """Rule checking that the populated values of a column are in a set."""
+    return QualityRule("allowed", column, allowed_values=frozenset(values))
+
+
+def starts_with(column: str, prefix: str) -> QualityRule:
+    """Rule checking that the populated values of a column start with a prefix."""
+    return QualityRule("prefix", column, prefix=prefix)
+
+
+def numeric_range(
+    column: str, minimum: Optional[float] = None, maximum: Optional[float] = None
+) -> QualityRule:
+    """Rule checking that the populated values of a column are numbers within a range."""
+    return QualityRule("range", column, minimum=minimum, maximum=maximum)
+
+
+class QualityViolation(TypedDict):
+    """Violation of one rule."""
+
+    rule: str
+    kind: RuleKind
+    column: str
+    rows: int
+    examples: list
+
+
+class QualityReport(TypedDict):
+    """Result of `evaluate_quality_rules`."""
+
+    violations: List[QualityViolation]
+    invalid_rows: pd.Series
+
+
+def _violation_mask(column: pd.Series, rule: QualityRule) -> np.ndarray:
+    """Flags the values of a column that break a rule."""
+    is_null = column.isna().to_numpy()
+    if rule.kind == "not_null":
+        return is_null
+    if rule.kind == "allowed":
+        return ~is_null & ~column.isin(list(rule.allowed_values)).to_numpy()
+    if rule.kind == "prefix":
+        return ~is_null & ~column.astype(str).str.startswith(rule.prefix).to_numpy(
+            dtype=bool
+        )
+    if rule.kind == "range":
+        numbers = pd.to_numeric(column, errors="coerce").to_numpy(dtype=float)
+        out_of_range = np.isnan(numbers)
+        if rule.minimum is not None:
+            out_of_range |= numbers < rule.minimum
+        if rule.maximum is not None:
+            out_of_range |= numbers > rule.maximum
+        return ~is_null & out_of_range
+    raise ValueError(f"Unknown quality rule kind '{rule.kind}'.")
+
+
+def evaluate_quality_rules(
+    dataframe: pd.DataFrame, rules: Iterable[QualityRule], max_examples: int = 5
+) -> QualityReport:
+    """Evaluates every rule on the dataframe, without raising.
+    The rules on a missing column are skipped, a `required` rule reports the column itself.
+    ## Arguments
+    - `dataframe`: The dataframe to check.
+    - `rules`: The rules, see `required`, `allowed`, `starts_with` and `numeric_range`.
+    - `max_examples`: Maximum number of wrong values given in each violation.
+
+    ## Example
+        >>> report = evaluate_quality_rules(df, [*required("company"), allowed("is_return", [True, False])])
+        >>> df.loc[~report["invalid_rows"]]
+
+    ## Returns
+    - `violations`: The broken rules, with the number of rows breaking them and some wrong values.
+    - `invalid_rows`: Boolean series telling which rows break at least one rule.
+    """
+    violations: List[QualityViolation] = []
+    invalid_rows = np.zeros(len(dataframe.index), dtype=bool)
+    for rule in rules:
+        if rule.column not in dataframe.columns:
+            if rule.kind == "required":
+                violations.append(
+                    QualityViolation(
+                        rule=rule.name,
+                        kind=rule.kind,
+                        column=rule.column,
+                        rows=len(dataframe.index),
+                        examples=[],
+                    )
+                )
+            continue
+        if rule.kind == "required":
+            continue
+
+        column = dataframe[rule.column]
+        mask = _violation_mask(column, rule)
+        if mask.any():
+            invalid_rows |= mask
+            violations.append(
+                QualityViolation(
+                    rule=rule.name,
+                    kind=rule.kind,
+                    column=rule.column,
+                    rows=int(mask.sum()),
+                    examples=(
+                        []
+                        if rule.kind == "not_null"
+                        else column[mask].drop_duplicates().head(max_examples).tolist()
+                    ),
+                )
+            )
+
+    return QualityReport(
+        violations=violations,
+        invalid_rows=pd.Series(invalid_rows, index=dataframe.index),
+    )
+
+
+def raise_for_violations(report: QualityReport) -> None:
+    """Raises if the report has violations.
+    ## Raises
+    - `MissingColumnsException`: If required columns are missing.
+    - `DataQualityException`: If values break the rules, it is also a `ValueError`.
+    """
+    missing_columns = [
+        violation["column"]
+        for violation in report["violations"]
+        if violation["kind"] == "required"
+    ]
+    if missing_columns:
+        raise MissingColumnsException(", ".join(missing_columns))
+    if report["violations"]:
+        raise DataQualityException(report["violations"])
@@ -111,3 +111,40 @@ DatasetTypeAlias = Union[
     TestEnvironment_dataset,
     InvoicesDataLake_dataset,
 ]
+
+ALL_DATASETS = (
+    InvoicesData_dataset,
+    InvoicesDataLake_dataset,
+    LoxData_dataset,
+    UserData_dataset,
+    Mapping_dataset,
+    RecordedActivity_dataset,
+    TestEnvironment_dataset,
+    Utils_dataset,
+    SubscriptionData_dataset,
+    CarrierData_dataset,
+)
+
+
+def get_dataset_name(table: Enum) -> str:
+    """Gets the dataset name of a table from its enum class.
+    ## Example
+        >>> get_dataset_name(InvoicesData_dataset.Refunds)
+        # "InvoicesData"
+    """
+    if type(table) not in ALL_DATASETS:
+        raise TypeError("'table' param must be an instance of one of the tables Enum.")
+    return type(table).__name__.removesuffix("_dataset")
+
+
+def get_table_from_full_name(full_name: str) -> Enum:
+    """Gets the table enum member from its full name.
+    ## Example
+        >>> get_table_from_full_name("InvoicesData.Refunds")
+        # InvoicesData_dataset.Refunds
+    """
+    dataset_name, table_name = full_name.split(".")
+    for dataset in ALL_DATASETS:
+        if dataset.__name__ == f"{dataset_name}_dataset":
+            return dataset[table_name]
+    raise ValueError(f"Unknown table '{full_name}'.")
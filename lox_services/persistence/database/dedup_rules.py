@@ -0,0 +1,366 @@
+"""Registry of the rules applied to the rows inserted into each table of the database.
+
+Every table maps to its key columns, the normalisation of its keys and the checks run before
+an insert. Adding a table only takes a new entry in `DEDUP_RULES`.
+The duplicate lookups of several dataframes can also be planned together, so that they run
+in a single BigQuery query instead of one per table, see `remove_saved_rows`.
+"""
+
+from enum import Enum
+from typing import Callable, Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+
+from lox_services.persistence.database.datasets import (
+    CarrierData_dataset,
+    InvoicesData_dataset,
+    LoxData_dataset,
+    UserData_dataset,
+    Utils_dataset,
+    get_dataset_name,
+)
+from lox_services.persistence.database.partitioning import build_partition_filter
+from lox_services.persistence.database.quality_checks import (
+    client_invoice_data_quality_check,
+)
+from lox_services.persistence.database.query_handlers import select
+from lox_services.persistence.database.remove_duplicates import (
+    CHUNK_SIZE,
+    check_duplicate_invoices_details,
+    check_lox_invoice_not_exists,
+    remove_duplicate_NestedAccountNumbers,
+    remove_duplicate_client_invoice_data,
+    remove_duplicate_currency_conversion,
+    remove_duplicate_deliveries,
+    remove_duplicate_headers_dataframe,
+    remove_duplicate_invoices,
+    remove_duplicate_invoices_from_client_to_carrier,
+    remove_duplicate_package_information,
+    remove_duplicate_refunds,
+)
+from lox_services.persistence.database.utils import (
+    fingerprint_series,
+    quality_check_package_info,
+)
+from lox_services.utils.enums import BQParameterType
+
+
+class RuleCheck(NamedTuple):
+    """A check run before inserting into a table.
+    It takes the dataframe and returns the rows to keep, or None if it only validates.
+    - `name`: The name of the check, used in the reports.
+    - `function`: The check.
+    - `is_duplicate_check`: Whether the check removes rows already saved in the table.
+    - `uses_key_index`: Whether the check accepts the `use_key_index` argument.
+    """
+
+    name: str
+    function: Callable[..., Optional[pd.DataFrame]]
+    is_duplicate_check: bool = False
+    uses_key_index: bool = False
+
+
+class DuplicateLookup(NamedTuple):
+    """How the keys of the incoming rows are looked up among the saved rows of a table.
+    - `lookup_column`: Column of the table filtered with the values of the incoming rows.
+    - `key_sql`: SQL expression of the key of a saved row.
+    - `build_keys`: Builds the same keys on the incoming rows. Rows without a complete key are NaN.
+    - `check_name`: The duplicate check replaced by the lookup.
+    - `required_columns`: Columns whose missing values make the replaced check drop the row,
+    the lookup drops these rows too.
+    """
+
+    lookup_column: str
+    key_sql: str
+    build_keys: Callable[[pd.DataFrame], pd.Series]
+    check_name: str
+    required_columns: Tuple[str, ...] = ()
+
+
+class TableRules(NamedTuple):
+    """Rules of a table.
+    - `checks`: The checks run before an insert, in order.
+    - `row_id_columns`: Key columns used to compute the insertId of each row in idempotent inserts.
+    - `append_only`: Whether the duplicate checks are skipped in idempotent inserts.
+    - `lookup`: The duplicate lookup that `remove_saved_rows` can batch with other tables.
+    """
+
+    checks: List[RuleCheck]
+    row_id_columns: Optional[List[str]] = None
+    append_only: bool = False
+    lookup: Optional[DuplicateLookup] = None
+
+
+def _concat_keys(dataframe: pd.DataFrame, columns: List[str]) -> pd.Series:
+    """Concatenates the key columns like `||` in BigQuery, NULL if any part is missing."""
+    keys = dataframe[columns[0]].astype(str)
+    for column in columns[1:]:
+        keys = keys + dataframe[column].astype(str)
+    return keys.where(dataframe[columns].notna().all(axis="columns"))
+
+
+def build_delivery_keys(dataframe: pd.DataFrame) -> pd.Series:
+    """Builds the keys of deliveries, with the date time formatted like in BigQuery."""
+    formatted_datetime = pd.to_datetime(
+        dataframe["date_time"], errors="coerce"
+    ).dt.strftime("%Y-%m-%d %H:%M:%S")
+    return _concat_keys(
+        dataframe.assign(formatted_datetime=formatted_datetime),
+        ["tracking_number", "status", "formatted_datetime"],
+    )
+
+
+HEADERS_CHECK = RuleCheck(
+    "remove_duplicate_headers_dataframe", remove_duplicate_headers_dataframe
+)
+
+
+DEDUP_RULES: Dict[Enum, TableRules] = {
+    **{table: TableRules([HEADERS_CHECK]) for table in InvoicesData_dataset},
+    InvoicesData_dataset.Invoices: TableRules(
+        [
+            HEADERS_CHECK,
+            RuleCheck(
+                "remove_duplicate_invoices", remove_duplicate_invoices, True, True
+            ),
+        ],
+        lookup=DuplicateLookup(
+            "invoice_number",
+            "company || carrier || invoice_number",
+            lambda dataframe: _concat_keys(
+                dataframe, ["company", "carrier", "invoice_number"]
+            ),
+            "remove_duplicate_invoices",
+        ),
+    ),
+    # The refund check also handles the duplicates inside the dataframe, it is not batched
+    InvoicesData_dataset.Refunds: TableRules(
+        [
+            HEADERS_CHECK,
+            RuleCheck("remove_duplicate_refunds", remove_duplicate_refunds, True, True),
+        ],
+        row_id_columns=["company", "carrier", "tracking_number", "reason_refund"],
+    ),
+    InvoicesData_dataset.ClientInvoicesData: TableRules(
+        [
+            HEADERS_CHECK,
+            RuleCheck(
+                "remove_duplicate_client_invoice_data",
+                remove_duplicate_client_invoice_data,
+                True,
+            ),
+            RuleCheck(
+                "client_invoice_data_quality_check", client_invoice_data_quality_check
+            ),
+        ]
+    ),
+    InvoicesData_dataset.Deliveries: TableRules(
+        [
+            HEADERS_CHECK,
+            RuleCheck(
+                "remove_duplicate_deliveries", remove_duplicate_deliveries, True, True
+            ),
+        ],
+        row_id_columns=["tracking_number", "status", "date_time"],
+        append_only=True,
+        lookup=DuplicateLookup(
+            "tracking_number",
+            "tracking_number || status || FORMAT_DATETIME('%Y-%m-%d %H:%M:%S', date_time)",
+            build_delivery_keys,
+            "remove_duplicate_deliveries",
+            ("tracking_number", "status", "date_time"),
+        ),
+    ),
+    LoxData_dataset.DueInvoices: TableRules(
+        [RuleCheck("check_lox_invoice_not_exists", check_lox_invoice_not_exists, True)]
+    ),
+    LoxData_dataset.InvoicesDetails: TableRules(
+        [
+            RuleCheck(
+                "check_duplicate_invoices_details",
+                check_duplicate_invoices_details,
+                True,
+            )
+        ]
+    ),
+    UserData_dataset.InvoicesFromClientToCarrier: TableRules(
+        [
+            RuleCheck(
+                "remove_duplicate_invoices_from_client_to_carrier",
+                remove_duplicate_invoices_from_client_to_carrier,
+                True,
+            )
+        ]
+    ),
+    UserData_dataset.NestedAccountNumbers: TableRules(
+        [
+            RuleCheck(
+                "remove_duplicate_NestedAccountNumbers",
+                remove_duplicate_NestedAccountNumbers,
+                True,
+            )
+        ]
+    ),
+    Utils_dataset.CurrencyConversion: TableRules(
+        [
+            RuleCheck(
+                "remove_duplicate_currency_conversion",
+                remove_duplicate_currency_conversion,
+                True,
+            )
+        ]
+    ),
+    CarrierData_dataset.PackageInformation: TableRules(
+        [
+            RuleCheck(
+                "remove_duplicate_package_information",
+                remove_duplicate_package_information,
+                True,
+                True,
+            ),
+            # Check that required columns are not null and country codes are valid
+            RuleCheck("quality_check_package_info", quality_check_package_info),
+        ],
+        row_id_columns=["carrier", "company", "tracking_number"],
+        lookup=DuplicateLookup(
+            "tracking_number",
+            "carrier || company || tracking_number",
+            lambda dataframe: _concat_keys(
+                dataframe, ["carrier", "company", "tracking_number"]
+            ),
+            "remove_duplicate_package_information",
+        ),
+    ),
+}
+
+
+def get_table_rules(table: Enum) -> TableRules:
+    """Gets the rules of a table, a table without entry has no checks."""
+    get_dataset_name(
+        table
+    )  # Raises a TypeError if the table is not one of the datasets
+    return DEDUP_RULES.get(table, TableRules([]))
+
+
+def get_lookup_values(dataframe: pd.DataFrame, table: Enum) -> list:
+    """Gets the distinct values of the lookup column of a dataframe."""
+    lookup_column = DEDUP_RULES[table].lookup.lookup_column
+    return dataframe[lookup_column].dropna().astype(str).unique().tolist()
+
+
+def build_lookup_query(
+    frames: Sequence[Tuple[pd.DataFrame, Enum]],
+    lookup_values: Optional[Sequence[list]] = None,
+) -> Tuple[str, list]:
+    """Builds the query looking up the keys of several dataframes at once.
+    The lookups of the tables are combined with UNION ALL and tagged with the position
+    of their dataframe. Only the distinct fingerprints of the saved keys are returned.
+    ## Arguments
+    - `frames`: The dataframes and their table. Every table must have a lookup.
+    - `lookup_values`: The values looked up for each dataframe, all the values of its lookup
+    column by default. The dataframes without values are left out of the query.
+
+    ## Returns
+    The query and its parameters.
+    """
+    if lookup_values is None:
+        lookup_values = [
+            get_lookup_values(dataframe, table) for dataframe, table in frames
+        ]
+    subqueries, parameters = [], []
+    for position, (dataframe, table) in enumerate(frames):
+        if not lookup_values[position]:
+            continue
+        lookup = DEDUP_RULES[table].lookup
+        partition_filter, partition_parameters = build_partition_filter(
+            table, dataframe, parameter_prefix=f"frame_{position}_"
+        )
+        subqueries.append(
+            f"""
+            SELECT DISTINCT
+                {position} AS frame_position,
+                FARM_FINGERPRINT({lookup.key_sql}) AS fingerprint
+
+            FROM {get_dataset_name(table)}.{table.name}
+
+            WHERE {lookup.lookup_column} IN UNNEST(@frame_{position}_lookup_values)
+                {partition_filter}
+            """
+        )
+        parameters.append(
+            (
+                f"frame_{position}_lookup_values",
+                BQParameterType.STRING,
+                lookup_values[position],
+            )
+        )
+        parameters += partition_parameters
+    return "\nUNION ALL\n".join(subqueries), parameters
+
+
+def remove_saved_rows(
+    frames: Sequence[Tuple[pd.DataFrame, Enum]]
+) -> List[Tuple[pd.DataFrame, Enum]]:
+    """Removes the rows already saved in the database from several dataframes, with one query.
+    The dataframes whose table has no lookup are returned unchanged. The rows whose key is
+    incomplete are kept, unless the check replaced by the lookup drops them, see `required_columns`.
+    The lookup values are sent by chunks of `CHUNK_SIZE`, one query per chunk.
+    The rows removed by the lookup can then be inserted with `duplicates_removed=True`.
+    ## Arguments
+    - `frames`: The dataframes and the table they are inserted into.
+
+    ## Example
+        >>> frames = remove_saved_rows(
+                [(invoices_df, InvoicesData_dataset.Invoices), (deliveries_df, InvoicesData_dataset.Deliveries)]
+            )
+
+    ## Returns
+    The dataframes without the saved rows, and their table, in the same order.
+    """
+    looked_up = [
+        position
+        for position, (dataframe, table) in enumerate(frames)
+        if not dataframe.empty and get_table_rules(table).lookup is not None
+    ]
+    if not looked_up:
+        return list(frames)
+
+    looked_up_frames = [frames[position] for position in looked_up]
+    lookup_values = [
+        get_lookup_values(dataframe, table) for dataframe, table in looked_up_frames
+    ]
+    saved_keys = []
+    for start in range(0, max(len(values) for values in lookup_values), CHUNK_SIZE):
+        query, parameters = build_lookup_query(
+            looked_up_frames,
+            [values[start : start + CHUNK_SIZE] for values in lookup_values],
+        )
+        saved_keys.append(select(query, print_query=False, parameters=parameters))
+    saved_keys = (
+        pd.concat(saved_keys, ignore_index=True)
+        if saved_keys
+        else pd.DataFrame({"frame_position": [], "fingerprint": []})
+    )
+
+    result = list(frames)
+    for lookup_position, position in enumerate(looked_up):
+        dataframe, table = frames[position]
+        lookup = DEDUP_RULES[table].lookup
+        if lookup.required_columns:
+            dataframe = dataframe.dropna(subset=list(lookup.required_columns))
+        keys = lookup.build_keys(dataframe)
+        complete = keys.notna()
+        saved_fingerprints = saved_keys.loc[
+            saved_keys["frame_position"] == lookup_position, "fingerprint"
+        ].to_numpy(dtype=np.int64)
+        already_saved = np.zeros(len(dataframe.index), dtype=bool)
+        already_saved[complete.to_numpy()] = np.isin(
+            fingerprint_series(keys.loc[complete]).to_numpy(), saved_fingerprints
+        )
+        kept = dataframe.loc[~already_saved]
+        print(
+            f"{len(frames[position][0].index) - len(kept.index)} rows of table {table.name} removed by the batched lookup."
+        )
+        result[position] = (kept, table)
+    return result
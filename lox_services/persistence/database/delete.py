@@ -0,0 +1,155 @@
+"""Contains the function to delete rows of the database from a dataframe of keys."""
+
+import os
+from contextlib import ExitStack
+from enum import Enum
+from typing import List, Tuple
+
+import pandas as pd
+from google.cloud.bigquery import Client, SchemaField
+
+from lox_services.persistence.config import SERVICE_ACCOUNT_PATH
+from lox_services.persistence.database.datasets import get_dataset_name
+from lox_services.persistence.database.query_handlers import delete, select
+from lox_services.persistence.database.schema_registry import get_table_with_schema
+from lox_services.persistence.database.temporary_tables import temporary_table
+from lox_services.persistence.database.utils import (
+    cast_dataframe_to_schema,
+    get_parameter_type,
+)
+from lox_services.utils.general_python import print_info
+
+# Above this number of keys, the keys are loaded into a temporary table instead of
+# being sent as array parameters
+ARRAY_PARAMETER_MAX_KEYS = 10000
+
+TARGET_ALIAS = "target"
+
+
+def _build_array_condition(
+    keys: pd.DataFrame, key_columns: List[str]
+) -> Tuple[str, list]:
+    """Builds the condition matching the keys sent as array parameters.
+    Composite keys are sent as one array per column, zipped back by their offset.
+    """
+    parameters = []
+    for position, column in enumerate(key_columns):
+        # `tolist` gives python values, the numpy scalars would all be typed as strings
+        values = keys[column].tolist()
+        parameters.append((f"keys_{position}", get_parameter_type(values[0]), values))
+    if len(key_columns) == 1:
+        return f"{TARGET_ALIAS}.{key_columns[0]} IN UNNEST(@keys_0)", parameters
+
+    joins = "\n".join(
+        f"JOIN UNNEST(@keys_{position}) AS key_{position} WITH OFFSET AS offset_{position} "
+        f"ON offset_{position} = offset_0"
+        for position in range(1, len(key_columns))
+    )
+    matches = " AND ".join(
+        f"{TARGET_ALIAS}.{column} = key_{position}"
+        for position, column in enumerate(key_columns)
+    )
+    # The first column also filters the table directly, so that BigQuery can prune it
+    condition = f"""{TARGET_ALIAS}.{key_columns[0]} IN UNNEST(@keys_0)
+            AND EXISTS (
+                SELECT 1
+                FROM UNNEST(@keys_0) AS key_0 WITH OFFSET AS offset_0
+                {joins}
+                WHERE {matches}
+            )"""
+    return condition, parameters
+
+
+def delete_by_keys(
+    table: Enum,
+    dataframe: pd.DataFrame,
+    key_columns: List[str],
+    *,
+    dry_run: bool = False,
+    max_array_keys: int = ARRAY_PARAMETER_MAX_KEYS,
+) -> int:
+    """Deletes, with a single statement, every row of the table matching one of the keys of the dataframe.
+    Small sets of keys are sent as array parameters, larger ones are loaded into a temporary table.
+    ## Arguments
+    - `table`: The database table. It must be one of the datasets.
+    - `dataframe`: The dataframe holding the keys. Rows with a missing key value are ignored.
+    - `key_columns`: The columns of the key, they must be columns of the table.
+    - `dry_run`: Only counts the rows that would be deleted.
+    - `max_array_keys`: Maximum number of keys sent as array parameters.
+
+    ## Example
+        >>> delete_by_keys(
+                InvoicesData_dataset.Refunds,
+                refunds_df,
+                ["company", "carrier", "tracking_number"],
+            )
+
+    ## Returns
+    The number of deleted rows, or of rows that would be deleted if `dry_run` is set.
+    """
+    if not key_columns:
+        raise ValueError("At least one key column is needed.")
+    keys = dataframe[key_columns].dropna().drop_duplicates()
+    if len(keys.index) < len(dataframe[key_columns].drop_duplicates().index):
+        print_info("Keys with missing values are ignored, they can't match any row.")
+    if keys.empty:
+        print("No keys, delete aborted because unnecessary.")
+        return 0
+
+    full_table_name = f"{get_dataset_name(table)}.{table.name}"
+    with ExitStack() as stack:
+        if len(keys.index) <= max_array_keys:
+            condition, parameters = _build_array_condition(keys, key_columns)
+        else:
+            os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = SERVICE_ACCOUNT_PATH
+            bigquery_client = Client()
+            destination = get_table_with_schema(
+                bigquery_client, get_dataset_name(table), table.name, key_columns
+            )
+            schema = [
+                SchemaField(field.name, field.field_type, mode="NULLABLE")
+                for field in destination.schema
+                if field.name in key_columns
+            ]
+            temporary_table_id = stack.enter_context(
+                temporary_table(
+                    cast_dataframe_to_schema(keys, schema),
+                    schema,
+                    destination.project,
+                    destination.dataset_id,
+                    bigquery_client=bigquery_client,
+                    prefix=f"{table.name}_delete",
+                )
+            )
+            matches = " AND ".join(
+                f"{TARGET_ALIAS}.{column} = deleted_key.{column}"
+                for column in key_columns
+            )
+            condition = f"""EXISTS (
+                    SELECT 1
+                    FROM `{temporary_table_id}` AS deleted_key
+                    WHERE {matches}
+                )"""
+            parameters = []
+
+        if dry_run:
+            count = select(
+                f"""
+                SELECT COUNT(*) AS rows_to_delete
+
+                FROM {full_table_name} AS {TARGET_ALIAS}
+
+                WHERE {condition}
+                """,
+                parameters=parameters,
+            )["rows_to_delete"].iloc[0]
+            print_info(f"{count} rows of table {table.name} would be deleted.")
+            return int(count)
+
+        return delete(
+            f"""DELETE FROM {full_table_name} AS {TARGET_ALIAS}
+
+            WHERE {condition}
+            """,
+            parameters=parameters,
+        )
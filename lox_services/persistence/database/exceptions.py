@@ -45,6 +45,23 @@ class InvalidDataException(DatabaseException):
         super().__init__(message)
 
 
+class SpoolFullException(DatabaseException):
+    """Raised when the local insert spool stays above its disk budget for too long.
+
+    ## Constructor arguments
+
+    - `folder` (str): the spool folder
+    - `max_disk_bytes` (int): the disk budget of the spool
+    """
+
+    def __init__(self, folder, max_disk_bytes):
+        self.folder = folder
+        self.max_disk_bytes = max_disk_bytes
+        super().__init__(
+            f"The insert spool '{folder}' exceeds {max_disk_bytes} bytes and could not be flushed in time."
+        )
+
+
 """Dataframe exceptions."""
 
 
@@ -54,8 +71,9 @@ class DataFrameException(Exception):
     pass
 
 
-class MissingColumnsException(DataFrameException):
+class MissingColumnsException(DataFrameException, KeyError):
     """Raised when a required column is missing in a given dataframe.
+    It is also a `KeyError`, the error raised by pandas for a missing column.
 
     ## Constructor arguments
 
@@ -65,3 +83,24 @@ class MissingColumnsException(DataFrameException):
     def __init__(self, column_name):
         self.column_name = column_name
         super().__init__(f"Missing required columns: '{column_name}'.")
+
+    def __str__(self):
+        # `KeyError` would show the representation of the message, with quotes
+        return str(self.args[0])
+
+
+class DataQualityException(DataFrameException, ValueError):
+    """Raised when some values of a given dataframe break data quality rules.
+
+    ## Constructor arguments
+
+    - `violations` (list): the violations of the quality report
+    """
+
+    def __init__(self, violations):
+        self.violations = violations
+        details = "\n".join(
+            f"- {violation['rule']}: {violation['rows']} rows, e.g. {violation['examples']}"
+            for violation in violations
+        )
+        super().__init__(f"Data quality rules are not respected:\n{details}")
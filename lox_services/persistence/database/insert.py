@@ -1,12 +1,15 @@
 """Contains the function to insert dataframes into the database."""
 
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from functools import partial
 from pprint import pformat
-from typing import Literal
+from time import perf_counter
+from typing import Callable, Dict, List, Literal, Optional, Tuple, TypedDict, Union
 import os
 
 import pandas as pd
-from google.cloud.bigquery import Client, LoadJobConfig
+from google.cloud.bigquery import Client, LoadJobConfig, SchemaField
 from lox_services.config.env_variables import get_env_variable
 
 from lox_services.persistence.config import SERVICE_ACCOUNT_PATH
@@ -14,39 +17,42 @@ from lox_services.persistence.database.exceptions import (
     InvalidDataException,
 )
 from lox_services.persistence.database.datasets import (
-    InvoicesData_dataset,
-    InvoicesDataLake_dataset,
-    LoxData_dataset,
-    Mapping_dataset,
     DatasetTypeAlias,
-    UserData_dataset,
-    Utils_dataset,
-    CarrierData_dataset,
-    RecordedActivity_dataset,
-    SubscriptionData_dataset,
+    get_dataset_name,
 )
-from lox_services.persistence.database.quality_checks import (
-    client_invoice_data_quality_check,
+from lox_services.persistence.database.dedup_rules import (
+    DEDUP_RULES,
+    get_table_rules,
 )
+from lox_services.persistence.database.query_handlers import raw_query
 from lox_services.persistence.database.remove_duplicates import (
-    check_duplicate_invoices_details,
-    check_lox_invoice_not_exists,
-    remove_duplicate_NestedAccountNumbers,
-    remove_duplicate_client_invoice_data,
-    remove_duplicate_currency_conversion,
-    remove_duplicate_deliveries,
-    remove_duplicate_invoices,
-    remove_duplicate_invoices_from_client_to_carrier,
-    remove_duplicate_package_information,
-    remove_duplicate_refunds,
+    ROW_POSITION_COLUMN,
+    SERVER_SIDE_DEDUPLICATION_TABLES,
+    build_server_side_deduplication_query,
+    remove_duplicate_headers_dataframe,
 )
-from lox_services.persistence.database.utils import quality_check_package_info
-from lox_services.utils.general_python import print_error, print_success
+from lox_services.persistence.database.schema_registry import get_table_with_schema
+from lox_services.persistence.database.temporary_tables import temporary_table
+from lox_services.persistence.database.utils import (
+    cast_dataframe_to_schema,
+    generate_id_series,
+)
+from lox_services.utils.general_python import print_error, print_info, print_success
 
 # pylint: disable=line-too-long
 
 os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = os.path.join(SERVICE_ACCOUNT_PATH)
 
+# Key columns used to compute the insertId of each row in idempotent inserts
+ROW_ID_COLUMNS = {
+    table: rules.row_id_columns
+    for table, rules in DEDUP_RULES.items()
+    if rules.row_id_columns is not None
+}
+
+# Number of rows sent in one streaming insert request
+STREAMING_CHUNK_SIZE = 500
+
 
 def add_metadata_columns(dataframe: pd.DataFrame, write_method: str) -> pd.DataFrame:
     """Adds the metadata columns to the dataframe.
@@ -70,16 +76,251 @@ def add_metadata_columns(dataframe: pd.DataFrame, write_method: str) -> pd.DataF
     return dataframe
 
 
+def insert_rows_with_ids(
+    bigquery_client: Client,
+    table,
+    dataframe: pd.DataFrame,
+    row_ids: List[str],
+) -> list:
+    """Streams the dataframe into the table, giving an insertId to every row.
+    BigQuery drops, on a best-effort basis, the rows whose insertId has been received
+    within the last minutes, so retries of the same rows do not create duplicates.
+    ## Arguments
+    - `bigquery_client`: The client used to stream the rows.
+    - `table`: The destination table, with its schema.
+    - `dataframe`: The rows to insert.
+    - `row_ids`: The insertId of every row of the dataframe, in the same order.
+
+    ## Returns
+    The insert errors of all chunks.
+    """
+    errors = []
+    # Chunks are made here because the client gives the same row_ids to every chunk
+    for start in range(0, len(dataframe.index), STREAMING_CHUNK_SIZE):
+        end = start + STREAMING_CHUNK_SIZE
+        for chunk_errors in bigquery_client.insert_rows_from_dataframe(
+            table=table,
+            dataframe=dataframe.iloc[start:end],
+            chunk_size=STREAMING_CHUNK_SIZE,
+            row_ids=row_ids[start:end],
+            ignore_unknown_values=True,
+        ):
+            errors += chunk_errors
+    return errors
+
+
+def insert_with_server_side_deduplication(
+    bigquery_client: Client,
+    destination,
+    table: DatasetTypeAlias,
+    dataframe: pd.DataFrame,
+) -> int:
+    """Loads the dataframe into a temporary table, then inserts the rows that are not saved yet
+    with one INSERT ... SELECT ... WHERE NOT EXISTS statement, see `build_server_side_deduplication_query`.
+    The keys are compared inside BigQuery instead of being downloaded.
+    ## Arguments
+    - `bigquery_client`: The client used to manage the temporary table.
+    - `destination`: The destination table, with its schema.
+    - `table`: The destination table enum, one of `SERVER_SIDE_DEDUPLICATION_TABLES`.
+    - `dataframe`: The rows to insert.
+
+    ## Returns
+    The number of inserted rows.
+    """
+    schema = [
+        SchemaField(
+            field.name,
+            field.field_type,
+            mode="REPEATED" if field.mode == "REPEATED" else "NULLABLE",
+            fields=field.fields,
+        )
+        for field in destination.schema
+        if field.name in dataframe.columns
+    ]
+    columns = [field.name for field in schema]
+    temporary_dataframe = cast_dataframe_to_schema(dataframe[columns], schema)
+    temporary_dataframe[ROW_POSITION_COLUMN] = range(len(temporary_dataframe.index))
+
+    with temporary_table(
+        temporary_dataframe,
+        schema + [SchemaField(ROW_POSITION_COLUMN, "INTEGER")],
+        destination.project,
+        destination.dataset_id,
+        bigquery_client=bigquery_client,
+        prefix=f"{destination.table_id}_insert",
+    ) as temporary_table_id:
+        query_job = raw_query(
+            f"""
+            INSERT INTO {destination.dataset_id}.{destination.table_id} ({", ".join(columns)})
+            {build_server_side_deduplication_query(table, temporary_table_id, columns)}
+            """
+        )
+
+    print(
+        f"{len(dataframe.index) - query_job.num_dml_affected_rows} duplicate rows removed by BigQuery."
+    )
+    return query_job.num_dml_affected_rows
+
+
+InsertCheck = Tuple[str, Callable[[pd.DataFrame], Optional[pd.DataFrame]]]
+
+
+class InsertDryRunReport(TypedDict):
+    """Result of an insert ran with `dry_run=True`."""
+
+    table: str
+    rows_to_insert: pd.DataFrame
+    dropped_rows: pd.DataFrame
+    errors: Dict[str, str]
+    timings: Dict[str, float]
+
+
+def get_insert_checks(
+    table: DatasetTypeAlias,
+    idempotent: bool = False,
+    use_key_index: bool = False,
+    server_side_deduplication: bool = False,
+    duplicates_removed: bool = False,
+) -> Tuple[str, List[InsertCheck]]:
+    """Gets the dataset name of the table and the checks to run before inserting into it,
+    from the rules of the table in `DEDUP_RULES`.
+    A check takes the dataframe and returns the rows to keep, or None if it only validates.
+    ## Arguments
+    - `table`: The database table. It must be one of the datasets.
+    - `idempotent`: Whether the insert is idempotent, see `insert_dataframe_into_database`.
+    - `use_key_index`: Whether the duplicate checks use the local key index.
+    - `server_side_deduplication`: Whether the duplicate checks run in BigQuery during the insert.
+    - `duplicates_removed`: Whether the lookup of the table already ran, see `remove_saved_rows`.
+
+    ## Returns
+    The dataset name and the ordered list of (check name, check function).
+    """
+    dataset = get_dataset_name(table)
+    rules = get_table_rules(table)
+    checks: List[InsertCheck] = []
+    for rule_check in rules.checks:
+        if rule_check.is_duplicate_check:
+            if idempotent and rules.append_only:
+                continue
+            if server_side_deduplication and table in SERVER_SIDE_DEDUPLICATION_TABLES:
+                continue
+            if duplicates_removed and rules.lookup is not None:
+                if rules.lookup.check_name == rule_check.name:
+                    continue
+        function = rule_check.function
+        if rule_check.uses_key_index:
+            function = partial(function, use_key_index=use_key_index)
+        checks.append((rule_check.name, function))
+
+    return dataset, checks
+
+
+def _run_timed_check(
+    check: Callable[[pd.DataFrame], Optional[pd.DataFrame]], dataframe: pd.DataFrame
+) -> Tuple[Optional[pd.DataFrame], float]:
+    """Runs a check and measures its duration in seconds."""
+    start_time = perf_counter()
+    result = check(dataframe)
+    return result, perf_counter() - start_time
+
+
+def dry_run_insert_checks(
+    dataframe: pd.DataFrame,
+    table: DatasetTypeAlias,
+    checks: List[InsertCheck],
+) -> InsertDryRunReport:
+    """Runs the insert checks of a table concurrently, without writing anything.
+    The header rows are removed first, then every other check runs on its own copy of the dataframe.
+    A row is kept if every check keeps it. The values modified by the checks are kept as well.
+    ## Arguments
+    - `dataframe`: The dataframe that would be inserted.
+    - `table`: The database table. It must be one of the datasets.
+    - `checks`: The checks of the table, see `get_insert_checks`.
+
+    ## Returns
+    - `rows_to_insert`: The rows that would be inserted.
+    - `dropped_rows`: The dropped rows, with the checks that dropped them in the `dropped_by` column.
+    - `errors`: The error message of every check that raised.
+    - `timings`: The duration of every check, in seconds.
+    """
+    if not dataframe.index.is_unique:
+        dataframe = dataframe.reset_index(drop=True)
+
+    results: Dict[str, Optional[pd.DataFrame]] = {}
+    errors: Dict[str, str] = {}
+    timings: Dict[str, float] = {}
+    concurrent_checks = []
+    for name, check in checks:
+        if check is remove_duplicate_headers_dataframe:
+            results[name], timings[name] = _run_timed_check(check, dataframe)
+        else:
+            concurrent_checks.append((name, check))
+
+    checked_dataframe = results.get("remove_duplicate_headers_dataframe", dataframe)
+    if concurrent_checks:
+        with ThreadPoolExecutor(max_workers=len(concurrent_checks)) as executor:
+            futures = {
+                name: executor.submit(_run_timed_check, check, checked_dataframe.copy())
+                for name, check in concurrent_checks
+            }
+            for name, future in futures.items():
+                try:
+                    results[name], timings[name] = future.result()
+                except Exception as error:
+                    errors[name] = f"{type(error).__name__}: {error}"
+
+    dropped_by = pd.Series("", index=dataframe.index)
+    kept_index = dataframe.index
+    for name, result in results.items():
+        if result is None:
+            continue
+        checked_index = (
+            dataframe.index
+            if name == "remove_duplicate_headers_dataframe"
+            else checked_dataframe.index
+        )
+        dropped_index = checked_index.difference(result.index)
+        dropped_by.loc[dropped_index] += name + ", "
+        kept_index = kept_index.intersection(result.index, sort=False)
+
+    rows_to_insert = dataframe.loc[kept_index].copy()
+    for result in results.values():
+        if result is not None:
+            for column in result.columns:
+                rows_to_insert[column] = result.loc[kept_index, column]
+
+    dropped_rows = dataframe.loc[dataframe.index.difference(kept_index)].copy()
+    dropped_rows["dropped_by"] = dropped_by.loc[dropped_rows.index].str.rstrip(", ")
+
+    print_info(
+        f"Dry run on table {table.name}: {len(rows_to_insert.index)} rows to insert, "
+        f"{len(dropped_rows.index)} rows dropped, {len(errors)} checks failed."
+    )
+    return InsertDryRunReport(
+        table=f"{get_dataset_name(table)}.{table.name}",
+        rows_to_insert=rows_to_insert,
+        dropped_rows=dropped_rows,
+        errors=errors,
+        timings=timings,
+    )
+
+
 def insert_dataframe_into_database(
     dataframe: pd.DataFrame,
     table: DatasetTypeAlias,
     write_method: Literal[
-        "insert_rows_from_dataframe", "load_table_from_dataframe"
+        "insert_rows_from_dataframe",
+        "load_table_from_dataframe",
+        "server_side_deduplication",
     ] = "insert_rows_from_dataframe",
     write_disposition: Literal[
         "WRITE_TRUNCATE", "WRITE_APPEND", "WRITE_EMPTY"
     ] = "WRITE_APPEND",
-) -> int:
+    idempotent: bool = False,
+    dry_run: bool = False,
+    use_key_index: bool = False,
+    duplicates_removed: bool = False,
+) -> Union[int, InsertDryRunReport]:
     """Inserts every row of the dataframe into the database.
     Does duplicate checks for specific tables (Invoices, Refunds).
     ## Arguments
@@ -87,6 +328,9 @@ def insert_dataframe_into_database(
     - `table`: The database table name. It must be one of the datasets.
     - 'write_method': Which GBQ client method gets called. 'load_table_from_dataframe' avoids
     bugs related to handling nullable PyArrow datatypes like Int64.
+    'server_side_deduplication' loads the dataframe into a temporary table and inserts the
+    new rows with one statement, the duplicate checks of Refunds, Deliveries and
+    PackageInformation then run inside BigQuery, see `insert_with_server_side_deduplication`.
     - `write_disposition`. Specifies the action that occurs if the destination table
     already exists when using the 'load_table_from_dataframe' method. The following values
     are supported:
@@ -98,12 +342,23 @@ def insert_dataframe_into_database(
     Each action is atomic and only occurs if BigQuery is able to complete the job
     successfully. Creation, truncation and append actions occur as one atomic update
     upon job completion.
+    - `idempotent`: Streams every row with an insertId computed from the `ROW_ID_COLUMNS`
+    of the table, so that retries are deduplicated by BigQuery. The duplicate checks
+    are skipped for the append-only tables of `DEDUP_RULES`.
+    - `dry_run`: Runs the checks of the table concurrently and returns what would be
+    inserted, see `dry_run_insert_checks`. Nothing is written.
+    - `use_key_index`: The duplicate checks of Invoices, Refunds, Deliveries and PackageInformation
+    look the keys up in the local key index, synced incrementally, instead of querying the table.
+    - `duplicates_removed`: The saved rows were already removed by `remove_saved_rows`,
+    so the duplicate check replaced by the lookup of the table is skipped.
 
     ## Example
         >>> insert_dataframe_into_database(df, InvoicesData_dataset.Invoices)
+        >>> insert_dataframe_into_database(df, InvoicesData_dataset.Deliveries, idempotent=True)
 
     ## Returns
     - The number of inserted rows.
+    - The dry run report if `dry_run` is set.
     - An Exception if a check didn't pass.
     """
     if (
@@ -112,6 +367,22 @@ def insert_dataframe_into_database(
     ):
         raise ValueError("WRITE_TRUNCATE is not allowed in production environment.")
 
+    if (
+        write_method == "server_side_deduplication"
+        and table not in SERVER_SIDE_DEDUPLICATION_TABLES
+    ):
+        raise ValueError(f"No server-side duplicate check for table {table.name}.")
+
+    if idempotent:
+        if write_method != "insert_rows_from_dataframe":
+            raise ValueError(
+                "Idempotent inserts are only available with 'insert_rows_from_dataframe'."
+            )
+        if table not in ROW_ID_COLUMNS:
+            raise ValueError(
+                f"No row id columns are configured for table {table.name}."
+            )
+
     if not isinstance(dataframe, pd.DataFrame):
         print_error("dataframe argument must be a DataFrame.")
         return 0
@@ -123,52 +394,20 @@ def insert_dataframe_into_database(
     print(
         f"Trying to save a dataframe ({len(dataframe.index)} rows) to Google BigQuery table {table.name}"
     )
-    if isinstance(table, InvoicesData_dataset):
-        dataset = "InvoicesData"
-        dataframe = remove_duplicate_headers_dataframe(dataframe)
-        if table.name == "Invoices":
-            dataframe = remove_duplicate_invoices(dataframe)
-        if table.name == "Refunds":
-            dataframe = remove_duplicate_refunds(dataframe)
-        if table.name == "ClientInvoicesData":
-            dataframe = remove_duplicate_client_invoice_data(dataframe)
-            dataframe = client_invoice_data_quality_check(dataframe)
-        if table.name == "Deliveries":
-            dataframe = remove_duplicate_deliveries(dataframe)
-
-    elif isinstance(table, LoxData_dataset):
-        dataset = "LoxData"
-        if table.name == "DueInvoices":
-            check_lox_invoice_not_exists(dataframe)
-        if table.name == "InvoicesDetails":
-            check_duplicate_invoices_details(dataframe)
-    elif isinstance(table, Mapping_dataset):
-        dataset = "Mapping"
-    elif isinstance(table, InvoicesDataLake_dataset):
-        dataset = "InvoicesDataLake"
-    elif isinstance(table, UserData_dataset):
-        dataset = "UserData"
-        if table.name == "InvoicesFromClientToCarrier":
-            dataframe = remove_duplicate_invoices_from_client_to_carrier(dataframe)
-
-        if table.name == "NestedAccountNumbers":
-            dataframe = remove_duplicate_NestedAccountNumbers(dataframe)
-    elif isinstance(table, Utils_dataset):
-        dataset = "Utils"
-        if table.name == "CurrencyConversion":
-            dataframe = remove_duplicate_currency_conversion(dataframe)
-    elif isinstance(table, CarrierData_dataset):
-        dataset = "CarrierData"
-        if table.name == "PackageInformation":
-            dataframe = remove_duplicate_package_information(dataframe)
-            # Check that required columns are not null and country codes are valid
-            quality_check_package_info(dataframe)
-    elif isinstance(table, RecordedActivity_dataset):
-        dataset = "RecordedActivity"
-    elif isinstance(table, SubscriptionData_dataset):
-        dataset = "SubscriptionData"
-    else:
-        raise TypeError("'table' param must be an instance of one of the tables Enum.")
+    dataset, checks = get_insert_checks(
+        table,
+        idempotent,
+        use_key_index,
+        server_side_deduplication=write_method == "server_side_deduplication",
+        duplicates_removed=duplicates_removed,
+    )
+    if dry_run:
+        return dry_run_insert_checks(dataframe, table, checks)
+
+    for _, check in checks:
+        result = check(dataframe)
+        if result is not None:
+            dataframe = result
 
     if dataframe.empty:
         print("Empty dataframe, insert aborted because unnecessary.")
@@ -177,56 +416,71 @@ def insert_dataframe_into_database(
     print_success(
         f"Checks done - Saving dataframe ({len(dataframe.index)} rows) to Google BigQuery table {table.name}"
     )
+    row_ids: Optional[List[str]] = None
+    if idempotent:
+        row_ids = generate_id_series(dataframe, ROW_ID_COLUMNS[table]).tolist()
+
     bigquery_client = Client()
-    # Prepares a reference to the dataset
-    dataset_ref = bigquery_client.dataset(dataset)
-    # Select the table where you want to push the data
-    table_ref = dataset_ref.table(table.name)
-    table = bigquery_client.get_table(table_ref)
+    # The schema comes from the registry when it has every column, to avoid fetching the table,
+    # except for the load jobs which reject a schema whose modes differ from the live table
+    table_with_schema = get_table_with_schema(
+        bigquery_client,
+        dataset,
+        table.name,
+        [*dataframe.columns, "insert_datetime", "update_datetime"],
+        exact_modes=write_method == "load_table_from_dataframe",
+    )
     dataframe = dataframe.where(pd.notnull(dataframe), None)
 
+    if write_method == "server_side_deduplication":
+        dataframe = add_metadata_columns(dataframe, "load_table_from_dataframe")
+        inserted_rows = insert_with_server_side_deduplication(
+            bigquery_client, table_with_schema, table, dataframe
+        )
+        print_success("Success, every new row has been inserted.")
+        return inserted_rows
+
     # Add metadata columns
     dataframe = add_metadata_columns(dataframe, write_method)
 
     if write_method == "insert_rows_from_dataframe":
-        errors = bigquery_client.insert_rows_from_dataframe(
-            table=table,
-            dataframe=dataframe,
-            ignore_unknown_values=True,
-        )[0]
+        if row_ids is not None:
+            errors = insert_rows_with_ids(
+                bigquery_client, table_with_schema, dataframe, row_ids
+            )
+        else:
+            errors = bigquery_client.insert_rows_from_dataframe(
+                table=table_with_schema,
+                dataframe=dataframe,
+                ignore_unknown_values=True,
+            )[0]
 
         if errors:
             raise InvalidDataException(
-                f"{pformat(errors)}\n{len(errors)} errors occured while inserting dataframe into {table}."
+                f"{pformat(errors)}\n{len(errors)} errors occured while inserting dataframe into {table_with_schema}."
             )
     else:
-        job_config = LoadJobConfig(write_disposition=write_disposition)
+        # Giving the schema avoids the request made by the client to get it
+        job_config = LoadJobConfig(
+            write_disposition=write_disposition,
+            schema=[
+                field
+                for field in table_with_schema.schema
+                if field.name in dataframe.columns
+            ],
+        )
         load_job = bigquery_client.load_table_from_dataframe(
             dataframe,
-            f"{table.project}.{table.dataset_id}.{table.table_id}",
+            f"{table_with_schema.project}.{table_with_schema.dataset_id}.{table_with_schema.table_id}",
             job_config=job_config,
         ).result()
 
         if load_job.errors:
             raise InvalidDataException(
                 f"{pformat(load_job.errors)}\n{len(load_job.errors)} errors occured while "
-                f"inserting dataframe into {table} with method {write_disposition}."
+                f"inserting dataframe into {table_with_schema} with method {write_disposition}."
             )
 
     print_success("Success, everything has been inserted.")
 
     return len(dataframe.index)
-
-
-def remove_duplicate_headers_dataframe(dataframe: pd.DataFrame) -> pd.DataFrame:
-    """Removes rows that are similar to the header and are not in the first line of the given dataframe
-    ## Arguments
-    - `dataframe`: dataframe that needs to be checked.
-
-    ## Example
-        >>> remove_duplicate_headers_dataframe(refunds_df)
-
-    ## Returns
-    The dataframe cleaned from potential header duplicates
-    """
-    return dataframe.loc[~(dataframe == dataframe.columns).all(axis="columns")]
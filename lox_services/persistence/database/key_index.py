@@ -0,0 +1,400 @@
+"""Persistent local index of the keys already saved in the database, used by the duplicate checks.
+
+Each index holds the fingerprinted keys of one table for one tenant (company and carrier), as a sorted
+array memory-mapped from the local disk. It is synced incrementally from Google BigQuery with
+the `insert_datetime` of the rows, so only the rows inserted since the last sync are downloaded.
+As `insert_datetime` is set by the clients, late rows can be missed by a sync: the keys missing
+from the index are confirmed against the database before being reported as new, with a lookup on
+the clustered column of the table restricted to the partitions of the incoming rows.
+"""
+
+import fcntl
+import json
+import os
+import re
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from enum import Enum
+from time import perf_counter
+from typing import Dict, Iterator, NamedTuple, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from lox_services.config.paths import DATABASE_CACHE_FOLDER
+from lox_services.persistence.database.datasets import (
+    CarrierData_dataset,
+    InvoicesData_dataset,
+    get_dataset_name,
+)
+from lox_services.persistence.database.query_handlers import (
+    estimate_query_bytes,
+    raw_query,
+)
+from lox_services.persistence.database.partitioning import build_partition_filter
+from lox_services.persistence.database.utils import fingerprint_series
+from lox_services.utils.enums import BQParameterType
+from lox_services.utils.general_python import print_info
+
+KEY_INDEX_FOLDER = os.path.join(DATABASE_CACHE_FOLDER, "key_index")
+
+# Rows inserted slightly before the watermark can still be in the streaming buffer,
+# so every sync looks back this far.
+SYNC_LOOKBACK = timedelta(minutes=15)
+
+INDEX_FORMAT_VERSION = 2
+
+# Number of lookup values of the missing keys confirmed per query
+CONFIRM_CHUNK_SIZE = 50000
+
+
+class KeyIndexSpec(NamedTuple):
+    """How the keys of a table are built, and whether they are split by tenant.
+    The missing keys are confirmed by looking up the values of `lookup_column` of their rows.
+    """
+
+    key_sql: str
+    by_tenant: bool
+    lookup_column: str
+
+
+KEY_INDEX_SPECS: Dict[Enum, KeyIndexSpec] = {
+    InvoicesData_dataset.Invoices: KeyIndexSpec(
+        "invoice_number", True, "invoice_number"
+    ),
+    InvoicesData_dataset.Refunds: KeyIndexSpec(
+        """tracking_number || CASE
+            WHEN reason_refund IN ("Lost", "Damaged", "Delivery Dispute")
+                THEN 'Lost or Damaged'
+                ELSE reason_refund
+            END""",
+        True,
+        "tracking_number",
+    ),
+    InvoicesData_dataset.Deliveries: KeyIndexSpec(
+        "tracking_number || status || FORMAT_DATETIME('%Y-%m-%d %H:%M:%S', date_time)",
+        False,
+        "tracking_number",
+    ),
+    CarrierData_dataset.PackageInformation: KeyIndexSpec(
+        "carrier || company || tracking_number", False, "tracking_number"
+    ),
+}
+
+
+class KeyIndex:
+    """Local index of the keys of one table for one tenant.
+    ## Arguments
+    - `table`: The table, it must have a spec in `KEY_INDEX_SPECS`.
+    - `company`, `carrier`: The tenant, required for the tables indexed by tenant.
+    - `folder`: The folder where the indexes are stored.
+
+    ## Example
+        >>> index = KeyIndex(InvoicesData_dataset.Invoices, company="Lox", carrier="UPS")
+        >>> index.sync()
+        >>> already_saved = index.contains(df["invoice_number"], df)
+    """
+
+    def __init__(
+        self,
+        table: Enum,
+        *,
+        company: Optional[str] = None,
+        carrier: Optional[str] = None,
+        folder: str = KEY_INDEX_FOLDER,
+    ):
+        if table not in KEY_INDEX_SPECS:
+            raise ValueError(f"No key index spec for table {table.name}.")
+        self.table = table
+        self.spec = KEY_INDEX_SPECS[table]
+        if self.spec.by_tenant and (company is None or carrier is None):
+            raise ValueError(f"Table {table.name} is indexed by company and carrier.")
+        self.company = company if self.spec.by_tenant else None
+        self.carrier = carrier if self.spec.by_tenant else None
+
+        tenant = "all"
+        if self.spec.by_tenant:
+            tenant = re.sub(r"[^\w-]", "_", f"{company}__{carrier}")
+        table_folder = os.path.join(folder, f"{get_dataset_name(table)}.{table.name}")
+        os.makedirs(table_folder, exist_ok=True)
+        self.keys_path = os.path.join(table_folder, f"{tenant}.npy")
+        self.metadata_path = os.path.join(table_folder, f"{tenant}.json")
+        self.lock_path = os.path.join(table_folder, f"{tenant}.lock")
+
+        self.watermark: Optional[datetime] = None
+        self.keys = np.array([], dtype=np.int64)
+        self.stats = {
+            "syncs": 0,
+            "synced_rows": 0,
+            "sync_bytes_processed": 0,
+            "sync_seconds": 0.0,
+            "full_scan_bytes_estimate": None,
+            "lookups": 0,
+            "keys_checked": 0,
+            "keys_found": 0,
+            "keys_confirmed": 0,
+            "confirm_queries": 0,
+            "confirm_bytes_processed": 0,
+        }
+        with self._locked():
+            self._load()
+
+    ### PRIVATE ###
+
+    @contextmanager
+    def _locked(self) -> Iterator[None]:
+        """Holds the lock of the index files, shared with the other processes."""
+        with open(self.lock_path, "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _load(self) -> None:
+        """Merges the index saved on disk, maybe by another process, into this one.
+        Each index holds every key inserted before its watermark, so their union holds every
+        key inserted before the latest of the two.
+        """
+        if not (os.path.exists(self.metadata_path) and os.path.exists(self.keys_path)):
+            return
+        with open(self.metadata_path, "r", encoding="utf-8") as file:
+            metadata = json.load(file)
+        if metadata.get("version") != INDEX_FORMAT_VERSION:
+            return
+        saved_keys = np.load(self.keys_path, mmap_mode="r")
+        self.keys = (
+            saved_keys if self.keys.size == 0 else np.union1d(self.keys, saved_keys)
+        )
+        if metadata["watermark"] is not None:
+            saved_watermark = datetime.fromisoformat(metadata["watermark"])
+            if self.watermark is None or saved_watermark > self.watermark:
+                self.watermark = saved_watermark
+
+    def _add_keys(self, keys: np.ndarray) -> None:
+        self.keys = np.union1d(self.keys, keys.astype(np.int64))
+
+    def _save(self) -> None:
+        # Written aside then renamed so that other processes never read a partial index
+        temporary_keys_path = self.keys_path + ".tmp.npy"
+        np.save(temporary_keys_path, self.keys)
+        os.replace(temporary_keys_path, self.keys_path)
+        temporary_metadata_path = self.metadata_path + ".tmp"
+        with open(temporary_metadata_path, "w", encoding="utf-8") as file:
+            json.dump(
+                {
+                    "version": INDEX_FORMAT_VERSION,
+                    "watermark": (
+                        None if self.watermark is None else self.watermark.isoformat()
+                    ),
+                    "size": int(self.keys.size),
+                },
+                file,
+            )
+        os.replace(temporary_metadata_path, self.metadata_path)
+
+    def _tenant_filter(self) -> Tuple[str, list]:
+        if not self.spec.by_tenant:
+            return "", []
+        return "AND company = @company AND carrier = @carrier", [
+            ("company", BQParameterType.STRING, self.company),
+            ("carrier", BQParameterType.STRING, self.carrier),
+        ]
+
+    ### PUBLIC ###
+
+    def sync(self) -> int:
+        """Downloads the keys inserted since the last sync and adds them to the index.
+        ## Returns
+        The number of downloaded rows.
+        """
+        tenant_filter, parameters = self._tenant_filter()
+        watermark_filter = ""
+        if self.watermark is not None:
+            watermark_filter = "AND insert_datetime > @watermark"
+            parameters.append(
+                (
+                    "watermark",
+                    BQParameterType.DATETIME,
+                    self.watermark - SYNC_LOOKBACK,
+                )
+            )
+
+        query = f"""
+            SELECT
+                FARM_FINGERPRINT({self.spec.key_sql}) AS existing_key,
+                insert_datetime
+
+            FROM {get_dataset_name(self.table)}.{self.table.name}
+
+            WHERE {self.spec.key_sql} IS NOT NULL
+                {tenant_filter}
+                {watermark_filter}
+        """
+        start_time = perf_counter()
+        query_job = raw_query(query, parameters=parameters, print_query=False)
+        new_rows = query_job.result().to_dataframe()
+
+        # Loaded again under the lock to keep the keys synced by the other processes meanwhile
+        with self._locked():
+            self._load()
+            if not new_rows.empty:
+                self._add_keys(new_rows["existing_key"].to_numpy(dtype=np.int64))
+                last_insert_datetime = pd.Timestamp(
+                    new_rows["insert_datetime"].max()
+                ).to_pydatetime()
+                if self.watermark is None or last_insert_datetime > self.watermark:
+                    self.watermark = last_insert_datetime
+            self._save()
+
+        self.stats["syncs"] += 1
+        self.stats["synced_rows"] += len(new_rows.index)
+        self.stats["sync_bytes_processed"] += query_job.total_bytes_processed or 0
+        self.stats["sync_seconds"] += perf_counter() - start_time
+        return len(new_rows.index)
+
+    def confirm_missing(
+        self, hashed_keys: np.ndarray, rows: pd.DataFrame
+    ) -> np.ndarray:
+        """Looks up in the database the keys missing from the index, and adds the ones found.
+        The lookup filters the `lookup_column` of the table and its partitions, like the
+        duplicate checks, instead of the fingerprints which can't prune the scan.
+        ## Arguments
+        - `hashed_keys`: The fingerprints of the keys.
+        - `rows`: The incoming rows of the keys, holding the lookup and partition columns.
+
+        ## Returns
+        The fingerprints found in the database.
+        """
+        lookup_values = (
+            rows[self.spec.lookup_column].dropna().astype(str).unique().tolist()
+        )
+        tenant_filter, tenant_parameters = self._tenant_filter()
+        partition_filter, partition_parameters = build_partition_filter(
+            self.table, rows
+        )
+        found_keys = []
+        for start in range(0, len(lookup_values), CONFIRM_CHUNK_SIZE):
+            query_job = raw_query(
+                f"""
+                SELECT DISTINCT FARM_FINGERPRINT({self.spec.key_sql}) AS existing_key
+
+                FROM {get_dataset_name(self.table)}.{self.table.name}
+
+                WHERE {self.spec.lookup_column} IN UNNEST(@lookup_values)
+                    {partition_filter}
+                    {tenant_filter}
+                """,
+                parameters=[
+                    (
+                        "lookup_values",
+                        BQParameterType.STRING,
+                        lookup_values[start : start + CONFIRM_CHUNK_SIZE],
+                    ),
+                    *partition_parameters,
+                    *tenant_parameters,
+                ],
+                print_query=False,
+            )
+            self.stats["confirm_queries"] += 1
+            self.stats["confirm_bytes_processed"] += (
+                query_job.total_bytes_processed or 0
+            )
+            found_keys.append(
+                query_job.result()
+                .to_dataframe()["existing_key"]
+                .to_numpy(dtype=np.int64)
+            )
+
+        found_keys = np.intersect1d(
+            np.concatenate(found_keys) if found_keys else hashed_keys[:0],
+            hashed_keys,
+        )
+        self.stats["keys_confirmed"] += int(found_keys.size)
+        if found_keys.size:
+            print_info(
+                f"{found_keys.size} keys of {self.table.name} were missing from the index."
+            )
+            with self._locked():
+                self._load()
+                self._add_keys(found_keys)
+                self._save()
+        return found_keys
+
+    def contains(
+        self, keys: pd.Series, rows: Optional[pd.DataFrame] = None
+    ) -> pd.Series:
+        """Tells, for every key, whether it is already saved in the index.
+        ## Arguments
+        - `keys`: The keys to look for, built like the `key_sql` of the table spec.
+        - `rows`: The incoming rows of the keys, with the same index. When given, the keys
+        missing from the index are confirmed in the database, see `confirm_missing`.
+
+        ## Returns
+        A boolean series with the same index as `keys`.
+        """
+        hashed_keys = fingerprint_series(keys).to_numpy()
+        positions = np.searchsorted(self.keys, hashed_keys)
+        found = np.zeros(len(hashed_keys), dtype=bool)
+        in_bounds = positions < self.keys.size
+        found[in_bounds] = self.keys[positions[in_bounds]] == hashed_keys[in_bounds]
+        if rows is not None and not found.all():
+            found[~found] = np.isin(
+                hashed_keys[~found],
+                self.confirm_missing(hashed_keys[~found], rows.loc[keys.index[~found]]),
+            )
+
+        self.stats["lookups"] += 1
+        self.stats["keys_checked"] += len(hashed_keys)
+        self.stats["keys_found"] += int(found.sum())
+        return pd.Series(found, index=keys.index)
+
+    def reset(self) -> None:
+        """Empties the index, the next sync downloads every key again."""
+        self.watermark = None
+        self.keys = np.array([], dtype=np.int64)
+        with self._locked():
+            for path in (self.keys_path, self.metadata_path):
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def report(self) -> dict:
+        """Reports the cost of the index compared to a lookup over the whole table.
+        The cost of the index is the bytes of its syncs and of the confirmations of missing keys.
+        The bytes of the full lookup are estimated once with a free dry run.
+        """
+        if self.stats["full_scan_bytes_estimate"] is None:
+            tenant_filter, parameters = self._tenant_filter()
+            self.stats["full_scan_bytes_estimate"] = estimate_query_bytes(
+                f"""
+                SELECT {self.spec.key_sql}
+                FROM {get_dataset_name(self.table)}.{self.table.name}
+                WHERE TRUE {tenant_filter}
+                """,
+                parameters=parameters,
+            )
+        report = dict(self.stats)
+        report["bytes_saved_estimate"] = max(
+            self.stats["full_scan_bytes_estimate"] * self.stats["lookups"]
+            - self.stats["sync_bytes_processed"]
+            - self.stats["confirm_bytes_processed"],
+            0,
+        )
+        print_info(f"Key index {self.table.name} report: {report}")
+        return report
+
+
+_KEY_INDEXES: Dict[Tuple[Enum, Optional[str], Optional[str]], KeyIndex] = {}
+
+
+def get_key_index(
+    table: Enum, company: Optional[str] = None, carrier: Optional[str] = None
+) -> KeyIndex:
+    """Gets the key index of a table and tenant, opened once per process."""
+    if not KEY_INDEX_SPECS[table].by_tenant:
+        company, carrier = None, None
+    if (table, company, carrier) not in _KEY_INDEXES:
+        _KEY_INDEXES[(table, company, carrier)] = KeyIndex(
+            table, company=company, carrier=carrier
+        )
+    return _KEY_INDEXES[(table, company, carrier)]
@@ -0,0 +1,151 @@
+"""Partitioning and clustering of the tables of the database, used to prune the lookups.
+
+The duplicate checks look rows up by key (tracking number, invoice number...). Without a filter
+on the partition column, BigQuery scans the whole history of the table for every push. The
+filters built here restrict a lookup to the time range of the incoming rows, plus a slack.
+The partition column declared for a table is checked once per process against the live table,
+a lookup is never restricted on a column the table is not partitioned by.
+"""
+
+import os
+from datetime import timedelta
+from enum import Enum
+from functools import lru_cache
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+import pandas as pd
+from google.cloud.bigquery import Client
+
+from lox_services.persistence.config import SERVICE_ACCOUNT_PATH
+from lox_services.persistence.database.datasets import (
+    InvoicesData_dataset,
+    get_dataset_name,
+)
+from lox_services.utils.enums import BQParameterType
+from lox_services.utils.general_python import print_error
+
+
+class TablePartitioning(NamedTuple):
+    """How a table is partitioned and clustered.
+    - `partition_column`: The DATE or DATETIME column the table is partitioned by.
+    - `partition_type`: The type of the partition column.
+    - `cluster_columns`: The columns the table is clustered by, in order.
+    - `lookup_slack`: Margin added around the time range of the incoming rows when a lookup is pruned.
+    `None` when the lookup key does not depend on the partition column, so the lookups are never pruned.
+    """
+
+    partition_column: str
+    partition_type: BQParameterType
+    cluster_columns: List[str]
+    lookup_slack: Optional[timedelta]
+
+
+TABLE_PARTITIONING: Dict[Enum, TablePartitioning] = {
+    # The date time is part of the key of a delivery, the slack only covers timezone shifts
+    InvoicesData_dataset.Deliveries: TablePartitioning(
+        "date_time", BQParameterType.DATETIME, ["tracking_number"], timedelta(days=2)
+    ),
+    # An invoice number is always saved with the same invoice date
+    InvoicesData_dataset.Invoices: TablePartitioning(
+        "invoice_date",
+        BQParameterType.DATE,
+        ["company", "carrier", "invoice_number"],
+        timedelta(days=7),
+    ),
+    # A refund can be requested again for a package invoiced at any date
+    InvoicesData_dataset.Refunds: TablePartitioning(
+        "invoice_date",
+        BQParameterType.DATE,
+        ["company", "carrier", "tracking_number"],
+        None,
+    ),
+}
+
+
+@lru_cache(maxsize=None)
+def get_live_partition_column(table: Enum) -> Optional[str]:
+    """Gets the column a table is partitioned by in BigQuery, with one metadata request per process.
+    ## Returns
+    The partition column, or None if the table is not partitioned by a column.
+    """
+    os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = SERVICE_ACCOUNT_PATH
+    live_table = Client().get_table(f"{get_dataset_name(table)}.{table.name}")
+    if live_table.time_partitioning is None:
+        return None
+    return live_table.time_partitioning.field
+
+
+@lru_cache(maxsize=None)
+def is_partitioned_by(table: Enum, column: str) -> bool:
+    """Tells whether the live table is partitioned by the column declared in `TABLE_PARTITIONING`."""
+    try:
+        live_column = get_live_partition_column(table)
+    except Exception as error:  # pylint: disable=broad-except
+        print_error(f"Partitioning of table {table.name} unknown: {error}")
+        return False
+    if live_column != column:
+        print_error(
+            f"Table {table.name} is partitioned by {live_column}, not {column}: its lookups are not pruned."
+        )
+        return False
+    return True
+
+
+def build_partition_filter(
+    table: Enum,
+    dataframe: pd.DataFrame,
+    *,
+    slack: Optional[timedelta] = None,
+    alias: Optional[str] = None,
+    parameter_prefix: str = "",
+) -> Tuple[str, list]:
+    """Builds the condition restricting a lookup to the partitions of the incoming rows.
+    ## Arguments
+    - `table`: The table looked up.
+    - `dataframe`: The incoming rows, holding the partition column of the table.
+    - `slack`: Overrides the `lookup_slack` of the table.
+    - `alias`: Alias of the table in the query.
+    - `parameter_prefix`: Prefix of the parameter names, when several filters are in the same query.
+
+    ## Example
+        >>> partition_filter, parameters = build_partition_filter(
+                InvoicesData_dataset.Deliveries, deliveries_df
+            )
+        >>> select(f"... WHERE tracking_number IN UNNEST(@tracking_numbers) {partition_filter}", ...)
+
+    ## Returns
+    - The condition, starting with `AND`, or an empty string when the lookup can't be pruned,
+    including when the live table is not partitioned by the declared column.
+    - The parameters of the condition.
+    """
+    partitioning = TABLE_PARTITIONING.get(table)
+    if partitioning is None:
+        return "", []
+    if slack is None:
+        slack = partitioning.lookup_slack
+    column = partitioning.partition_column
+    if slack is None or column not in dataframe.columns:
+        return "", []
+    if not is_partitioned_by(table, column):
+        return "", []
+
+    dates = pd.to_datetime(dataframe[column], errors="coerce")
+    if dates.isna().any() or dates.empty:
+        # Rows without a date could match a saved row of any partition
+        return "", []
+    start, end = dates.min() - slack, dates.max() + slack
+    if partitioning.partition_type == BQParameterType.DATE:
+        start, end = start.date(), end.date()
+    else:
+        start, end = start.to_pydatetime(), end.to_pydatetime()
+
+    qualified_column = column if alias is None else f"{alias}.{column}"
+    start_name = f"{parameter_prefix}partition_start"
+    end_name = f"{parameter_prefix}partition_end"
+    return (
+        f"AND {qualified_column} BETWEEN @{start_name} AND @{end_name}",
+        [
+            (start_name, partitioning.partition_type, start),
+            (end_name, partitioning.partition_type, end),
+        ],
+    )
@@ -2,13 +2,20 @@
 
 import os
 from enum import Enum
-from typing import Mapping, List, Sequence, Tuple, Union
+from typing import Mapping, List, Optional, Sequence, Tuple, Union
 
 import pandas as pd
 import numpy as np
 
 from lox_services.persistence.database.datasets import InvoicesData_dataset
+from lox_services.persistence.database.dedup_rules import remove_saved_rows
 from lox_services.persistence.database.insert import insert_dataframe_into_database
+from lox_services.persistence.database.schema_registry import get_csv_dtypes
+from lox_services.persistence.database.spool import InsertSpool
+from lox_services.persistence.database.status_normalization import (
+    StatusNormalizer,
+    get_status_normalizer,
+)
 from lox_services.persistence.database.schema import (
     dates_refunds,
     dtypes_deliveries,
@@ -24,6 +31,7 @@ from lox_services.persistence.database.utils import (
     validate_country_code,
 )
 from lox_services.utils.enums import Files
+from lox_services.utils.general_python import print_error
 
 
 def process_df(
@@ -32,8 +40,13 @@ def process_df(
     na_fill_value: Mapping[str, str],
     format_time_cols: bool = False,
     replace_empty_dates: bool = False,
+    status_carrier: Optional[str] = None,
+    status_normalizer: Optional[StatusNormalizer] = None,
 ) -> pd.DataFrame:
-    """Process dataframes before appending them to a processing batch."""
+    """Process dataframes before appending them to a processing batch.
+    If `status_carrier` is given, the missing final statuses are normalized from the
+    statuses of this carrier with `status_normalizer`, or set to the raw statuses without it.
+    """
     # If some columns are missing, add the columns with None values
     missing_columns = set(dtype_cols).difference(set(df.columns))
     if missing_columns:
@@ -48,6 +61,17 @@ def process_df(
             df["date"] + "T" + df["time"],
         )
 
+    if status_carrier is not None:
+        missing_final_status = df["final_status"].isna() | (df["final_status"] == "")
+        if missing_final_status.any() and status_normalizer is None:
+            df.loc[missing_final_status, "final_status"] = df.loc[
+                missing_final_status, "status"
+            ]
+        elif missing_final_status.any():
+            df.loc[missing_final_status, "final_status"] = status_normalizer.normalize(
+                df.loc[missing_final_status, "status"], status_carrier
+            )
+
     df = df.fillna(value=na_fill_value).astype(dtype_cols)
 
     if replace_empty_dates:
@@ -56,6 +80,22 @@ def process_df(
     return df
 
 
+def _get_status_normalization(carrier: str, normalize_statuses: bool) -> dict:
+    """Gets the status arguments of `process_df` for the deliveries of a carrier.
+    A mapping that can't be loaded doesn't fail the push, the raw statuses are used instead.
+    """
+    if not normalize_statuses:
+        return {}
+    try:
+        status_normalizer = get_status_normalizer()
+    except Exception as error:
+        print_error(
+            f"Status mapping unavailable, the raw statuses are used as final statuses: {error}"
+        )
+        status_normalizer = None
+    return {"status_carrier": carrier, "status_normalizer": status_normalizer}
+
+
 def process_postal_and_country_cols(df: pd.DataFrame) -> pd.DataFrame:
     """Remove faux floating point conversion in the dataframe."""
     postal_code_cols = df.columns[
@@ -112,7 +152,12 @@ def translate_country_codes(
 
 
 def push_run_to_database(
-    run_output_folder: str, carrier: str, company: str, account_number_input: str = ""
+    run_output_folder: str,
+    carrier: str,
+    company: str,
+    account_number_input: str = "",
+    spool: Optional[InsertSpool] = None,
+    normalize_statuses: bool = False,
 ) -> dict:
     """Add to the database all the important files of the given folder.
     Returns a dictionary reporesenting the run report.
@@ -121,6 +166,11 @@ def push_run_to_database(
     - `carrier_input`: The carrier that was run as a result of the given output folder
     - `company_input`: The company that was run as a result of the given output folder
     - `account_number_input` : the account_number that was run, REQUESTED for colissimo
+    - `spool`: If given, the files are written to this local spool and inserted in the background.
+    The report then contains the number of spooled rows.
+    - `normalize_statuses`: Fills the missing final statuses of the deliveries from the
+    Mapping.StatusMapping table, see `StatusNormalizer`. The raw statuses are used if the
+    mapping can't be loaded.
 
     ## Returns
         - A report of the inserted files.
@@ -147,6 +197,7 @@ def push_run_to_database(
                 infer_datetime_format=date_format,
                 header=0,
                 dtype={
+                    **get_csv_dtypes(InvoicesData_dataset.Invoices),
                     "postal_code_receiver": "string[pyarrow]",
                     "postal_code_sender": "string[pyarrow]",
                     "account_number": "str",
@@ -178,7 +229,11 @@ def push_run_to_database(
         )
         if not df_deliveries.empty:
             df_deliveries = process_df(
-                df_deliveries, dtypes_deliveries, na_deliveries, format_time_cols=True
+                df_deliveries,
+                dtypes_deliveries,
+                na_deliveries,
+                format_time_cols=True,
+                **_get_status_normalization(carrier, normalize_statuses),
             )
 
             list_files_to_push.append(
@@ -192,7 +247,10 @@ def push_run_to_database(
     if os.path.exists(refunds_path):
         # Read the refund file and check the datetime format
         df_refund: pd.DataFrame = pd.read_csv(
-            refunds_path, infer_datetime_format=date_format, header=0
+            refunds_path,
+            infer_datetime_format=date_format,
+            header=0,
+            dtype=get_csv_dtypes(InvoicesData_dataset.Refunds),
         )
         if not df_refund.empty:
             df_refund = process_df(
@@ -200,11 +258,22 @@ def push_run_to_database(
             )
             list_files_to_push.append((df_refund, InvoicesData_dataset.Refunds))
 
+    list_files_to_push = [
+        (replace_nan_with_none_in_dataframe(dataframe), table)
+        for dataframe, table in list_files_to_push
+    ]
     report = {}
+    if spool is not None:
+        for dataframe, table in list_files_to_push:
+            report[table.name] = spool.append(dataframe, table)
+        print("report:\n", report)
+        return report
+
+    # The duplicate lookups of all the files run in a single query
+    list_files_to_push = remove_saved_rows(list_files_to_push)  # API request
     for dataframe, table in list_files_to_push:
-        dataframe = replace_nan_with_none_in_dataframe(dataframe)
         number_inserted_rows = insert_dataframe_into_database(
-            dataframe=dataframe, table=table
+            dataframe=dataframe, table=table, duplicates_removed=True
         )  # API request
         report[table.name] = number_inserted_rows
 
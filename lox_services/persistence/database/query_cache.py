@@ -0,0 +1,283 @@
+"""Cache of the results of the select queries, shared by the processes of the machine.
+
+The results are stored as Parquet files on the local disk, keyed by the hash of the query and
+of its parameters. A result is valid while the `modified` time of every table referenced by
+the query is unchanged: it is checked with a free dry run and metadata requests, instead of
+running the query again. The least recently used results are evicted above a size budget.
+"""
+
+import fcntl
+import hashlib
+import json
+import os
+import re
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Any, Dict, Iterator, Optional, Sequence, Tuple
+
+import pandas as pd
+import pyarrow.parquet as pq
+from google.cloud.bigquery import Client
+
+from lox_services.config.paths import DATABASE_CACHE_FOLDER
+from lox_services.persistence.config import SERVICE_ACCOUNT_PATH
+from lox_services.persistence.database.query_handlers import (
+    build_query_job_config,
+    select,
+)
+from lox_services.utils.enums import BQParameterType
+from lox_services.utils.general_python import print_info
+
+QUERY_CACHE_FOLDER = os.path.join(DATABASE_CACHE_FOLDER, "query_results")
+
+# Disk budget of the cached results, the least recently used ones are evicted above it
+MAX_CACHE_SIZE = 2 * 1024**3
+
+CACHE_FORMAT_VERSION = 1
+
+# Number of hexadecimal characters of the query key naming its lock, which bounds the
+# lock files to 16 ** LOCK_KEY_LENGTH, whatever the number of cached results
+LOCK_KEY_LENGTH = 2
+
+# Functions whose result changes between two runs of the same query on the same tables
+NON_DETERMINISTIC_FUNCTIONS = re.compile(
+    r"\b(CURRENT_(DATE|DATETIME|TIME|TIMESTAMP)|RAND|GENERATE_UUID|SESSION_USER)\b",
+    re.IGNORECASE,
+)
+
+
+def get_query_key(
+    query: str,
+    parameters: Optional[Sequence[Tuple[str, BQParameterType, Any]]] = None,
+    dtypes: Optional[Dict[str, Any]] = None,
+) -> str:
+    """Hashes a query with its parameters and dtypes, the same query always has the same key."""
+    content = json.dumps(
+        {
+            "query": query.strip(),
+            "parameters": [
+                [name, parameter_type.value, value]
+                for name, parameter_type, value in parameters or []
+            ],
+            "dtypes": dtypes or {},
+        },
+        default=str,
+        sort_keys=True,
+    )
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+class QueryCache:
+    """Results of select queries cached on the local disk.
+    The processes computing the same result wait for each other instead of running the query twice.
+    ## Arguments
+    - `folder`: The folder where the results are stored.
+    - `max_size`: The disk budget of the results, in bytes.
+
+    ## Example
+        >>> cache = QueryCache()
+        >>> df = cache.select("SELECT * FROM InvoicesData.Invoices WHERE company = 'Lox'")
+    """
+
+    def __init__(
+        self, folder: str = QUERY_CACHE_FOLDER, max_size: int = MAX_CACHE_SIZE
+    ):
+        self.folder = folder
+        self.max_size = max_size
+        os.makedirs(folder, exist_ok=True)
+        self.stats = {"hits": 0, "misses": 0, "uncacheable": 0, "evictions": 0}
+
+    ### PRIVATE ###
+
+    def _get_paths(self, key: str) -> Tuple[str, str]:
+        return (
+            os.path.join(self.folder, f"{key}.parquet"),
+            os.path.join(self.folder, f"{key}.json"),
+        )
+
+    @contextmanager
+    def _lock(self, name: str) -> Iterator[None]:
+        """Holds an exclusive lock shared with the other processes, released with the block."""
+        with open(os.path.join(self.folder, f"{name}.lock"), "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _get_table_versions(
+        self,
+        query: str,
+        parameters: Optional[Sequence[Tuple[str, BQParameterType, Any]]],
+    ) -> Optional[Dict[str, str]]:
+        """Gets the `modified` time of every table referenced by the query, with a dry run.
+        ## Returns
+        The times by table id, or None if the result can't be cached: the query references
+        no table, or a table with rows in its streaming buffer, which are not reflected in
+        its `modified` time.
+        """
+        os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = SERVICE_ACCOUNT_PATH
+        bigquery_client = Client()
+        job_config = build_query_job_config(parameters or [])
+        job_config.dry_run = True
+        job_config.use_query_cache = False
+        referenced_tables = bigquery_client.query(
+            query, job_config=job_config
+        ).referenced_tables
+        if not referenced_tables:
+            return None
+
+        table_versions = {}
+        for table_reference in referenced_tables:
+            table = bigquery_client.get_table(table_reference)
+            if table.streaming_buffer is not None or table.modified is None:
+                return None
+            table_versions[table.full_table_id] = table.modified.isoformat()
+        return table_versions
+
+    def _read(self, key: str, table_versions: Dict[str, str]) -> Optional[pd.DataFrame]:
+        """Reads a cached result if it was computed from the same table versions."""
+        data_path, metadata_path = self._get_paths(key)
+        try:
+            with open(metadata_path, "r", encoding="utf-8") as file:
+                metadata = json.load(file)
+            if (
+                metadata.get("version") != CACHE_FORMAT_VERSION
+                or metadata["tables"] != table_versions
+            ):
+                return None
+            dataframe = pq.read_table(data_path, memory_map=True).to_pandas()
+            # The modification time of the data file is the last use of the result
+            os.utime(data_path)
+        except FileNotFoundError:
+            # Evicted by another process
+            return None
+        return dataframe
+
+    def _write(
+        self, key: str, dataframe: pd.DataFrame, table_versions: Dict[str, str]
+    ) -> None:
+        # Written aside then renamed so that other processes never read a partial result
+        data_path, metadata_path = self._get_paths(key)
+        dataframe.to_parquet(data_path + ".tmp", index=False)
+        os.replace(data_path + ".tmp", data_path)
+        with open(metadata_path + ".tmp", "w", encoding="utf-8") as file:
+            json.dump(
+                {
+                    "version": CACHE_FORMAT_VERSION,
+                    "tables": table_versions,
+                    "rows": len(dataframe.index),
+                    "created": datetime.now().isoformat(),
+                },
+                file,
+            )
+        os.replace(metadata_path + ".tmp", metadata_path)
+
+    ### PUBLIC ###
+
+    def get_size(self) -> int:
+        """Gets the disk size of the cached results, in bytes."""
+        return sum(
+            entry.stat().st_size
+            for entry in os.scandir(self.folder)
+            if entry.name.endswith(".parquet")
+        )
+
+    def evict(self) -> int:
+        """Removes the least recently used results until the cache fits in `max_size`.
+        ## Returns
+        The number of removed results.
+        """
+        with self._lock("eviction"):
+            entries = sorted(
+                (
+                    entry.stat().st_mtime,
+                    entry.stat().st_size,
+                    entry.name[: -len(".parquet")],
+                )
+                for entry in os.scandir(self.folder)
+                if entry.name.endswith(".parquet")
+            )
+            size = sum(entry_size for _, entry_size, _ in entries)
+            evicted = 0
+            for _, entry_size, key in entries:
+                if size <= self.max_size:
+                    break
+                data_path, metadata_path = self._get_paths(key)
+                # The metadata first, so that no reader finds metadata without data
+                for path in (metadata_path, data_path):
+                    try:
+                        os.remove(path)
+                    except FileNotFoundError:
+                        pass
+                size -= entry_size
+                evicted += 1
+        self.stats["evictions"] += evicted
+        return evicted
+
+    def select(
+        self,
+        query: str,
+        print_query: bool = True,
+        *,
+        parameters: Optional[Sequence[Tuple[str, BQParameterType, Any]]] = None,
+        dtypes: Optional[Dict[str, Any]] = None,
+    ) -> pd.DataFrame:
+        """Gets the result of a select query from the cache, or runs it and caches it.
+        The queries calling non-deterministic functions, like `CURRENT_DATE()`, are always run.
+        The arguments are the ones of `select`.
+        """
+        table_versions = None
+        # The CALL queries are left to `select`, like the other statements it refuses
+        is_select = query.lstrip().startswith(("SELECT", "WITH"))
+        if is_select and not NON_DETERMINISTIC_FUNCTIONS.search(query):
+            table_versions = self._get_table_versions(query, parameters)
+        if table_versions is None:
+            self.stats["uncacheable"] += 1
+            return select(query, print_query, parameters=parameters, dtypes=dtypes)
+
+        key = get_query_key(query, parameters, dtypes)
+        # The lock files are shared by the keys with the same prefix and never removed, removing
+        # one while another process waits on it would let two processes compute the result
+        with self._lock(f"query_{key[:LOCK_KEY_LENGTH]}"):
+            dataframe = self._read(key, table_versions)
+            if dataframe is not None:
+                self.stats["hits"] += 1
+                print_info(f"Query result {key[:12]} read from the cache.")
+                return dataframe
+
+            self.stats["misses"] += 1
+            dataframe = select(query, print_query, parameters=parameters, dtypes=dtypes)
+            self._write(key, dataframe, table_versions)
+        self.evict()
+        return dataframe
+
+
+_QUERY_CACHES: Dict[str, QueryCache] = {}
+
+
+def get_query_cache(folder: str = QUERY_CACHE_FOLDER) -> QueryCache:
+    """Gets the query cache of a folder, opened once per process."""
+    if folder not in _QUERY_CACHES:
+        _QUERY_CACHES[folder] = QueryCache(folder)
+    return _QUERY_CACHES[folder]
+
+
+def cached_select(
+    query: str,
+    print_query: bool = True,
+    *,
+    parameters: Optional[Sequence[Tuple[str, BQParameterType, Any]]] = None,
+    dtypes: Optional[Dict[str, Any]] = None,
+) -> pd.DataFrame:
+    """Same as `select`, with the result cached on the local disk, see `QueryCache`.
+    Meant for the heavy queries run again by other scripts before their tables change.
+    ## Example
+        >>> cached_select(
+                "SELECT * FROM InvoicesData.Deliveries WHERE carrier = @carrier",
+                parameters=[("carrier", BQParameterType.STRING, "UPS")],
+            )
+    """
+    return get_query_cache().select(
+        query, print_query, parameters=parameters, dtypes=dtypes
+    )
@@ -3,7 +3,22 @@
 import os
 import re
 import time
-from typing import Any, Optional, Tuple, Sequence, Iterator, Union
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta
+from typing import (
+    Any,
+    Deque,
+    Dict,
+    List,
+    NamedTuple,
+    Optional,
+    Tuple,
+    Sequence,
+    Iterator,
+    Union,
+)
 
 from google.cloud.bigquery import (
     Client,
@@ -13,6 +28,7 @@ from google.cloud.bigquery import (
 )
 from google.cloud.bigquery.job import QueryJob
 from pandas import DataFrame
+import pyarrow.parquet as pq
 
 from lox_services.persistence.config import SERVICE_ACCOUNT_PATH
 from lox_services.persistence.database.exceptions import (
@@ -72,35 +88,68 @@ def raw_query(
     bigquery_client = Client()
 
     if parameters:
-        parameters = QueryJobConfig(
-            query_parameters=[
-                (
-                    ArrayQueryParameter(
-                        parameter[0], parameter[1].value, parameter[2]
-                    )  # NOQA
-                    if (
-                        isinstance(parameter[2], Sequence)
-                        and not isinstance(parameter[2], str)
-                    )
-                    else ScalarQueryParameter(
-                        parameter[0], parameter[1].value, parameter[2]
-                    )
-                )
-                for parameter in parameters
-            ]
-        )
+        parameters = build_query_job_config(parameters)
 
     query_job = bigquery_client.query(query, job_config=parameters)
     query_job.result()
     return query_job
 
 
+def estimate_query_bytes(
+    query: str,
+    *,
+    parameters: Optional[Sequence[Tuple[str, BQParameterType, Any]]] = None,
+) -> int:
+    """Estimates the number of bytes a query would process, with a free dry run.
+    ## Arguments
+    - `query`: String representation of the query to be estimated.
+    - `parameters`: List of parameters used to avoid SQL injection
+
+    ## Example
+        >>> estimate_query_bytes("SELECT tracking_number FROM InvoicesData.Deliveries")
+
+    ## Return
+    The number of bytes processed by the query if it were executed.
+    """
+    os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = os.path.join(SERVICE_ACCOUNT_PATH)
+    job_config = build_query_job_config(parameters or [])
+    job_config.dry_run = True
+    job_config.use_query_cache = False
+    return Client().query(query, job_config=job_config).total_bytes_processed
+
+
+def build_query_job_config(
+    parameters: Sequence[Tuple[str, BQParameterType, Any]]
+) -> QueryJobConfig:
+    """Builds the job configuration of a parameterized query.
+    Sequences (except strings) are sent as array parameters, other values as scalar parameters.
+    """
+    return QueryJobConfig(
+        query_parameters=[
+            (
+                ArrayQueryParameter(
+                    parameter[0], parameter[1].value, parameter[2]
+                )  # NOQA
+                if (
+                    isinstance(parameter[2], Sequence)
+                    and not isinstance(parameter[2], str)
+                )
+                else ScalarQueryParameter(
+                    parameter[0], parameter[1].value, parameter[2]
+                )
+            )
+            for parameter in parameters
+        ]
+    )
+
+
 def select(
     query: str,
     print_query: bool = True,
     *,
     parameters: Optional[Sequence[Tuple[str, BQParameterType, Any]]] = None,
     as_iterator: bool = False,
+    dtypes: Optional[Dict[str, Any]] = None,
 ) -> Union[DataFrame, Iterator]:
     """Checks if the query begings with a SELECT statement. If so the query is being executed.
     ## Arguments
@@ -109,6 +158,8 @@ def select(
     - `parameters`: List of parameters used to avoid SQL injection
     = 'as_iterator': In case results just need to be iterated over, as opposed to requiring
     vectorized operations, this returns a lazily evaluated iterator of query results.
+    - `dtypes`: The pandas dtypes of the result columns, like the `dtypes` of `TableSchema`,
+    instead of the default ones. Columns that are not in the result are ignored.
 
     ## Example
         >>> select("SELECT * FROM InvoicesData.Refunds where carrier='UPS' LIMIT 10")
@@ -127,29 +178,191 @@ def select(
     result = raw_query(query, print_query=print_query, parameters=parameters).result()
     if as_iterator:
         return result
-    return result.to_dataframe()
+    if dtypes:
+        result_columns = {field.name for field in result.schema}
+        dtypes = {
+            name: dtype for name, dtype in dtypes.items() if name in result_columns
+        }
+    return result.to_dataframe(dtypes=dtypes)
 
 
-def update(
+def open_parquet_extract(path: str) -> pq.ParquetDataset:
+    """Opens an extract written by `select_to_parquet`, without reading it.
+    The file is memory-mapped, so its pages are only loaded when they are read.
+    ## Example
+        >>> extract = open_parquet_extract("/tmp/deliveries.parquet")
+        >>> extract.read(columns=["tracking_number"]).to_pandas()
+    """
+    return pq.ParquetDataset(path, memory_map=True)
+
+
+def select_to_parquet(
     query: str,
+    path: str,
     print_query: bool = True,
     *,
     parameters: Optional[Sequence[Tuple[str, BQParameterType, Any]]] = None,
-) -> int:
-    """Checks if the query begings with a UPDATE statement. If so the query is being executed.
+    rows_per_group: int = 100_000,
+) -> pq.ParquetDataset:
+    """Executes a select query and writes its result to a Parquet file, one page at a time,
+    so that the whole result is never held in memory.
     ## Arguments
     - `query`: String representation of the query to be executed.
+    - `path`: The Parquet file to write, replaced once it is complete.
     - `print_query`: Tells whether to print the query before executing it.
     - `parameters`: List of parameters used to avoid SQL injection
+    - `rows_per_group`: The number of rows downloaded per page, written as one row group.
 
     ## Example
-        >>> update("UPDATE InvoicesData.Refunds SET state='Test' WHERE company='Test'")
-        >>> update("UPDATE InvoicesData.Refunds SET state='Test' where company=@company", parameters = [("company", BQParameterType.STRING, "Test")])
-
+        >>> extract = select_to_parquet("SELECT * FROM InvoicesData.Deliveries", "/tmp/deliveries.parquet")
+        >>> extract.read(filters=[("carrier", "=", "UPS")]).to_pandas()
 
     ## Return
-    The result of the update query is a number of affected rows.
+    The extract, see `open_parquet_extract`.
+    """
+    if not (query.lstrip().startswith("SELECT") or query.lstrip().startswith("WITH")):
+        raise BadQueryTypeException("SELECT or WITH")
+
+    query_job = raw_query(query, print_query=print_query, parameters=parameters)
+    # Written aside then renamed so that other processes never open a partial extract
+    temporary_path = path + ".tmp"
+    writer = None
+    try:
+        for record_batch in query_job.result(
+            page_size=rows_per_group
+        ).to_arrow_iterable():
+            if writer is None:
+                writer = pq.ParquetWriter(temporary_path, record_batch.schema)
+            writer.write_batch(record_batch, row_group_size=rows_per_group)
+        if writer is None:
+            # No rows, the empty result still gives the schema
+            pq.write_table(query_job.result().to_arrow(), temporary_path)
+    finally:
+        if writer is not None:
+            writer.close()
+    os.replace(temporary_path, path)
+    return open_parquet_extract(path)
+
+
+class WindowResult(NamedTuple):
+    """Result of one window of `select_windowed`.
+    - `start`: The first day of the window.
+    - `end`: The day after the last day of the window.
+    - `dataframe`: The result of the query on the window.
     """
+
+    start: date
+    end: date
+    dataframe: DataFrame
+
+
+def _select_window(
+    query_template: str,
+    parameters: List[Tuple[str, BQParameterType, Any]],
+    retries: int,
+    print_query: bool,
+    dtypes: Optional[Dict[str, Any]],
+) -> DataFrame:
+    """Selects the result of one window, retrying it alone when it fails."""
+    attempt = 0
+    while True:
+        try:
+            return select(
+                query_template, print_query, parameters=parameters, dtypes=dtypes
+            )
+        except Exception as error:
+            attempt += 1
+            if attempt > retries:
+                raise error
+            print(
+                f"Window {parameters[0][2]} to {parameters[1][2]} failed ({error}), "
+                f"retry {attempt}/{retries}"
+            )
+            time.sleep(5 * attempt)
+
+
+def select_windowed(
+    query_template: str,
+    start: str,
+    end: str,
+    windows: int,
+    max_parallel: int = 4,
+    print_query: bool = False,
+    *,
+    parameters: Optional[Sequence[Tuple[str, BQParameterType, Any]]] = None,
+    dtypes: Optional[Dict[str, Any]] = None,
+    retries: int = 2,
+) -> Iterator[WindowResult]:
+    """Splits a select query on a date range into windows, see `split_date_range`, and runs
+    them concurrently. The results are yielded in the order of the windows, and no more than
+    `max_parallel` of them are computed ahead of the one being consumed.
+    ## Arguments
+    - `query_template`: The select query, filtering its dates with the `@window_start` and
+    `@window_end` DATE parameters, as `date >= @window_start AND date < @window_end`.
+    - `start`: The first day of the range, in the format %Y-%m-%d.
+    - `end`: The last day of the range, in the format %Y-%m-%d, included in the last window.
+    - `windows`: The number of windows, windows shorter than a day are merged.
+    - `max_parallel`: The maximum number of windows queried at the same time.
+    - `print_query`: Tells whether to print the query of every window before executing it.
+    - `parameters`: The other parameters of the query.
+    - `dtypes`: The pandas dtypes of the result columns, see `select`.
+    - `retries`: The number of times a failed window is run again before raising.
+
+    ## Example
+        >>> for window in select_windowed(
+                "SELECT * FROM InvoicesData.Deliveries WHERE DATE(date_time) >= @window_start AND DATE(date_time) < @window_end",
+                "2023-01-01", "2023-12-31", windows=12,
+            ):
+        >>>     process(window.dataframe)
+    """
+    last_day = datetime.strptime(end, "%Y-%m-%d") + timedelta(days=1)
+    bounds = sorted(
+        {
+            datetime.strptime(bound, "%Y-%m-%d").date()
+            for bound in gpy.split_date_range(
+                start, last_day.strftime("%Y-%m-%d"), windows
+            )
+        }
+    )
+    window_bounds = list(zip(bounds[:-1], bounds[1:]))
+
+    with ThreadPoolExecutor(max_workers=max_parallel) as executor:
+        pending: Deque[Tuple[date, date, Future]] = deque()
+        next_window = 0
+        try:
+            while pending or next_window < len(window_bounds):
+                while len(pending) < max_parallel and next_window < len(window_bounds):
+                    window_start, window_end = window_bounds[next_window]
+                    window_parameters = [
+                        ("window_start", BQParameterType.DATE, window_start),
+                        ("window_end", BQParameterType.DATE, window_end),
+                        *(parameters or []),
+                    ]
+                    pending.append(
+                        (
+                            window_start,
+                            window_end,
+                            executor.submit(
+                                _select_window,
+                                query_template,
+                                window_parameters,
+                                retries,
+                                print_query,
+                                dtypes,
+                            ),
+                        )
+                    )
+                    next_window += 1
+                window_start, window_end, future = pending.popleft()
+                yield WindowResult(window_start, window_end, future.result())
+        finally:
+            # The windows not started yet are dropped if the consumer stops early
+            for _, _, future in pending:
+                future.cancel()
+
+
+def _check_update_query(query: str) -> None:
+    """Checks that the query is an UPDATE statement that sets the `update_datetime`."""
     if not query.lstrip().startswith("UPDATE"):
         raise BadQueryTypeException("UPDATE")
 
@@ -160,15 +373,18 @@ def update(
     ):
         raise MissingUpdateDatetimeException(query)
 
+
+def _raw_query_with_retries(
+    query: str,
+    *,
+    print_query: bool,
+    parameters: Optional[Sequence[Tuple[str, BQParameterType, Any]]],
+) -> QueryJob:
+    """Executes a DML query, retrying it when it fails because of a concurrent update."""
     count = 0
-    query_success = False
-    result_returned = None
-    while not query_success:
+    while True:
         try:
-            result = raw_query(query, print_query=print_query, parameters=parameters)
-            print("Rows affected:", result.num_dml_affected_rows)
-            result_returned = result.num_dml_affected_rows
-            query_success = True
+            return raw_query(query, print_query=print_query, parameters=parameters)
         except Exception as error:
             error_msg = error.__dict__["_errors"][0]["message"]
             if "concurrent update" in error_msg:
@@ -179,8 +395,36 @@ def update(
                     raise error
             else:
                 raise error
-    if result_returned is not None:
-        return result_returned
+
+
+def update(
+    query: str,
+    print_query: bool = True,
+    *,
+    parameters: Optional[Sequence[Tuple[str, BQParameterType, Any]]] = None,
+) -> int:
+    """Checks if the query begings with a UPDATE statement. If so the query is being executed.
+    ## Arguments
+    - `query`: String representation of the query to be executed.
+    - `print_query`: Tells whether to print the query before executing it.
+    - `parameters`: List of parameters used to avoid SQL injection
+
+    ## Example
+        >>> update("UPDATE InvoicesData.Refunds SET state='Test' WHERE company='Test'")
+        >>> update("UPDATE InvoicesData.Refunds SET state='Test' where company=@company", parameters = [("company", BQParameterType.STRING, "Test")])
+
+
+    ## Return
+    The result of the update query is a number of affected rows.
+    """
+    _check_update_query(query)
+
+    result = _raw_query_with_retries(
+        query, print_query=print_query, parameters=parameters
+    )
+    print("Rows affected:", result.num_dml_affected_rows)
+    if result.num_dml_affected_rows is not None:
+        return result.num_dml_affected_rows
     else:
         raise Exception("Error processing update: ", query)
 
@@ -190,7 +434,7 @@ def delete(
     print_query: bool = True,
     *,
     parameters: Optional[Sequence[Tuple[str, BQParameterType, Any]]] = None,
-) -> None:
+) -> int:
     """Checks if the query begings with a DELETE statement. If so the query is being executed.
 
     ## Arguments
@@ -212,3 +456,111 @@ def delete(
 
     result = raw_query(query, print_query=print_query, parameters=parameters)
     print("Rows deleted:", result.num_dml_affected_rows)
+    return result.num_dml_affected_rows
+
+
+class DMLBatch:
+    """Statements collected by `dml_batch`, executed together in one transaction.
+    The statements are checked when they are added, like with `update` and `delete`.
+    """
+
+    def __init__(self, print_query: bool = True):
+        self.print_query = print_query
+        self.statements: List[
+            Tuple[str, Sequence[Tuple[str, BQParameterType, Any]]]
+        ] = []
+        self.results: Optional[List[int]] = None
+
+    def update(
+        self,
+        query: str,
+        *,
+        parameters: Optional[Sequence[Tuple[str, BQParameterType, Any]]] = None,
+    ) -> None:
+        """Adds an UPDATE statement to the batch, it must set the `update_datetime`."""
+        _check_update_query(query)
+        self.statements.append((query, parameters or []))
+
+    def delete(
+        self,
+        query: str,
+        *,
+        parameters: Optional[Sequence[Tuple[str, BQParameterType, Any]]] = None,
+    ) -> None:
+        """Adds a DELETE statement to the batch."""
+        if not query.lstrip().startswith("DELETE"):
+            raise BadQueryTypeException("DELETE")
+        self.statements.append((query, parameters or []))
+
+    def build_script(self) -> Tuple[str, list]:
+        """Builds the transaction script of the statements and its parameters.
+        The parameters of every statement are prefixed with its position so that they can't collide.
+        """
+        statements, script_parameters = [], []
+        for position, (query, parameters) in enumerate(self.statements):
+            for name, parameter_type, value in parameters:
+                prefixed_name = f"statement_{position}_{name}"
+                query = re.sub(rf"@{name}\b", f"@{prefixed_name}", query)
+                script_parameters.append((prefixed_name, parameter_type, value))
+            statements.append(query.strip().rstrip(";") + ";")
+
+        script = "\n".join(
+            [
+                "BEGIN",
+                "BEGIN TRANSACTION;",
+                *statements,
+                "COMMIT TRANSACTION;",
+                "EXCEPTION WHEN ERROR THEN",
+                "ROLLBACK TRANSACTION;",
+                "RAISE USING MESSAGE = @@error.message;",
+                "END;",
+            ]
+        )
+        return script, script_parameters
+
+    def execute(self) -> List[int]:
+        """Executes the statements in one transaction, they are all applied or none of them is.
+        ## Returns
+        The number of affected rows of every statement, in order.
+        """
+        if not self.statements:
+            self.results = []
+            return self.results
+
+        script, parameters = self.build_script()
+        script_job = _raw_query_with_retries(
+            script, print_query=self.print_query, parameters=parameters
+        )
+        child_jobs = sorted(
+            Client().list_jobs(parent_job=script_job.job_id),
+            key=lambda job: job.created,
+        )
+        self.results = [
+            job.num_dml_affected_rows
+            for job in child_jobs
+            if job.statement_type in ("UPDATE", "DELETE")
+        ]
+        print("Rows affected:", self.results)
+        return self.results
+
+
+@contextmanager
+def dml_batch(print_query: bool = True) -> Iterator[DMLBatch]:
+    """Collects UPDATE and DELETE statements and executes them in a single transaction script
+    when the block exits. Nothing is executed if the block raises.
+    ## Arguments
+    - `print_query`: Tells whether to print the script before executing it.
+
+    ## Example
+        >>> with dml_batch() as batch:
+        >>>     batch.update(
+                    "UPDATE InvoicesData.Refunds SET state = 'Credited', update_datetime = CURRENT_DATETIME() WHERE tracking_number = @tracking_number",
+                    parameters=[("tracking_number", BQParameterType.STRING, "1Z1")],
+                )
+        >>>     batch.delete("DELETE FROM InvoicesData.ClaimHistory WHERE tracking_number = '1Z1'")
+        >>> batch.results
+        # [1, 3]
+    """
+    batch = DMLBatch(print_query)
+    yield batch
+    batch.execute()
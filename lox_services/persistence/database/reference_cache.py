@@ -0,0 +1,262 @@
+"""Local cache of the small reference tables, like the mappings and the currency conversions.
+
+Each table is kept in memory and in a Parquet file on the local disk, so that a new process
+starts with the copy of the previous one. The copy is refreshed when the `modified` time of
+the table changes, which costs a metadata request instead of a query, or while the table has
+rows in its streaming buffer, as the streamed rows don't reliably update its `modified` time.
+The refreshes of an outdated copy run in the background while the current copy keeps being used.
+"""
+
+import fcntl
+import json
+import os
+import tempfile
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from enum import Enum
+from time import monotonic
+from typing import Any, Dict, Iterator, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+from google.cloud.bigquery import Client
+
+from lox_services.config.paths import DATABASE_CACHE_FOLDER
+from lox_services.persistence.config import SERVICE_ACCOUNT_PATH
+from lox_services.persistence.database.datasets import (
+    Mapping_dataset,
+    UserData_dataset,
+    Utils_dataset,
+    get_dataset_name,
+)
+from lox_services.persistence.database.query_handlers import select
+from lox_services.utils.general_python import print_info
+
+REFERENCE_CACHE_FOLDER = os.path.join(DATABASE_CACHE_FOLDER, "reference_tables")
+
+# The tables small and stable enough to be cached entirely
+REFERENCE_TABLES = (
+    Mapping_dataset.ClaimStatuses,
+    Mapping_dataset.StatusMapping,
+    Utils_dataset.CurrencyConversion,
+    UserData_dataset.NestedAccountNumbers,
+)
+
+# Delay after which the copy is checked against the `modified` time of the table
+REFRESH_INTERVAL = timedelta(minutes=10)
+
+CACHE_FORMAT_VERSION = 1
+
+
+class ReferenceTable:
+    """Cached copy of a reference table, with indexed lookups.
+    ## Arguments
+    - `table`: The table, one of `REFERENCE_TABLES`.
+    - `folder`: The folder where the copies are stored.
+    - `refresh_interval`: Delay after which the copy is checked in the background.
+
+    ## Example
+        >>> claim_statuses = ReferenceTable(Mapping_dataset.ClaimStatuses)
+        >>> claim_statuses.lookup(carrier="UPS", status="Credited")
+    """
+
+    def __init__(
+        self,
+        table: Enum,
+        *,
+        folder: str = REFERENCE_CACHE_FOLDER,
+        refresh_interval: timedelta = REFRESH_INTERVAL,
+    ):
+        if table not in REFERENCE_TABLES:
+            raise ValueError(f"Table {table.name} is not a reference table.")
+        self.table = table
+        self.full_table_name = f"{get_dataset_name(table)}.{table.name}"
+        self.refresh_interval = refresh_interval
+        os.makedirs(folder, exist_ok=True)
+        self.data_path = os.path.join(folder, f"{self.full_table_name}.parquet")
+        self.metadata_path = os.path.join(folder, f"{self.full_table_name}.json")
+        self.lock_path = os.path.join(folder, f"{self.full_table_name}.lock")
+
+        self.modified: Optional[datetime] = None
+        self.dataframe: Optional[pd.DataFrame] = None
+        self.stats = {"checks": 0, "refreshes": 0, "lookups": 0}
+        self._checked_at: Optional[float] = None
+        self._indexes: Dict[Tuple[str, ...], Dict[Any, np.ndarray]] = {}
+        self._lock = threading.Lock()
+        self._refresh_thread: Optional[threading.Thread] = None
+        self._load()
+
+    ### PRIVATE ###
+
+    @contextmanager
+    def _locked(self) -> Iterator[None]:
+        """Holds the lock of the copy files, shared with the other processes."""
+        with open(self.lock_path, "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _write_aside(self, path: str) -> str:
+        """Creates a temporary file next to a copy file, unique to this writer."""
+        file_descriptor, temporary_path = tempfile.mkstemp(
+            dir=os.path.dirname(path), prefix=os.path.basename(path), suffix=".tmp"
+        )
+        os.close(file_descriptor)
+        return temporary_path
+
+    def _load(self) -> None:
+        with self._locked():
+            self._load_locked()
+
+    def _load_locked(self) -> None:
+        if not (os.path.exists(self.metadata_path) and os.path.exists(self.data_path)):
+            return
+        with open(self.metadata_path, "r", encoding="utf-8") as file:
+            metadata = json.load(file)
+        if metadata.get("version") != CACHE_FORMAT_VERSION:
+            return
+        self.modified = datetime.fromisoformat(metadata["modified"])
+        self.dataframe = pd.read_parquet(self.data_path)
+
+    def _save(self) -> None:
+        # Written aside then renamed so that other processes never read a partial copy,
+        # and both files renamed under the lock so that they always come from the same refresh
+        temporary_data_path = self._write_aside(self.data_path)
+        temporary_metadata_path = self._write_aside(self.metadata_path)
+        try:
+            self.dataframe.to_parquet(temporary_data_path, index=False)
+            with open(temporary_metadata_path, "w", encoding="utf-8") as file:
+                json.dump(
+                    {
+                        "version": CACHE_FORMAT_VERSION,
+                        "modified": self.modified.isoformat(),
+                        "rows": len(self.dataframe.index),
+                    },
+                    file,
+                )
+            with self._locked():
+                os.replace(temporary_data_path, self.data_path)
+                os.replace(temporary_metadata_path, self.metadata_path)
+        finally:
+            for path in (temporary_data_path, temporary_metadata_path):
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def _get_index(
+        self, columns: Tuple[str, ...]
+    ) -> Tuple[pd.DataFrame, Dict[Any, np.ndarray]]:
+        """Gets the copy and the positions of its rows by value of the columns.
+        The index is built once per copy, both are taken together as a refresh replaces them.
+        """
+        self.get_dataframe()
+        with self._lock:
+            if columns not in self._indexes:
+                self._indexes[columns] = self.dataframe.groupby(
+                    list(columns) if len(columns) > 1 else columns[0], sort=False
+                ).indices
+            return self.dataframe, self._indexes[columns]
+
+    ### PUBLIC ###
+
+    def refresh(self, force: bool = False) -> bool:
+        """Downloads the table if it was modified since the copy was made, or if rows were
+        streamed into it recently.
+        ## Arguments
+        - `force`: Downloads the table even if it was not modified.
+
+        ## Returns
+        Whether the table was downloaded.
+        """
+        os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = SERVICE_ACCOUNT_PATH
+        table = Client().get_table(self.full_table_name)
+        modified = table.modified
+        self.stats["checks"] += 1
+        self._checked_at = monotonic()
+        if (
+            not force
+            and self.dataframe is not None
+            and modified == self.modified
+            and table.streaming_buffer is None
+        ):
+            return False
+
+        dataframe = select(f"SELECT * FROM {self.full_table_name}", print_query=False)
+        with self._lock:
+            self.dataframe, self.modified = dataframe, modified
+            self._indexes = {}
+            self._save()
+        self.stats["refreshes"] += 1
+        print_info(
+            f"Reference table {self.full_table_name} refreshed ({len(dataframe.index)} rows)."
+        )
+        return True
+
+    def refresh_in_background(self) -> threading.Thread:
+        """Starts a refresh in a background thread, unless one is already running."""
+        with self._lock:
+            if self._refresh_thread is None or not self._refresh_thread.is_alive():
+                self._refresh_thread = threading.Thread(
+                    target=self.refresh, name=f"refresh_{self.table.name}", daemon=True
+                )
+                self._refresh_thread.start()
+            return self._refresh_thread
+
+    def get_dataframe(self) -> pd.DataFrame:
+        """Gets the copy of the table. It is downloaded if there is none yet, and refreshed
+        in the background if it wasn't checked for `refresh_interval`.
+        """
+        if self.dataframe is None:
+            self.refresh()
+        elif (
+            self._checked_at is None
+            or monotonic() - self._checked_at > self.refresh_interval.total_seconds()
+        ):
+            self.refresh_in_background()
+        return self.dataframe
+
+    def _find_positions(
+        self, values: Dict[str, Any]
+    ) -> Tuple[pd.DataFrame, Optional[np.ndarray]]:
+        """Gets the copy and the positions of the rows whose columns have the given values."""
+        if not values:
+            raise ValueError("At least one column value is needed.")
+        dataframe, index = self._get_index(tuple(values))
+        key = tuple(values.values()) if len(values) > 1 else next(iter(values.values()))
+        self.stats["lookups"] += 1
+        return dataframe, index.get(key)
+
+    def lookup(self, **values: Any) -> pd.DataFrame:
+        """Gets the rows whose columns have the given values, with an index of the copy.
+        ## Example
+            >>> nested_accounts.lookup(company="Lox", carrier="UPS")
+
+        ## Returns
+        The matching rows, an empty dataframe if there are none.
+        """
+        dataframe, positions = self._find_positions(values)
+        return dataframe.iloc[positions if positions is not None else []]
+
+    def lookup_value(self, column: str, default: Any = None, **values: Any) -> Any:
+        """Gets the value of a column in the first row matching the values, see `lookup`.
+        ## Example
+            >>> currency_conversion.lookup_value(
+                    "rate", date=date(2024, 1, 2), currency_code_from="USD", currency_code_to="EUR"
+                )
+        """
+        dataframe, positions = self._find_positions(values)
+        if positions is None:
+            return default
+        return dataframe[column].iat[positions[0]]
+
+
+_REFERENCE_TABLES: Dict[Enum, ReferenceTable] = {}
+
+
+def get_reference_table(table: Enum) -> ReferenceTable:
+    """Gets the cached copy of a reference table, opened once per process."""
+    if table not in _REFERENCE_TABLES:
+        _REFERENCE_TABLES[table] = ReferenceTable(table)
+    return _REFERENCE_TABLES[table]
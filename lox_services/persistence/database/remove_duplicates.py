@@ -1,8 +1,18 @@
-from typing import Any, List
+from concurrent.futures import ThreadPoolExecutor
+from enum import Enum
+from functools import wraps
+from typing import Any, Callable, List
 import numpy as np
 import pandas as pd
 
+from lox_services.persistence.database.datasets import (
+    CarrierData_dataset,
+    InvoicesData_dataset,
+)
+from lox_services.persistence.database.key_index import get_key_index
+from lox_services.persistence.database.partitioning import build_partition_filter
 from lox_services.persistence.database.query_handlers import select
+from lox_services.persistence.database.utils import fingerprint_series
 from lox_services.utils.enums import BQParameterType
 from lox_services.utils.general_python import print_error, print_success
 
@@ -11,11 +21,75 @@ CHUNK_SIZE = (
     50000  # max length of a list that can be passed in argument in a sql request
 )
 
+# Column holding the original row order of a dataframe loaded into a temporary table
+ROW_POSITION_COLUMN = "_row_position"
+
+SMART_REASON_REFUND_SQL = """CASE
+            WHEN {alias}.reason_refund IN ("Lost", "Damaged", "Delivery Dispute")
+                THEN 'Lost or Damaged'
+                ELSE {alias}.reason_refund
+            END"""
+
+
+TENANT_COLUMNS = ["company", "carrier"]
+
+# Maximum number of tenants checked at the same time
+MAX_TENANT_WORKERS = 8
+
+
+def split_by_tenant(function: Callable[..., pd.DataFrame]):
+    """Runs a duplicate check once per (company, carrier) group of the dataframe.
+    The groups are checked concurrently, and the rows kept are returned in their original order.
+    This lets dataframes mixing several companies or carriers be checked in a single push.
+    """
+
+    @wraps(function)
+    def wrapper(dataframe: pd.DataFrame, *args, **kwargs) -> pd.DataFrame:
+        if dataframe.empty or len(dataframe[TENANT_COLUMNS].drop_duplicates()) == 1:
+            return function(dataframe, *args, **kwargs)
+
+        groups = [
+            group.copy()
+            for _, group in dataframe.groupby(TENANT_COLUMNS, sort=False, dropna=False)
+        ]
+        print(f"Checking duplicates of {len(groups)} (company, carrier) groups...")
+        with ThreadPoolExecutor(
+            max_workers=min(MAX_TENANT_WORKERS, len(groups))
+        ) as executor:
+            results = list(
+                executor.map(lambda group: function(group, *args, **kwargs), groups)
+            )
+
+        result = pd.concat(results)
+        if dataframe.index.is_unique:
+            result = result.loc[dataframe.index[dataframe.index.isin(result.index)]]
+        return result
 
-def remove_duplicate_invoices(dataframe: pd.DataFrame) -> pd.DataFrame:
+    return wrapper
+
+
+def remove_duplicate_headers_dataframe(dataframe: pd.DataFrame) -> pd.DataFrame:
+    """Removes rows that are similar to the header and are not in the first line of the given dataframe
+    ## Arguments
+    - `dataframe`: dataframe that needs to be checked.
+
+    ## Example
+        >>> remove_duplicate_headers_dataframe(refunds_df)
+
+    ## Returns
+    The dataframe cleaned from potential header duplicates
+    """
+    return dataframe.loc[~(dataframe == dataframe.columns).all(axis="columns")]
+
+
+@split_by_tenant
+def remove_duplicate_invoices(
+    dataframe: pd.DataFrame, use_key_index: bool = False
+) -> pd.DataFrame:
     """Removes invoices that have already been saved in the database.
     ## Arguments
     - `dataframe`: The dataframe containing the invoice numbers to check.
+    - `use_key_index`: Looks the invoice numbers up in the local key index instead of the database.
 
     ## Example
         >>> remove_duplicate_invoices(df)
@@ -27,20 +101,43 @@ def remove_duplicate_invoices(dataframe: pd.DataFrame) -> pd.DataFrame:
     dataframe["invoice_number"] = dataframe["invoice_number"].astype(str)
     company = dataframe.iloc[0]["company"]
     carrier = dataframe.iloc[0]["carrier"]
-    query = f"""
-        SELECT DISTINCT invoice_number
-
-        FROM InvoicesData.Invoices
-
-        WHERE carrier = "{carrier}"
-            AND company = "{company}"
-            AND invoice_number IN UNNEST({dataframe['invoice_number'].unique().tolist()})
-    """
-    already_pushed = select(query)
-    # Remove invoice numbers that were already pushed to BQ
-    dataframe = dataframe[
-        ~(dataframe["invoice_number"]).isin(already_pushed["invoice_number"])
-    ]
+    if use_key_index:
+        key_index = get_key_index(InvoicesData_dataset.Invoices, company, carrier)
+        key_index.sync()
+        dataframe = dataframe[
+            ~key_index.contains(dataframe["invoice_number"], dataframe)
+        ]
+    else:
+        partition_filter, partition_parameters = build_partition_filter(
+            InvoicesData_dataset.Invoices, dataframe
+        )
+        query = f"""
+            SELECT DISTINCT invoice_number
+
+            FROM InvoicesData.Invoices
+
+            WHERE carrier = @carrier
+                AND company = @company
+                AND invoice_number IN UNNEST(@invoice_numbers)
+                {partition_filter}
+        """
+        already_pushed = select(
+            query,
+            parameters=[
+                ("carrier", BQParameterType.STRING, carrier),
+                ("company", BQParameterType.STRING, company),
+                (
+                    "invoice_numbers",
+                    BQParameterType.STRING,
+                    dataframe["invoice_number"].unique().tolist(),
+                ),
+            ]
+            + partition_parameters,
+        )
+        # Remove invoice numbers that were already pushed to BQ
+        dataframe = dataframe[
+            ~(dataframe["invoice_number"]).isin(already_pushed["invoice_number"])
+        ]
 
     print(
         f"{original_size - len(dataframe.index)} invoice rows deleted before saving to the database."
@@ -49,11 +146,15 @@ def remove_duplicate_invoices(dataframe: pd.DataFrame) -> pd.DataFrame:
     return dataframe
 
 
-def remove_duplicate_refunds(dataframe: pd.DataFrame) -> pd.DataFrame:
+@split_by_tenant
+def remove_duplicate_refunds(
+    dataframe: pd.DataFrame, use_key_index: bool = False
+) -> pd.DataFrame:
     """Removes rows for which the package has already a refund for the same reason, or one related (Lost & Damaged).
     Removes duplicates in the dataframe as well.
     ## Arguments
     - `dataframe`: refunds dataframe that needs to be checked.
+    - `use_key_index`: Looks the refunds up in the local key index instead of the database.
 
     ## Example
         >>> remove_duplicate_refunds(refunds_df)
@@ -80,30 +181,47 @@ def remove_duplicate_refunds(dataframe: pd.DataFrame) -> pd.DataFrame:
 
     dataframe["tracking_number"] = dataframe.tracking_number.astype(str)
     tracking_numbers = dataframe["tracking_number"].tolist()
-    query = f"""
-    SELECT DISTINCT
-        tracking_number || CASE
-            WHEN reason_refund IN ("Lost", "Damaged", "Delivery Dispute")
-                THEN 'Lost or Damaged'
-                ELSE reason_refund
-            END
-        AS existing_combo
-
-    FROM InvoicesData.Refunds
-
-    WHERE company = "{company}"
-        AND carrier = "{carrier}"
-        AND tracking_number IN UNNEST({tracking_numbers})
-        AND reason_refund IN UNNEST({reason_refunds})
-    """
-    print(query)
-    existing_data_dataframe = select(query)
     # Lost or damaged trick
     dataframe["smart_reason_refund"] = np.where(
         dataframe["reason_refund"].isin({"Lost", "Damaged", "Delivery Dispute"}),
         "Lost or Damaged",
         dataframe["reason_refund"],
     )
+    if use_key_index:
+        key_index = get_key_index(InvoicesData_dataset.Refunds, company, carrier)
+        key_index.sync()
+        already_saved = key_index.contains(
+            dataframe["tracking_number"] + dataframe["smart_reason_refund"], dataframe
+        )
+    else:
+        query = """
+        SELECT DISTINCT
+            tracking_number || CASE
+                WHEN reason_refund IN ("Lost", "Damaged", "Delivery Dispute")
+                    THEN 'Lost or Damaged'
+                    ELSE reason_refund
+                END
+            AS existing_combo
+
+        FROM InvoicesData.Refunds
+
+        WHERE company = @company
+            AND carrier = @carrier
+            AND tracking_number IN UNNEST(@tracking_numbers)
+            AND reason_refund IN UNNEST(@reason_refunds)
+        """
+        existing_data_dataframe = select(
+            query,
+            parameters=[
+                ("company", BQParameterType.STRING, company),
+                ("carrier", BQParameterType.STRING, carrier),
+                ("tracking_numbers", BQParameterType.STRING, tracking_numbers),
+                ("reason_refunds", BQParameterType.STRING, reason_refunds),
+            ],
+        )
+        already_saved = (
+            dataframe["tracking_number"] + dataframe["smart_reason_refund"]
+        ).isin(existing_data_dataframe["existing_combo"])
     # Duplicate check
     allow_duplicates = carrier == "UPS" and "claim_number" in dataframe.columns
     if not allow_duplicates:
@@ -111,11 +229,7 @@ def remove_duplicate_refunds(dataframe: pd.DataFrame) -> pd.DataFrame:
             subset=["tracking_number", "smart_reason_refund"], keep=False
         )
         # Remove rows where the tracking number and reason refund is already present in the database
-        dataframe = dataframe[
-            ~(dataframe["tracking_number"] + dataframe["smart_reason_refund"]).isin(
-                existing_data_dataframe["existing_combo"]
-            )
-        ]
+        dataframe = dataframe[~already_saved.loc[dataframe.index]]
         dataframe.drop(columns=["smart_reason_refund"], inplace=True)
 
     else:
@@ -127,7 +241,9 @@ def remove_duplicate_refunds(dataframe: pd.DataFrame) -> pd.DataFrame:
     return dataframe
 
 
-def remove_duplicate_deliveries(dataframe: pd.DataFrame) -> pd.DataFrame:
+def remove_duplicate_deliveries(
+    dataframe: pd.DataFrame, use_key_index: bool = False
+) -> pd.DataFrame:
     """
     Removes duplicate rows from the provided DataFrame based on certain criteria.
 
@@ -138,6 +254,7 @@ def remove_duplicate_deliveries(dataframe: pd.DataFrame) -> pd.DataFrame:
 
     Args:
         dataframe (pd.DataFrame): The input DataFrame containing delivery data.
+        use_key_index (bool): Looks the deliveries up in the local key index instead of the database.
 
     Returns:
         pd.DataFrame: A DataFrame with duplicate deliveries removed, if any.
@@ -159,43 +276,60 @@ def remove_duplicate_deliveries(dataframe: pd.DataFrame) -> pd.DataFrame:
         + dataframe["formated_datetime"].astype(str)
     )
 
+    if use_key_index:
+        key_index = get_key_index(InvoicesData_dataset.Deliveries)
+        key_index.sync()
+        original_length = len(dataframe.index)
+        dataframe = dataframe.loc[
+            ~key_index.contains(dataframe["concat_values"], dataframe)
+        ]
+        print("Number of rows removed:", original_length - len(dataframe.index))
+        return dataframe.drop(columns=["concat_values", "formated_datetime"])
+
     tracking_numbers_to_check = dataframe["tracking_number"].unique().tolist()
 
-    sql_query = """
+    # Only the fingerprints of the keys are downloaded and compared
+    partition_filter, partition_parameters = build_partition_filter(
+        InvoicesData_dataset.Deliveries, dataframe
+    )
+    sql_query = f"""
         SELECT
-            tracking_number || status || date_time as concat_values
+            FARM_FINGERPRINT(
+                tracking_number || status || FORMAT_DATETIME('%Y-%m-%d %H:%M:%S', date_time)
+            ) AS fingerprint
         FROM
             InvoicesData.Deliveries
         WHERE
         tracking_number IN UNNEST(@tracking_numbers)
+        {partition_filter}
     """
 
     tn_lists = [
         tracking_numbers_to_check[i : i + CHUNK_SIZE]
         for i in range(0, len(tracking_numbers_to_check), CHUNK_SIZE)
     ]
-    deliveries_already_in_db = pd.DataFrame(columns=["concat_values"])
-    for tn_list in tn_lists:
-        deliveries_already_in_db = pd.concat(
-            [
-                deliveries_already_in_db,
-                select(
-                    sql_query,
-                    print_query=False,
-                    parameters=[
-                        (
-                            "tracking_numbers",
-                            BQParameterType.STRING,
-                            tn_list,
-                        )
-                    ],
-                ),
+    fingerprints_in_db = [
+        select(
+            sql_query,
+            print_query=False,
+            parameters=[
+                (
+                    "tracking_numbers",
+                    BQParameterType.STRING,
+                    tn_list,
+                )
             ]
-        )
+            + partition_parameters,
+        )["fingerprint"].to_numpy(dtype=np.int64)
+        for tn_list in tn_lists
+    ]
     original_length = len(dataframe.index)
-    if not deliveries_already_in_db.empty:
-        duplicate_values = deliveries_already_in_db["concat_values"].unique().tolist()
-        dataframe = dataframe.loc[~dataframe["concat_values"].isin(duplicate_values)]
+    if fingerprints_in_db:
+        already_saved = np.isin(
+            fingerprint_series(dataframe["concat_values"]).to_numpy(),
+            np.concatenate(fingerprints_in_db),
+        )
+        dataframe = dataframe.loc[~already_saved]
 
     print("Number of rows removed:", original_length - len(dataframe.index))
     return dataframe.drop(columns=["concat_values", "formated_datetime"])
@@ -225,6 +359,7 @@ def remove_duplicate_client_invoice_data(dataframe: pd.DataFrame) -> pd.DataFram
 # ------UserData Dataset----------
 
 
+@split_by_tenant
 def remove_duplicate_invoices_from_client_to_carrier(
     dataframe: pd.DataFrame,
 ) -> pd.DataFrame:
@@ -232,19 +367,25 @@ def remove_duplicate_invoices_from_client_to_carrier(
     carrier = dataframe.iloc[0]["carrier"]
     company = dataframe.iloc[0]["company"]
     tracking_numbers = dataframe["tracking_number"].to_list()
-    sql_query = f"""
+    sql_query = """
         SELECT
             tracking_number
 
         FROM UserData.InvoicesFromClientToCarrier
 
-        WHERE company = "{company}"
-            AND carrier = "{carrier}"
-            AND tracking_number IN UNNEST({tracking_numbers})
+        WHERE company = @company
+            AND carrier = @carrier
+            AND tracking_number IN UNNEST(@tracking_numbers)
     """
-    already_saved_tracking_numbers = select(sql_query, False)[
-        "tracking_number"
-    ].to_list()
+    already_saved_tracking_numbers = select(
+        sql_query,
+        False,
+        parameters=[
+            ("company", BQParameterType.STRING, company),
+            ("carrier", BQParameterType.STRING, carrier),
+            ("tracking_numbers", BQParameterType.STRING, tracking_numbers),
+        ],
+    )["tracking_number"].to_list()
     if already_saved_tracking_numbers:
         dataframe = dataframe.loc[
             ~dataframe["tracking_number"].isin(already_saved_tracking_numbers)
@@ -252,20 +393,28 @@ def remove_duplicate_invoices_from_client_to_carrier(
     return dataframe
 
 
+@split_by_tenant
 def remove_duplicate_NestedAccountNumbers(dataframe: pd.DataFrame) -> pd.DataFrame:
     """Removes already saved account numbers dataframe"""
     carrier = dataframe.iloc[0]["carrier"]
     company = dataframe.iloc[0]["company"]
-    sql_query = f"""
+    sql_query = """
         SELECT
             distinct account_number
 
         FROM UserData.NestedAccountNumbers
 
-        WHERE company = "{company}"
-            AND carrier = "{carrier}"
+        WHERE company = @company
+            AND carrier = @carrier
     """
-    already_saved_account_numbers = select(sql_query, False)["account_number"].to_list()
+    already_saved_account_numbers = select(
+        sql_query,
+        False,
+        parameters=[
+            ("company", BQParameterType.STRING, company),
+            ("carrier", BQParameterType.STRING, carrier),
+        ],
+    )["account_number"].to_list()
     if already_saved_account_numbers:
         print(
             f"Account numbers {already_saved_account_numbers} are already saved in table."
@@ -378,27 +527,164 @@ def remove_duplicate_currency_conversion(dataframe: pd.DataFrame) -> pd.DataFram
 # ----------CarrierData Dataset----------
 
 
-def remove_duplicate_package_information(dataframe: pd.DataFrame) -> pd.DataFrame:
+def remove_duplicate_package_information(
+    dataframe: pd.DataFrame, use_key_index: bool = False
+) -> pd.DataFrame:
     """Removes already saved package information dataframe"""
+    if use_key_index:
+        key_index = get_key_index(CarrierData_dataset.PackageInformation)
+        key_index.sync()
+        return dataframe.loc[
+            ~key_index.contains(
+                dataframe["carrier"].astype(str)
+                + dataframe["company"].astype(str)
+                + dataframe["tracking_number"].astype(str),
+                dataframe,
+            )
+        ]
+
     tns = dataframe["tracking_number"].unique().tolist()
     sql_query = """
         SELECT
-            distinct carrier || company || tracking_number AS existing_entry
+            distinct FARM_FINGERPRINT(carrier || company || tracking_number) AS fingerprint
 
         FROM CarrierData.PackageInformation
         WHERE tracking_number IN UNNEST(@tracking_numbers)
     """
-    already_saved_entries = select(
+    already_saved_fingerprints = select(
         sql_query,
         parameters=(("tracking_numbers", BQParameterType.STRING, tns),),
-    )["existing_entry"].tolist()
-    if already_saved_entries:
-        dataframe["concat_values"] = (
+    )["fingerprint"].to_numpy(dtype=np.int64)
+    if already_saved_fingerprints.size:
+        fingerprints = fingerprint_series(
             dataframe["carrier"].astype(str)
             + dataframe["company"].astype(str)
             + dataframe["tracking_number"].astype(str)
         )
         dataframe = dataframe.loc[
-            ~dataframe["concat_values"].isin(already_saved_entries)
-        ].drop(columns=["concat_values"])
+            ~np.isin(fingerprints.to_numpy(), already_saved_fingerprints)
+        ]
     return dataframe
+
+
+# ----------Server-side duplicate checks----------
+
+SERVER_SIDE_DEDUPLICATION_TABLES = [
+    InvoicesData_dataset.Refunds,
+    InvoicesData_dataset.Deliveries,
+    CarrierData_dataset.PackageInformation,
+]
+
+
+def build_server_side_deduplication_query(
+    table: Enum, temporary_table: str, columns: List[str]
+) -> str:
+    """Builds the query selecting the rows of a temporary table that are not saved in the table yet.
+    It applies the same rules as `remove_duplicate_refunds`, `remove_duplicate_deliveries` and
+    `remove_duplicate_package_information`, so that all the key comparisons run in BigQuery.
+    ## Arguments
+    - `table`: The destination table, one of `SERVER_SIDE_DEDUPLICATION_TABLES`.
+    - `temporary_table`: The full id of the temporary table holding the new rows,
+    with their original order in the `ROW_POSITION_COLUMN`.
+    - `columns`: The columns to select.
+
+    ## Example
+        >>> build_server_side_deduplication_query(
+                CarrierData_dataset.PackageInformation,
+                "project.CarrierData.PackageInformation_tmp",
+                ["carrier", "company", "tracking_number"],
+            )
+
+    ## Returns
+    The SELECT query of the rows to insert.
+    """
+    selected_columns = ", ".join(f"new.{column}" for column in columns)
+
+    if table == InvoicesData_dataset.Refunds:
+        # We allow db duplicates for UPS refunds if this comes from the platform
+        allow_duplicates = (
+            "new.carrier = 'UPS'" if "claim_number" in columns else "FALSE"
+        )
+        return f"""
+        WITH new_rows AS (
+            SELECT
+                new.*,
+                {SMART_REASON_REFUND_SQL.format(alias="new")} AS smart_reason_refund
+
+            FROM `{temporary_table}` AS new
+
+            WHERE TRUE
+            QUALIFY ROW_NUMBER() OVER (
+                PARTITION BY new.tracking_number, new.reason_refund
+                ORDER BY new.{ROW_POSITION_COLUMN}
+            ) = 1
+        ),
+
+        unique_new_rows AS (
+            SELECT *
+
+            FROM new_rows AS new
+
+            WHERE TRUE
+            QUALIFY {allow_duplicates}
+                OR COUNT(*) OVER (
+                    PARTITION BY new.tracking_number, new.smart_reason_refund
+                ) = 1
+        )
+
+        SELECT {selected_columns}
+
+        FROM unique_new_rows AS new
+
+        WHERE {allow_duplicates}
+            OR NOT EXISTS (
+                SELECT 1
+
+                FROM InvoicesData.Refunds AS existing
+
+                WHERE existing.company = new.company
+                    AND existing.carrier = new.carrier
+                    AND existing.tracking_number = new.tracking_number
+                    AND {SMART_REASON_REFUND_SQL.format(alias="existing")} = new.smart_reason_refund
+            )
+        """
+
+    if table == InvoicesData_dataset.Deliveries:
+        return f"""
+        SELECT {selected_columns}
+
+        FROM `{temporary_table}` AS new
+
+        WHERE new.tracking_number IS NOT NULL
+            AND new.status IS NOT NULL
+            AND new.date_time IS NOT NULL
+            AND NOT EXISTS (
+                SELECT 1
+
+                FROM InvoicesData.Deliveries AS existing
+
+                WHERE existing.tracking_number = new.tracking_number
+                    AND existing.status = new.status
+                    AND DATETIME_TRUNC(existing.date_time, SECOND)
+                        = DATETIME_TRUNC(new.date_time, SECOND)
+            )
+        """
+
+    if table == CarrierData_dataset.PackageInformation:
+        return f"""
+        SELECT {selected_columns}
+
+        FROM `{temporary_table}` AS new
+
+        WHERE NOT EXISTS (
+            SELECT 1
+
+            FROM CarrierData.PackageInformation AS existing
+
+            WHERE existing.carrier = new.carrier
+                AND existing.company = new.company
+                AND existing.tracking_number = new.tracking_number
+        )
+        """
+
+    raise ValueError(f"No server-side duplicate check for table {table.name}.")
@@ -0,0 +1,235 @@
+"""Registry of the table schemas, compiled from the SQL files of the schemas folder.
+
+The SQL files are parsed once per process. The schemas are then available without any
+request to BigQuery, as `SchemaField` lists, Arrow schemas and pandas dtypes.
+"""
+
+import os
+import re
+from enum import Enum
+from functools import lru_cache
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+import pyarrow as pa
+from google.cloud.bigquery import Client, SchemaField, Table
+
+from lox_services.persistence.database.datasets import get_dataset_name
+from lox_services.persistence.database.schemas.operations import (
+    SCHEMAS_TABLES_PATH,
+    parse_table_columns,
+    read_table_schema,
+)
+
+# Names of the types in the schemas returned by the BigQuery API
+API_TYPE_NAMES = {
+    "INT64": "INTEGER",
+    "FLOAT64": "FLOAT",
+    "BOOL": "BOOLEAN",
+    "STRUCT": "RECORD",
+}
+
+ARROW_TYPES = {
+    "STRING": pa.string(),
+    "BYTES": pa.binary(),
+    "INTEGER": pa.int64(),
+    "FLOAT": pa.float64(),
+    "NUMERIC": pa.decimal128(38, 9),
+    "BIGNUMERIC": pa.decimal256(76, 38),
+    "BOOLEAN": pa.bool_(),
+    "DATE": pa.date32(),
+    "DATETIME": pa.timestamp("us"),
+    "TIMESTAMP": pa.timestamp("us", tz="UTC"),
+    "TIME": pa.time64("us"),
+    "GEOGRAPHY": pa.string(),
+    "JSON": pa.string(),
+}
+
+# Same pandas types as the ones of `cast_dataframe_to_schema`, the dates are parsed separately
+PANDAS_DTYPES = {
+    "STRING": "string",
+    "INTEGER": "Int64",
+    "FLOAT": "float64",
+    "NUMERIC": "float64",
+    "BIGNUMERIC": "float64",
+    "BOOLEAN": "boolean",
+}
+
+
+class TableSchema(NamedTuple):
+    """Schema of a table in the formats used by the BigQuery client, Arrow and pandas.
+    - `fields`: The schema fields, as returned by `Client.get_table`.
+    - `arrow_schema`: The Arrow schema.
+    - `dtypes`: The pandas dtypes of the scalar columns, except the dates and times.
+    - `date_columns`: The DATE, DATETIME and TIMESTAMP columns, to be parsed as dates.
+    """
+
+    fields: Tuple[SchemaField, ...]
+    arrow_schema: pa.Schema
+    dtypes: Dict[str, str]
+    date_columns: Tuple[str, ...]
+
+
+def _split_struct_fields(struct_fields: str) -> List[str]:
+    """Splits the fields of a struct type, the nested types contain commas too."""
+    fields, depth, start = [], 0, 0
+    for position, character in enumerate(struct_fields):
+        depth += {"<": 1, ">": -1, "(": 1, ")": -1}.get(character, 0)
+        if character == "," and depth == 0:
+            fields.append(struct_fields[start:position])
+            start = position + 1
+    fields.append(struct_fields[start:])
+    return [field.strip() for field in fields]
+
+
+def _to_schema_field(
+    name: str, column_type: str, not_null: bool, description: Optional[str] = None
+) -> SchemaField:
+    """Converts a normalized column type, see `parse_table_columns`, to a schema field."""
+    mode = "REQUIRED" if not_null else "NULLABLE"
+    if column_type.startswith("ARRAY<"):
+        element = _to_schema_field(name, column_type[len("ARRAY<") : -1], False)
+        return SchemaField(
+            name,
+            element.field_type,
+            mode="REPEATED",
+            description=description,
+            fields=element.fields,
+        )
+    if column_type.startswith("STRUCT<"):
+        fields = []
+        for struct_field in _split_struct_fields(column_type[len("STRUCT<") : -1]):
+            field_name, _, field_type = struct_field.partition(" ")
+            field_not_null = field_type.endswith(" NOT NULL")
+            fields.append(
+                _to_schema_field(
+                    field_name,
+                    field_type[: -len(" NOT NULL")] if field_not_null else field_type,
+                    field_not_null,
+                )
+            )
+        return SchemaField(
+            name, "RECORD", mode=mode, description=description, fields=fields
+        )
+
+    base_type, *parameters = re.findall(r"\w+", column_type)
+    field_type = API_TYPE_NAMES.get(base_type, base_type)
+    options = {}
+    if parameters and field_type in ("NUMERIC", "BIGNUMERIC"):
+        options["precision"] = int(parameters[0])
+        if len(parameters) > 1:
+            options["scale"] = int(parameters[1])
+    elif parameters and field_type in ("STRING", "BYTES"):
+        options["max_length"] = int(parameters[0])
+    return SchemaField(name, field_type, mode=mode, description=description, **options)
+
+
+def _to_arrow_type(field: SchemaField) -> pa.DataType:
+    """Converts a schema field to the matching Arrow type."""
+    if field.field_type == "RECORD":
+        arrow_type = pa.struct(
+            [
+                pa.field(
+                    subfield.name,
+                    _to_arrow_type(subfield),
+                    nullable=subfield.mode != "REQUIRED",
+                )
+                for subfield in field.fields
+            ]
+        )
+    else:
+        arrow_type = ARROW_TYPES[field.field_type]
+    if field.mode == "REPEATED":
+        return pa.list_(arrow_type)
+    return arrow_type
+
+
+@lru_cache(maxsize=None)
+def get_registered_schema(dataset: str, table: str) -> Optional[TableSchema]:
+    """Gets the schema of a table from its SQL file, the file is only parsed the first time.
+    ## Arguments
+    - `dataset`: The dataset name, a sub-folder of the schemas folder.
+    - `table`: The table name, a SQL file of the dataset folder.
+
+    ## Example
+        >>> get_registered_schema("InvoicesData", "Deliveries").fields
+
+    ## Returns
+    The schema of the table, or None if the table has no SQL file.
+    """
+    if not os.path.isfile(os.path.join(SCHEMAS_TABLES_PATH, dataset, f"{table}.sql")):
+        return None
+
+    fields = tuple(
+        _to_schema_field(column.name, column.type, column.not_null, column.description)
+        for column in parse_table_columns(read_table_schema(dataset, table))
+    )
+    return TableSchema(
+        fields=fields,
+        arrow_schema=pa.schema(
+            [
+                pa.field(
+                    field.name, _to_arrow_type(field), nullable=field.mode != "REQUIRED"
+                )
+                for field in fields
+            ]
+        ),
+        dtypes={
+            field.name: PANDAS_DTYPES[field.field_type]
+            for field in fields
+            if field.mode != "REPEATED" and field.field_type in PANDAS_DTYPES
+        },
+        date_columns=tuple(
+            field.name
+            for field in fields
+            if field.mode != "REPEATED"
+            and field.field_type in ("DATE", "DATETIME", "TIMESTAMP")
+        ),
+    )
+
+
+def get_table_schema(table: Enum) -> Optional[TableSchema]:
+    """Gets the schema of a table enum from its SQL file, see `get_registered_schema`."""
+    return get_registered_schema(get_dataset_name(table), table.name)
+
+
+def get_table_with_schema(
+    bigquery_client: Client,
+    dataset: str,
+    table: str,
+    columns: Iterable[str],
+    exact_modes: bool = False,
+) -> Table:
+    """Gets a table with its schema, from the registry if possible to avoid a request.
+    The table is fetched if it has no SQL file, or if some of the columns are not in its file.
+    ## Arguments
+    - `bigquery_client`: The client, its project is the one of the table.
+    - `dataset`: The dataset name.
+    - `table`: The table name.
+    - `columns`: The columns that will be written or read.
+    - `exact_modes`: Fetches the table, for the schemas whose modes must match the live table,
+    like the schema of a load job. The modes of a SQL file can drift from the live table.
+
+    ## Returns
+    The table, only its reference and its schema are set if it comes from the registry.
+    """
+    schema = get_registered_schema(dataset, table)
+    if (
+        not exact_modes
+        and schema is not None
+        and set(columns).issubset(field.name for field in schema.fields)
+    ):
+        return Table(
+            f"{bigquery_client.project}.{dataset}.{table}", schema=schema.fields
+        )
+    return bigquery_client.get_table(f"{bigquery_client.project}.{dataset}.{table}")
+
+
+def get_csv_dtypes(table: Enum) -> Dict[str, str]:
+    """Gets the dtypes reading the STRING columns of a table as strings in `pandas.read_csv`,
+    so that identifiers like tracking numbers or postal codes keep their leading zeros.
+    The other columns are left to the inference, as they are converted afterwards.
+    """
+    schema = get_table_schema(table)
+    if schema is None:
+        return {}
+    return {name: "str" for name, dtype in schema.dtypes.items() if dtype == "string"}
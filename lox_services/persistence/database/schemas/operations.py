@@ -1,9 +1,31 @@
 import os
+import re
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from time import perf_counter
+from typing import Dict, List, Literal, NamedTuple, Optional, Tuple
 
 from lox_services.persistence.database.query_handlers import raw_query, select
+from lox_services.utils.general_python import print_error, print_info, print_success
 
 SCHEMAS_TABLES_PATH = os.path.dirname(__file__)
 
+# Maximum number of tables migrated at the same time
+MAX_MIGRATION_WORKERS = 4
+
+# Type aliases accepted in the SQL files, replaced by the name used in the DDL of BigQuery
+TYPE_ALIASES = {
+    "INTEGER": "INT64",
+    "INT": "INT64",
+    "SMALLINT": "INT64",
+    "BIGINT": "INT64",
+    "TINYINT": "INT64",
+    "BYTEINT": "INT64",
+    "FLOAT": "FLOAT64",
+    "BOOLEAN": "BOOL",
+    "DECIMAL": "NUMERIC",
+    "BIGDECIMAL": "BIGNUMERIC",
+}
+
 
 def get_creation_table_sql_query(dataset: str, table: str) -> str:
     """Gets the creation query for a table with schema data."""
@@ -19,6 +41,196 @@ def get_creation_table_sql_query(dataset: str, table: str) -> str:
     return select(query).loc[0]["ddl"]
 
 
+def get_creation_table_sql_queries(dataset: str) -> Dict[str, str]:
+    """Gets the creation query of every table of a dataset, with a single query.
+    ## Returns
+    The creation queries by table name.
+    """
+    query = f"""
+        SELECT
+            table_name,
+            ddl
+        FROM
+            {dataset}.INFORMATION_SCHEMA.TABLES
+        WHERE
+            table_type = "BASE TABLE"
+    """
+    ddls = select(query)
+    return dict(zip(ddls["table_name"], ddls["ddl"]))
+
+
+def read_table_schema(dataset: str, table: str) -> str:
+    """Reads the SQL file of a table, it holds the table name followed by its columns."""
+    with open(os.path.join(SCHEMAS_TABLES_PATH, dataset, f"{table}.sql")) as sql_file:
+        return sql_file.read()
+
+
+def list_schema_tables() -> Dict[str, List[str]]:
+    """Lists the tables having a SQL file, by dataset, both sorted by name."""
+    datasets = sorted(
+        directory
+        for directory in os.listdir(SCHEMAS_TABLES_PATH)
+        if os.path.isdir(os.path.join(SCHEMAS_TABLES_PATH, directory))
+        and not directory.startswith("__")
+    )
+    return {
+        dataset: sorted(
+            file.replace(".sql", "")
+            for file in os.listdir(os.path.join(SCHEMAS_TABLES_PATH, dataset))
+            if file.endswith(".sql")
+        )
+        for dataset in datasets
+    }
+
+
+class ColumnDefinition(NamedTuple):
+    """A column of a table, as compared between the SQL files and the live tables."""
+
+    name: str
+    type: str
+    not_null: bool
+    description: Optional[str]
+
+
+def _split_top_level(text: str, separator: str = ",") -> List[str]:
+    """Splits a text on the separators that are not nested in brackets or quotes."""
+    parts, depth, quote, start = [], 0, None, 0
+    for position, character in enumerate(text):
+        if quote:
+            if character == quote and text[position - 1] != "\\":
+                quote = None
+        elif character in "\"'":
+            quote = character
+        elif character in "(<":
+            depth += 1
+        elif character in ")>":
+            depth -= 1
+        elif character == separator and depth == 0:
+            parts.append(text[start:position])
+            start = position + 1
+    parts.append(text[start:])
+    return [part.strip() for part in parts if part.strip()]
+
+
+def _normalize_type(column_type: str) -> str:
+    """Normalizes the spacing, the case and the aliases of a column type, nested types included.
+    The names of the struct fields, followed by their type, keep their case.
+    """
+    column_type = re.sub(r"\s+", " ", column_type).strip()
+    column_type = re.sub(r"\s*([<>,()])\s*", r"\1", column_type)
+    column_type = column_type.replace(",", ", ")
+    return re.sub(
+        r"\b\w+\b(?! (?!NOT\b|NULL\b)\w)",
+        lambda match: TYPE_ALIASES.get(match.group().upper(), match.group().upper()),
+        column_type,
+        flags=re.IGNORECASE,
+    )
+
+
+def _read_column_type(definition: str) -> Tuple[str, int]:
+    """Reads the type at the beginning of a column definition, with its nested or parameterized parts.
+    ## Returns
+    The normalized type and the position of its end in the definition.
+    """
+    match = re.match(r"[A-Za-z0-9_]+", definition)
+    if match is None:
+        raise ValueError(f"Can't read the type of column definition '{definition}'.")
+    end = match.end()
+    if definition[end:].lstrip().startswith("<"):
+        depth = 0
+        end = definition.index("<", end)
+        for position in range(end, len(definition)):
+            depth += {"<": 1, ">": -1}.get(definition[position], 0)
+            if depth == 0:
+                end = position + 1
+                break
+    parameters = re.match(r"\s*\(\s*\d+(\s*,\s*\d+)?\s*\)", definition[end:])
+    if parameters is not None:
+        end += parameters.end()
+    return _normalize_type(definition[:end]), end
+
+
+def parse_table_columns(ddl: str) -> List[ColumnDefinition]:
+    """Parses the columns of a table definition, from a SQL file or from the DDL of a live table.
+    Comments are ignored, and so are the table options like partitioning.
+    ## Example
+        >>> parse_table_columns("LoxData.Targets (metric STRING NOT NULL, month DATE)")
+        [ColumnDefinition(name='metric', type='STRING', not_null=True, description=None), ...]
+    """
+    ddl = re.sub(r"--[^\n]*", "", ddl)
+    start = ddl.index("(")
+    depth = 0
+    for end in range(start, len(ddl)):
+        depth += {"(": 1, ")": -1}.get(ddl[end], 0)
+        if depth == 0:
+            break
+    else:
+        raise ValueError("The column list of the table definition is not closed.")
+
+    columns = []
+    for definition in _split_top_level(ddl[start + 1 : end]):
+        name, _, rest = definition.partition(" ")
+        rest = rest.strip()
+        column_type, type_end = _read_column_type(rest)
+        # The constraints are between the type and the options, which can contain any text
+        constraints, *_ = re.split(
+            r"\bOPTIONS\s*\(", rest[type_end:], flags=re.IGNORECASE
+        )
+        description = re.search(
+            r"description\s*=\s*(\"(?:[^\"\\]|\\.)*\"|'(?:[^'\\]|\\.)*')", rest
+        )
+        columns.append(
+            ColumnDefinition(
+                name=name.strip("`"),
+                type=column_type,
+                not_null=re.search(r"\bNOT\s+NULL\b", constraints, re.IGNORECASE)
+                is not None,
+                description=description.group(1)[1:-1] if description else None,
+            )
+        )
+    return columns
+
+
+def compare_table_columns(
+    expected: List[ColumnDefinition], current: List[ColumnDefinition]
+) -> List[str]:
+    """Lists the differences between the columns of a SQL file and the ones of the live table."""
+    expected_by_name = {column.name: column for column in expected}
+    current_by_name = {column.name: column for column in current}
+    changes = [
+        f"add {name}" for name in expected_by_name if name not in current_by_name
+    ] + [f"drop {name}" for name in current_by_name if name not in expected_by_name]
+    for name, column in expected_by_name.items():
+        current_column = current_by_name.get(name)
+        if current_column is None:
+            continue
+        if column.type != current_column.type:
+            changes.append(f"{name}: {current_column.type} -> {column.type}")
+        if column.not_null != current_column.not_null:
+            changes.append(f"{name}: {'NOT NULL' if column.not_null else 'NULLABLE'}")
+        if column.description != current_column.description:
+            changes.append(f"{name}: description")
+    common_names = [name for name in expected_by_name if name in current_by_name]
+    if not changes and common_names != [
+        name for name in current_by_name if name in expected_by_name
+    ]:
+        changes.append("column order")
+    return changes
+
+
+class TableMigration(NamedTuple):
+    """Planned migration of a table.
+    - `create`: The table doesn't exist yet.
+    - `replace`: The table is recreated with the schema of its SQL file, keeping its rows.
+    - `unchanged`: The table already has the schema of its SQL file.
+    """
+
+    dataset: str
+    table: str
+    action: Literal["create", "replace", "unchanged"]
+    changes: List[str]
+
+
 def create_table_with_schema(dataset: str, table: str):
     """Creates a table with the SQL file provided
     ## Arguments
@@ -30,10 +242,7 @@ def create_table_with_schema(dataset: str, table: str):
     create_table_with_schema("LoxData", "Hello")
     ```
     """
-    with open(os.path.join(SCHEMAS_TABLES_PATH, dataset, f"{table}.sql")) as sql_file:
-        query = sql_file.read()
-
-    query = "CREATE TABLE " + query
+    query = "CREATE TABLE " + read_table_schema(dataset, table)
     queryjob = raw_query(query)
     return queryjob
 
@@ -49,12 +258,9 @@ def use_new_table_schema(dataset: str, table: str):
     use_new_table_schema("LoxData", "Invoicing")
     ```
     """
-    with open(os.path.join(SCHEMAS_TABLES_PATH, dataset, f"{table}.sql")) as sql_file:
-        query = sql_file.read()
-
     query = (
         "CREATE OR REPLACE TABLE "
-        + query
+        + read_table_schema(dataset, table)
         + f"""
         AS
         SELECT *
@@ -65,22 +271,97 @@ def use_new_table_schema(dataset: str, table: str):
     return queryjob
 
 
-def use_all_new_tables_schemas():
-    """Apply table schema on files"""
-    datasets = list(
-        filter(lambda dir: ".py" not in dir, os.listdir(SCHEMAS_TABLES_PATH))
+def plan_schema_migrations(
+    datasets: Optional[List[str]] = None,
+) -> List[TableMigration]:
+    """Compares the SQL file of every table with the DDL of the live table, without changing anything.
+    The live DDLs are fetched with one query per dataset.
+    ## Arguments
+    - `datasets`: The datasets to plan, all the sub-folders of the schemas folder by default.
+
+    ## Example
+        >>> plan = plan_schema_migrations(["InvoicesData"])
+        >>> [migration for migration in plan if migration.action != "unchanged"]
+
+    ## Returns
+    The migration of each table, in the order of the datasets and tables.
+    """
+    plan = []
+    for dataset, tables in list_schema_tables().items():
+        if datasets is not None and dataset not in datasets:
+            continue
+        live_ddls = get_creation_table_sql_queries(dataset)
+        for table in tables:
+            if table not in live_ddls:
+                plan.append(TableMigration(dataset, table, "create", []))
+                continue
+            changes = compare_table_columns(
+                parse_table_columns(read_table_schema(dataset, table)),
+                parse_table_columns(live_ddls[table]),
+            )
+            plan.append(
+                TableMigration(
+                    dataset, table, "replace" if changes else "unchanged", changes
+                )
+            )
+    return plan
+
+
+def _apply_table_migration(migration: TableMigration) -> float:
+    """Applies the migration of one table and returns its duration in seconds."""
+    start_time = perf_counter()
+    if migration.action == "create":
+        create_table_with_schema(migration.dataset, migration.table)
+    else:
+        use_new_table_schema(migration.dataset, migration.table)
+    return perf_counter() - start_time
+
+
+def apply_schema_migrations(
+    plan: List[TableMigration], max_workers: int = MAX_MIGRATION_WORKERS
+) -> Dict[str, float]:
+    """Applies the migrations of a plan made by `plan_schema_migrations`, in parallel.
+    The unchanged tables are skipped. Every migration is run even if another one fails,
+    the first error is raised once all of them are done.
+    ## Arguments
+    - `plan`: The migrations to apply.
+    - `max_workers`: Maximum number of tables migrated at the same time.
+
+    ## Returns
+    The duration in seconds of each migration, by full table name.
+    """
+    migrations = [migration for migration in plan if migration.action != "unchanged"]
+    print_info(
+        f"{len(migrations)} tables to migrate, "
+        f"{len(plan) - len(migrations)} unchanged tables skipped."
     )
-    datasets.sort()
-    for dataset in datasets:
-        tables = list(
-            map(
-                lambda file: file.replace(".sql", ""),
-                filter(
-                    lambda dir: ".sql" in dir,
-                    os.listdir(os.path.join(SCHEMAS_TABLES_PATH, dataset)),
-                ),
+    durations: Dict[str, float] = {}
+    errors = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(_apply_table_migration, migration): migration
+            for migration in migrations
+        }
+        for future in as_completed(futures):
+            migration = futures[future]
+            full_table_name = f"{migration.dataset}.{migration.table}"
+            try:
+                durations[full_table_name] = future.result()
+            except Exception as error:
+                print_error(f"Migration of {full_table_name} failed: {error}")
+                errors.append(error)
+                continue
+            print_success(
+                f"{full_table_name} migrated ({migration.action}) "
+                f"in {durations[full_table_name]:.1f}s: {', '.join(migration.changes)}"
             )
-        )
-        tables.sort()
-        for table in tables:
-            use_new_table_schema(dataset, table)
+    if errors:
+        raise errors[0]
+    return durations
+
+
+def use_all_new_tables_schemas(max_workers: int = MAX_MIGRATION_WORKERS):
+    """Apply table schema on files, only to the tables whose schema changed.
+    See `plan_schema_migrations` and `apply_schema_migrations`.
+    """
+    return apply_schema_migrations(plan_schema_migrations(), max_workers=max_workers)
@@ -0,0 +1,364 @@
+"""Durable local write-ahead spool for the inserts into the database.
+
+Dataframes are appended to a local folder as Parquet segments (one sub-folder per table)
+and a background thread flushes them to Google BigQuery in micro-batches.
+Segments are only removed once they have been inserted, so pending data is replayed
+when a new spool is opened on the same folder after a crash.
+"""
+
+import fcntl
+import os
+import shutil
+import threading
+import time
+import uuid
+from enum import Enum
+from typing import Dict, List, Optional
+
+import pandas as pd
+import pyarrow.parquet as pq
+
+from lox_services.config.paths import DATABASE_CACHE_FOLDER
+from lox_services.persistence.database.datasets import (
+    get_dataset_name,
+    get_table_from_full_name,
+)
+from lox_services.persistence.database.exceptions import SpoolFullException
+from lox_services.persistence.database.insert import insert_dataframe_into_database
+from lox_services.utils.general_python import print_error, print_info
+
+SPOOL_FOLDER = os.path.join(DATABASE_CACHE_FOLDER, "spool")
+
+SEGMENT_EXTENSION = ".parquet"
+TEMPORARY_EXTENSION = ".tmp"
+LOCK_FILE_NAME = ".flush.lock"
+
+# Segments failing this many times in a row are moved aside, so that they stop blocking their table
+QUARANTINE_FOLDER_NAME = "quarantine"
+MAX_SEGMENT_FAILURES = 30
+
+# A temporary segment this old was abandoned, even if the process that wrote it is still alive
+STALE_TEMPORARY_AGE = 3600
+
+
+def _is_process_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _fsync_path(path: str) -> None:
+    """Flushes a file or a folder to the disk."""
+    file_descriptor = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(file_descriptor)
+    finally:
+        os.close(file_descriptor)
+
+
+class InsertSpool:
+    """Spools dataframes on the local disk and inserts them into the database in the background.
+    `append` returns as soon as the dataframe is safely written on the local disk.
+
+    ## Arguments
+    - `folder`: The folder where the segments are stored.
+    - `flush_interval`: Number of seconds between two flushes of the background thread.
+    - `max_batch_rows`: Maximum number of rows sent to `insert_dataframe_into_database` at once.
+    - `max_disk_bytes`: Disk budget of the spool. `append` waits for the flusher when it is exceeded.
+    - `full_timeout`: Number of seconds `append` waits before raising a `SpoolFullException`.
+    - `max_segment_failures`: Number of failed inserts after which a segment is moved to the
+    quarantine folder, see `quarantined_segments`.
+    - `insert_kwargs`: Extra keyword arguments given to `insert_dataframe_into_database`.
+
+    ## Example
+        >>> with InsertSpool() as spool:
+        >>>     spool.append(deliveries_df, InvoicesData_dataset.Deliveries)
+    """
+
+    def __init__(
+        self,
+        folder: str = SPOOL_FOLDER,
+        *,
+        flush_interval: float = 5.0,
+        max_batch_rows: int = 50000,
+        max_disk_bytes: int = 2 * 1024**3,
+        full_timeout: float = 300.0,
+        max_segment_failures: int = MAX_SEGMENT_FAILURES,
+        insert_kwargs: Optional[dict] = None,
+    ):
+        self.folder = folder
+        self.flush_interval = flush_interval
+        self.max_batch_rows = max_batch_rows
+        self.max_disk_bytes = max_disk_bytes
+        self.full_timeout = full_timeout
+        self.max_segment_failures = max_segment_failures
+        self.insert_kwargs = insert_kwargs or {}
+
+        self._flush_lock = threading.Lock()
+        self._flushed = threading.Condition()
+        self._stop_event = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        # Number of failed inserts of the segments, by path
+        self._failures: Dict[str, int] = {}
+
+        os.makedirs(self.folder, exist_ok=True)
+        self._remove_incomplete_segments()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    ### PRIVATE ###
+
+    def _remove_incomplete_segments(self) -> None:
+        """Removes the segments whose write was interrupted, they were never acknowledged.
+        The segments being written by other live processes are left alone.
+        """
+        for table_folder in self._table_folders():
+            for file_name in os.listdir(table_folder):
+                if not file_name.endswith(TEMPORARY_EXTENSION):
+                    continue
+                path = os.path.join(table_folder, file_name)
+                # The temporary segments are named `{segment}.{pid}.tmp`
+                owner = file_name[: -len(TEMPORARY_EXTENSION)].rpartition(".")[2]
+                try:
+                    if (
+                        owner.isdigit()
+                        and _is_process_alive(int(owner))
+                        and time.time() - os.path.getmtime(path) < STALE_TEMPORARY_AGE
+                    ):
+                        continue
+                    os.remove(path)
+                except FileNotFoundError:
+                    # Renamed or removed by its owner meanwhile
+                    pass
+
+    def _table_folders(self) -> List[str]:
+        return sorted(
+            os.path.join(self.folder, folder_name)
+            for folder_name in os.listdir(self.folder)
+            if folder_name != QUARANTINE_FOLDER_NAME
+            and os.path.isdir(os.path.join(self.folder, folder_name))
+        )
+
+    def _quarantine(self, segment_path: str) -> None:
+        """Moves a segment that keeps failing out of the spool, it must be inserted by hand."""
+        quarantine_folder = os.path.join(
+            self.folder,
+            QUARANTINE_FOLDER_NAME,
+            os.path.basename(os.path.dirname(segment_path)),
+        )
+        os.makedirs(quarantine_folder, exist_ok=True)
+        shutil.move(segment_path, quarantine_folder)
+        self._failures.pop(segment_path, None)
+        print_error(
+            f"Segment {segment_path} failed {self.max_segment_failures} times, "
+            f"moved to {quarantine_folder}"
+        )
+
+    def _wait_for_disk_space(self) -> None:
+        """Blocks until the spool is back under its disk budget."""
+        deadline = time.monotonic() + self.full_timeout
+        while self.disk_usage() >= self.max_disk_bytes:
+            if not self.is_running:
+                self.flush()
+                if self.disk_usage() >= self.max_disk_bytes:
+                    raise SpoolFullException(self.folder, self.max_disk_bytes)
+                return
+
+            remaining_time = deadline - time.monotonic()
+            if remaining_time <= 0:
+                raise SpoolFullException(self.folder, self.max_disk_bytes)
+            with self._flushed:
+                self._flushed.wait(min(remaining_time, self.flush_interval))
+
+    def _flush_table(self, table_folder: str) -> int:
+        """Inserts the pending segments of one table, oldest first, in micro-batches.
+        Stops at the first failing batch so that the order of the segments is kept.
+        The table is skipped while another process is flushing it.
+        """
+        with open(os.path.join(table_folder, LOCK_FILE_NAME), "a") as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return 0
+            try:
+                return self._flush_locked_table(table_folder)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _flush_locked_table(self, table_folder: str) -> int:
+        table = get_table_from_full_name(os.path.basename(table_folder))
+        segments = self.pending_segments(table)
+        inserted_rows = 0
+        while segments:
+            batch_paths, batch_frames, batch_size = [], [], 0
+            # A segment that already failed often is retried alone, to find out if it is the culprit
+            suspect = self._failures.get(segments[0], 0) > 1
+            for segment_path in segments[: 1 if suspect else len(segments)]:
+                segment_size = pq.read_metadata(segment_path).num_rows
+                if batch_frames and batch_size + segment_size > self.max_batch_rows:
+                    break
+                batch_paths.append(segment_path)
+                batch_frames.append(pd.read_parquet(segment_path))
+                batch_size += segment_size
+
+            try:
+                inserted_rows += insert_dataframe_into_database(
+                    pd.concat(batch_frames, ignore_index=True),
+                    table,
+                    **self.insert_kwargs,
+                )
+            except Exception as error:
+                print_error(
+                    f"Spool flush failed for table {table.name}, {len(segments)} segments kept: {error}"
+                )
+                self._failures[batch_paths[0]] = (
+                    self._failures.get(batch_paths[0], 0) + 1
+                )
+                if (
+                    len(batch_paths) == 1
+                    and self._failures[batch_paths[0]] >= self.max_segment_failures
+                ):
+                    self._quarantine(batch_paths[0])
+                    segments = segments[1:]
+                    continue
+                break
+
+            for segment_path in batch_paths:
+                self._failures.pop(segment_path, None)
+                os.remove(segment_path)
+            segments = segments[len(batch_paths) :]
+        return inserted_rows
+
+    def _run(self) -> None:
+        while not self._stop_event.wait(self.flush_interval):
+            # The flusher must outlive any error, or the spool would silently stop flushing
+            try:
+                self.flush()
+            except Exception as error:
+                print_error(f"Spool flush failed: {error}")
+
+    ### PUBLIC ###
+
+    @property
+    def is_running(self) -> bool:
+        """Tells whether the background flusher is running."""
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self) -> None:
+        """Starts the background flusher. Segments left by a previous process are replayed."""
+        if self.is_running:
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(
+            target=self._run, name="InsertSpoolFlusher", daemon=True
+        )
+        self._thread.start()
+
+    def close(self, flush: bool = True) -> None:
+        """Stops the background flusher and, by default, flushes the pending segments."""
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if flush:
+            self.flush()
+
+    def append(self, dataframe: pd.DataFrame, table: Enum) -> int:
+        """Writes a dataframe in the spool of the given table.
+        ## Arguments
+        - `dataframe`: The dataframe to insert into the database.
+        - `table`: The database table. It must be one of the datasets.
+
+        ## Returns
+        The number of spooled rows.
+        """
+        if dataframe.empty:
+            print("Empty dataframe, spool aborted because unnecessary.")
+            return 0
+
+        self._wait_for_disk_space()
+
+        table_folder = os.path.join(
+            self.folder, f"{get_dataset_name(table)}.{table.name}"
+        )
+        os.makedirs(table_folder, exist_ok=True)
+        # Names are sortable so that segments are flushed in the order they were appended
+        segment_name = f"{time.time_ns():020d}-{uuid.uuid4().hex[:8]}"
+        temporary_path = os.path.join(
+            table_folder, f"{segment_name}.{os.getpid()}{TEMPORARY_EXTENSION}"
+        )
+        segment_path = os.path.join(table_folder, segment_name + SEGMENT_EXTENSION)
+
+        dataframe.to_parquet(temporary_path, index=False)
+        _fsync_path(temporary_path)
+        os.replace(temporary_path, segment_path)
+        _fsync_path(table_folder)
+
+        print_info(
+            f"{len(dataframe.index)} rows spooled for table {table.name} in {segment_path}"
+        )
+        return len(dataframe.index)
+
+    def pending_segments(self, table: Optional[Enum] = None) -> List[str]:
+        """Lists the segments not inserted yet, oldest first."""
+        if table is None:
+            table_folders = self._table_folders()
+        else:
+            table_folders = [
+                os.path.join(self.folder, f"{get_dataset_name(table)}.{table.name}")
+            ]
+
+        segments = []
+        for table_folder in table_folders:
+            if not os.path.isdir(table_folder):
+                continue
+            segments += sorted(
+                os.path.join(table_folder, file_name)
+                for file_name in os.listdir(table_folder)
+                if file_name.endswith(SEGMENT_EXTENSION)
+            )
+        return segments
+
+    def quarantined_segments(self) -> List[str]:
+        """Lists the segments moved aside after failing `max_segment_failures` times."""
+        quarantine_folder = os.path.join(self.folder, QUARANTINE_FOLDER_NAME)
+        if not os.path.isdir(quarantine_folder):
+            return []
+        return sorted(
+            os.path.join(quarantine_folder, table_folder, file_name)
+            for table_folder in os.listdir(quarantine_folder)
+            for file_name in os.listdir(os.path.join(quarantine_folder, table_folder))
+        )
+
+    def disk_usage(self) -> int:
+        """Gets the number of bytes used by the pending segments."""
+        usage = 0
+        for segment in self.pending_segments():
+            try:
+                usage += os.path.getsize(segment)
+            except FileNotFoundError:
+                # Inserted by another process meanwhile
+                pass
+        return usage
+
+    def flush(self) -> Dict[str, int]:
+        """Inserts every pending segment into the database.
+        ## Returns
+        A report with the number of inserted rows per table.
+        """
+        report = {}
+        with self._flush_lock:
+            for table_folder in self._table_folders():
+                report[os.path.basename(table_folder)] = self._flush_table(table_folder)
+        with self._flushed:
+            self._flushed.notify_all()
+        return report
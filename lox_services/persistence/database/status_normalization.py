@@ -0,0 +1,124 @@
+"""Normalization of the raw carrier statuses with the Mapping.StatusMapping table.
+
+The mapping is compiled into a hash map by carrier. A status column is normalized by
+mapping its distinct values only, then spreading them back with the categorical codes.
+"""
+
+from typing import Dict, Optional
+
+import numpy as np
+import pandas as pd
+
+from lox_services.persistence.database.datasets import Mapping_dataset
+from lox_services.persistence.database.exceptions import MissingColumnsException
+from lox_services.persistence.database.reference_cache import get_reference_table
+from lox_services.utils.general_python import print_info
+
+# Columns of the StatusMapping table
+CARRIER_COLUMN = "carrier"
+STATUS_COLUMN = "status"
+FINAL_STATUS_COLUMN = "final_status"
+
+
+def _normalize_key(status: str) -> str:
+    """Raw statuses are matched regardless of their case and spacing."""
+    return " ".join(str(status).split()).casefold()
+
+
+class StatusNormalizer:
+    """Maps the raw statuses of the carriers to the final statuses.
+    The rows of the mapping without carrier apply to every carrier, after its own rows.
+    ## Arguments
+    - `mapping`: The mapping, with the `carrier`, `status` and `final_status` columns.
+
+    ## Raises
+    - `MissingColumnsException`: If one of the columns is missing from the mapping.
+
+    ## Example
+        >>> normalizer = get_status_normalizer()
+        >>> df["final_status"] = normalizer.normalize(df["status"], "UPS", fallback="Unknown")
+    """
+
+    def __init__(self, mapping: pd.DataFrame):
+        missing_columns = [
+            column
+            for column in (CARRIER_COLUMN, STATUS_COLUMN, FINAL_STATUS_COLUMN)
+            if column not in mapping.columns
+        ]
+        if missing_columns:
+            raise MissingColumnsException(", ".join(missing_columns))
+        mapping = mapping.dropna(subset=[STATUS_COLUMN, FINAL_STATUS_COLUMN])
+        self._final_statuses: Dict[Optional[str], Dict[str, str]] = {}
+        for carrier, status, final_status in zip(
+            mapping[CARRIER_COLUMN],
+            mapping[STATUS_COLUMN],
+            mapping[FINAL_STATUS_COLUMN],
+        ):
+            carrier = None if pd.isna(carrier) else carrier
+            self._final_statuses.setdefault(carrier, {})[
+                _normalize_key(status)
+            ] = final_status
+
+    def get_carrier_mapping(self, carrier: Optional[str]) -> Dict[str, str]:
+        """Gets the final status by normalized raw status for a carrier."""
+        return {
+            **self._final_statuses.get(None, {}),
+            **self._final_statuses.get(carrier, {}),
+        }
+
+    def normalize(
+        self,
+        statuses: pd.Series,
+        carrier: Optional[str],
+        fallback: Optional[str] = None,
+        keep_unknown: bool = False,
+    ) -> pd.Series:
+        """Maps a column of raw statuses to the final statuses.
+        ## Arguments
+        - `statuses`: The raw statuses.
+        - `carrier`: The carrier of the statuses.
+        - `fallback`: The final status of the unknown statuses.
+        - `keep_unknown`: Keeps the unknown statuses as they are, instead of the fallback.
+
+        ## Returns
+        The final statuses, with the index of `statuses`. Missing statuses stay missing.
+        """
+        carrier_mapping = self.get_carrier_mapping(carrier)
+        codes, raw_statuses = pd.factorize(statuses)
+        final_statuses = np.array(
+            [
+                carrier_mapping.get(
+                    _normalize_key(status), status if keep_unknown else fallback
+                )
+                for status in raw_statuses
+            ]
+            + [None],
+            dtype=object,
+        )
+        unknown_statuses = [
+            status
+            for status in raw_statuses
+            if _normalize_key(status) not in carrier_mapping
+        ]
+        if unknown_statuses:
+            print_info(
+                f"{len(unknown_statuses)} unknown {carrier} statuses: {unknown_statuses[:10]}"
+            )
+        # The code -1 of the missing statuses points to the last value, None
+        return pd.Series(final_statuses[codes], index=statuses.index, dtype=object)
+
+
+# The last compiled normalizer, with the copy of the mapping it was compiled from
+_COMPILED_NORMALIZER: dict = {}
+
+
+def get_status_normalizer() -> StatusNormalizer:
+    """Gets the normalizer of the cached copy of the StatusMapping table.
+    It is compiled again only when the copy is refreshed.
+    """
+    mapping = get_reference_table(Mapping_dataset.StatusMapping).get_dataframe()
+    if _COMPILED_NORMALIZER.get("mapping") is not mapping:
+        _COMPILED_NORMALIZER.update(
+            mapping=mapping, normalizer=StatusNormalizer(mapping)
+        )
+    return _COMPILED_NORMALIZER["normalizer"]
@@ -0,0 +1,243 @@
+"""Temporary tables used to send dataframes to BigQuery statements.
+
+The tables are created with their expiration, so that a table is never left behind even
+if the script is killed. The tables of `temporary_table` are pooled by the process and reused
+by the next loads with the same schema, they are deleted when the process exits.
+"""
+
+import atexit
+import os
+import threading
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import pandas as pd
+from google.cloud.bigquery import Client, LoadJobConfig, SchemaField, Table
+
+from lox_services.persistence.config import SERVICE_ACCOUNT_PATH
+
+# Temporary tables expire after this delay, even if they could not be deleted
+TEMPORARY_TABLE_EXPIRATION = timedelta(hours=1)
+
+# A pooled table is not reused when it expires in less than this delay, a statement could still
+# be using it when it expires
+MIN_REMAINING_LIFETIME = timedelta(minutes=10)
+
+
+def generate_temporary_table_name(prefix: str) -> str:
+    """Generates a table name that can't collide with the tables of other scripts running in parallel."""
+    return f"{prefix}_{os.getpid()}_{uuid.uuid4().hex}"
+
+
+class TemporaryTableManager:
+    """Creates temporary tables in a dataset and deletes all of them when closed.
+    A released table is reused by the next load with the same schema, the load then
+    truncates it in a single API call instead of creating a new table. The expiration of
+    a reused table is pushed back once half of it has passed.
+    ## Arguments
+    - `project`: The ID of the BigQuery project.
+    - `dataset_id`: The ID of the dataset holding the temporary tables.
+    - `bigquery_client`: The client used, a new one is created if not given.
+    - `expiration`: Delay after which BigQuery deletes the tables by itself.
+    - `prefix`: Prefix of the table names.
+
+    ## Example
+        >>> with TemporaryTableManager(project, "InvoicesData", prefix="Refunds_update") as manager:
+                for chunk in chunks:
+                    with manager.table(chunk, schema) as table_id:
+                        update(f"UPDATE ... FROM `{table_id}` AS source WHERE ...")
+    """
+
+    def __init__(
+        self,
+        project: str,
+        dataset_id: str,
+        *,
+        bigquery_client: Optional[Client] = None,
+        expiration: timedelta = TEMPORARY_TABLE_EXPIRATION,
+        prefix: str = "temporary",
+    ):
+        if bigquery_client is None:
+            os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = SERVICE_ACCOUNT_PATH
+            bigquery_client = Client()
+        self.bigquery_client = bigquery_client
+        self.project = project
+        self.dataset_id = dataset_id
+        self.expiration = expiration
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self._created: List[str] = []
+        self._released: Dict[Tuple[SchemaField, ...], List[str]] = {}
+        self._expires: Dict[str, datetime] = {}
+
+    def _reuse_released_table(
+        self, schema_key: Tuple[SchemaField, ...]
+    ) -> Optional[str]:
+        """Takes a released table with the schema, pushing back its expiration if needed.
+        The tables too close to their expiration are dropped from the pool.
+        """
+        while True:
+            with self._lock:
+                released_tables = self._released.get(schema_key, [])
+                if not released_tables:
+                    return None
+                table_id = released_tables.pop()
+                expires = self._expires[table_id]
+            now = datetime.now(timezone.utc)
+            if expires - now < MIN_REMAINING_LIFETIME:
+                with self._lock:
+                    self._created.remove(table_id)
+                    del self._expires[table_id]
+                self.bigquery_client.delete_table(table_id, not_found_ok=True)
+                continue
+            if expires - now < self.expiration / 2:
+                table = Table(table_id)
+                table.expires = now + self.expiration
+                self.bigquery_client.update_table(table, ["expires"])
+                with self._lock:
+                    self._expires[table_id] = table.expires
+            return table_id
+
+    def load(self, dataframe: pd.DataFrame, schema: List[SchemaField]) -> str:
+        """Loads the dataframe into a temporary table, reusing a released table with the same schema if any.
+        ## Returns
+        The full id of the table, to be given back with `release`.
+        """
+        table_id = self._reuse_released_table(tuple(schema))
+        if table_id is None:
+            table_id = ".".join(
+                (
+                    self.project,
+                    self.dataset_id,
+                    generate_temporary_table_name(self.prefix),
+                )
+            )
+            table = Table(table_id, schema=schema)
+            table.expires = datetime.now(timezone.utc) + self.expiration
+            self.bigquery_client.create_table(table)
+            with self._lock:
+                self._created.append(table_id)
+                self._expires[table_id] = table.expires
+
+        # Truncating keeps the expiration set at the creation of the table
+        load_job = self.bigquery_client.load_table_from_dataframe(
+            dataframe,
+            table_id,
+            job_config=LoadJobConfig(
+                write_disposition="WRITE_TRUNCATE",
+                create_disposition="CREATE_NEVER",
+                schema=schema,
+            ),
+        )
+        load_job.result()
+        if load_job.errors is not None:
+            raise ValueError(
+                f"Error occurred when loading data to the table - {load_job.errors}"
+            )
+        return table_id
+
+    def release(self, table_id: str, schema: List[SchemaField]) -> None:
+        """Gives back a table loaded with `load`, so that it can be reused."""
+        with self._lock:
+            self._released.setdefault(tuple(schema), []).append(table_id)
+
+    @contextmanager
+    def table(
+        self, dataframe: pd.DataFrame, schema: List[SchemaField]
+    ) -> Iterator[str]:
+        """Context manager loading the dataframe into a temporary table and releasing it on exit.
+        ## Returns
+        The full id of the table.
+        """
+        table_id = self.load(dataframe, schema)
+        try:
+            yield table_id
+        finally:
+            self.release(table_id, schema)
+
+    def close(self) -> None:
+        """Deletes every table created by the manager."""
+        with self._lock:
+            created, self._created, self._released = self._created, [], {}
+            self._expires = {}
+        for table_id in created:
+            self.bigquery_client.delete_table(table_id, not_found_ok=True)
+
+    def __enter__(self) -> "TemporaryTableManager":
+        return self
+
+    def __exit__(self, *exception_info) -> None:
+        self.close()
+
+
+_TEMPORARY_TABLE_MANAGERS: Dict[Tuple[str, str, str], TemporaryTableManager] = {}
+_TEMPORARY_TABLE_MANAGERS_LOCK = threading.Lock()
+
+
+def get_temporary_table_manager(
+    project: str,
+    dataset_id: str,
+    *,
+    bigquery_client: Optional[Client] = None,
+    prefix: str = "temporary",
+) -> TemporaryTableManager:
+    """Gets the manager of the temporary tables of a dataset and prefix, shared by the process.
+    Its tables are deleted when the process exits, see `close_temporary_table_managers`.
+    The client given is used for the next calls of the manager.
+    """
+    with _TEMPORARY_TABLE_MANAGERS_LOCK:
+        key = (project, dataset_id, prefix)
+        if key not in _TEMPORARY_TABLE_MANAGERS:
+            _TEMPORARY_TABLE_MANAGERS[key] = TemporaryTableManager(
+                project, dataset_id, bigquery_client=bigquery_client, prefix=prefix
+            )
+        elif bigquery_client is not None:
+            _TEMPORARY_TABLE_MANAGERS[key].bigquery_client = bigquery_client
+        return _TEMPORARY_TABLE_MANAGERS[key]
+
+
+@atexit.register
+def close_temporary_table_managers() -> None:
+    """Deletes the tables of the shared managers, called when the process exits."""
+    with _TEMPORARY_TABLE_MANAGERS_LOCK:
+        managers = list(_TEMPORARY_TABLE_MANAGERS.values())
+        _TEMPORARY_TABLE_MANAGERS.clear()
+    for manager in managers:
+        manager.close()
+
+
+@contextmanager
+def temporary_table(
+    dataframe: pd.DataFrame,
+    schema: List[SchemaField],
+    project: str,
+    dataset_id: str,
+    *,
+    bigquery_client: Optional[Client] = None,
+    prefix: str = "temporary",
+) -> Iterator[str]:
+    """Context manager loading the dataframe into a temporary table, given back to the pool on exit.
+    A new table takes two API calls, the creation with its expiration and the load, a pooled
+    table only the load.
+    ## Arguments
+    - `dataframe`: The rows of the table.
+    - `schema`: The schema of the table.
+    - `project`: The ID of the BigQuery project.
+    - `dataset_id`: The ID of the dataset holding the table.
+    - `bigquery_client`: The client used, a new one is created if not given.
+    - `prefix`: Prefix of the table name.
+
+    ## Example
+        >>> with temporary_table(keys, schema, project, "InvoicesData") as table_id:
+                delete(f"DELETE FROM ... WHERE EXISTS (SELECT 1 FROM `{table_id}` ...)")
+
+    ## Returns
+    The full id of the table.
+    """
+    manager = get_temporary_table_manager(
+        project, dataset_id, bigquery_client=bigquery_client, prefix=prefix
+    )
+    with manager.table(dataframe, schema) as table_id:
+        yield table_id
@@ -1,9 +1,29 @@
 """All material needed to generate the update query."""
-from typing import Tuple
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Tuple, Union
 
 import pandas as pd
+from google.cloud.bigquery import Client, SchemaField
+
+from lox_services.persistence.config import SERVICE_ACCOUNT_PATH
 from lox_services.persistence.database.constants import BQ_CURRENT_DATETIME
-from lox_services.persistence.database.query_handlers import update
+from lox_services.persistence.database.query_handlers import select, update
+from lox_services.persistence.database.schema_registry import get_table_with_schema
+from lox_services.persistence.database.temporary_tables import temporary_table
+from lox_services.persistence.database.utils import (
+    cast_dataframe_to_schema,
+    get_parameter_type,
+)
+from lox_services.utils.enums import BQParameterType
+from lox_services.utils.general_python import print_info
+
+# Alias of the updated table and of the temporary table in set-based updates
+TARGET_ALIAS = "target"
+SOURCE_ALIAS = "source"
+
+# Maximum number of grouped UPDATE statements running at the same time
+MAX_UPDATE_WORKERS = 4
 
 
 def _generate_set_field(row: pd.Series, where, set_and_where):
@@ -45,6 +65,273 @@ def _generate_where_field(row: pd.Series, where):
     return result
 
 
+def _get_set_fields(columns: List[str], where, set_and_where) -> List[str]:
+    """Gets the fields set by a set-based update, like `_generate_set_field` does for a row."""
+    where_fields = [element["field"] for element in where]
+    return [
+        name for name in columns if name not in where_fields or name in set_and_where
+    ]
+
+
+def _generate_set_based_where_field(where) -> str:
+    """Generates the where field of a set-based update, joining the table with the temporary table."""
+    conditions = []
+    for element in where:
+        field_name = element["field"]
+        operator = element["operator"]
+        if "value" in element:
+            conditions.append(
+                f"{TARGET_ALIAS}.{field_name} {operator} {element['value']}"
+            )
+        elif operator.strip().upper() in ("IN", "NOT IN"):
+            raise ValueError(
+                f"The '{operator}' operator needs a 'value' in set-based updates (field {field_name})."
+            )
+        else:
+            conditions.append(
+                f"{TARGET_ALIAS}.{field_name} {operator} {SOURCE_ALIAS}.{field_name}"
+            )
+    return " AND ".join(conditions)
+
+
+def _update_set_based(
+    dataset: str, table: str, dataframe: pd.DataFrame, where, set_and_where
+) -> int:
+    """Uploads the dataframe into a temporary table and updates the table with a single
+    UPDATE ... FROM statement, see `update_from_dataframe`.
+    """
+    join_fields = [element["field"] for element in where if "value" not in element]
+    # A row of the table can only be updated by one row of the dataframe,
+    # the last one wins like when the rows are updated one by one
+    dataframe = dataframe.drop_duplicates(subset=join_fields or None, keep="last")
+
+    os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = SERVICE_ACCOUNT_PATH
+    bigquery_client = Client()
+    destination = get_table_with_schema(
+        bigquery_client, dataset, table, dataframe.columns
+    )
+    schema = [
+        SchemaField(
+            field.name,
+            field.field_type,
+            mode="REPEATED" if field.mode == "REPEATED" else "NULLABLE",
+            fields=field.fields,
+        )
+        for field in destination.schema
+        if field.name in dataframe.columns
+    ]
+    columns = [field.name for field in schema]
+    missing_columns = set(dataframe.columns).difference(columns)
+    if missing_columns:
+        raise ValueError(
+            f"Columns {sorted(missing_columns)} are not in table {dataset}.{table}."
+        )
+
+    current_datetime_string = ""
+    if "update_datetime" not in columns:
+        current_datetime_string = f"update_datetime = {BQ_CURRENT_DATETIME},"
+    set_field = ", ".join(
+        f"{name} = {SOURCE_ALIAS}.{name}"
+        for name in _get_set_fields(columns, where, set_and_where)
+    )
+
+    where_field = _generate_set_based_where_field(where)
+
+    with temporary_table(
+        cast_dataframe_to_schema(dataframe[columns], schema),
+        schema,
+        destination.project,
+        destination.dataset_id,
+        bigquery_client=bigquery_client,
+        prefix=f"{table}_update",
+    ) as temporary_table_id:
+        query = f"""
+        UPDATE {dataset}.{table} AS {TARGET_ALIAS}
+
+        SET {current_datetime_string}
+            {set_field}
+
+        FROM `{temporary_table_id}` AS {SOURCE_ALIAS}
+
+        WHERE {where_field}
+        """
+        return update(query)
+
+
+def _get_changed_values(
+    dataset: str, table: str, dataframe: pd.DataFrame, where, set_and_where
+) -> pd.DataFrame:
+    """Compares the values to set with the current values of the table, fetched in one query.
+    ## Returns
+    A boolean dataframe with the same index as `dataframe` and one column per set field,
+    telling whether the value differs from the current one. Rows that match no row of
+    the table are all False, as their update would not change anything.
+    """
+    key_fields = []
+    for element in where:
+        if "value" in element:
+            continue
+        if element["operator"].strip() != "=":
+            raise ValueError(
+                f"Unchanged values can only be detected with '=' conditions (field {element['field']})."
+            )
+        key_fields.append(element["field"])
+    if not key_fields:
+        raise ValueError("Unchanged values detection needs a key field in 'where'.")
+    # A key field in `set_and_where` is set to the value it is joined on, it never changes
+    compared_fields = [
+        name
+        for name in _get_set_fields(list(dataframe.columns), where, set_and_where)
+        if name != "update_datetime" and name not in key_fields
+    ]
+
+    os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = SERVICE_ACCOUNT_PATH
+    schema = [
+        field
+        for field in get_table_with_schema(
+            Client(), dataset, table, key_fields + compared_fields
+        ).schema
+        if field.name in key_fields + compared_fields
+    ]
+    parameters, conditions = [], []
+    for position, key in enumerate(key_fields):
+        values = dataframe[key].dropna().unique().tolist()
+        parameters.append(
+            (f"keys_{position}", get_parameter_type(values[0]), values)
+            if values
+            else (f"keys_{position}", BQParameterType.STRING, [])
+        )
+        conditions.append(f"{key} IN UNNEST(@keys_{position})")
+    conditions += [
+        f"{element['field']} {element['operator']} {element['value']}"
+        for element in where
+        if "value" in element
+    ]
+    current_values = select(
+        f"""
+        SELECT {", ".join(dict.fromkeys(key_fields + compared_fields))}
+
+        FROM {dataset}.{table}
+
+        WHERE {" AND ".join(conditions)}
+        """,
+        parameters=parameters,
+    )
+
+    # Both sides are casted to the table types so that the values can be compared
+    new_values = cast_dataframe_to_schema(
+        dataframe[list(dict.fromkeys(key_fields + compared_fields))], schema
+    )
+    current_values = cast_dataframe_to_schema(current_values, schema)
+    merged = (
+        new_values.rename_axis("row_index")
+        .reset_index()
+        .merge(current_values, on=key_fields, suffixes=("", "_current"))
+    )
+    changed = pd.DataFrame(False, index=dataframe.index, columns=compared_fields)
+    if merged.empty:
+        return changed
+    for field in compared_fields:
+        new, current = merged[field], merged[f"{field}_current"]
+        is_different = ~((new == current) | (new.isna() & current.isna()))
+        # A key can match several rows of the table, any different row is updated
+        changed[field] = (
+            is_different.groupby(merged["row_index"])
+            .any()
+            .reindex(dataframe.index, fill_value=False)
+        )
+    return changed
+
+
+def _unchanged_fields(changed: Optional[pd.DataFrame], index) -> List[str]:
+    """Gets the set fields of a row that already hold their value."""
+    if changed is None:
+        return []
+    return changed.columns[~changed.loc[index]].tolist()
+
+
+def _update_grouped(
+    dataset: str,
+    table: str,
+    dataframe: pd.DataFrame,
+    where,
+    set_and_where,
+    max_workers: int,
+    changed: Optional[pd.DataFrame] = None,
+) -> list:
+    """Updates the rows setting the same values with a single statement per group,
+    the keys being given as an array parameter, see `update_from_dataframe`.
+    """
+    key_fields = []
+    for element in where:
+        if "value" in element:
+            continue
+        if element["operator"].strip() != "=":
+            raise ValueError(
+                f"Grouped updates only join on '=' conditions (field {element['field']})."
+            )
+        key_fields.append(element["field"])
+    if not key_fields:
+        raise ValueError("Grouped updates need at least one key field in 'where'.")
+    # The last key is sent as an array, the other ones are part of the group
+    array_key, scalar_keys = key_fields[-1], key_fields[:-1]
+    literal_conditions = [
+        f"{element['field']} {element['operator']} {element['value']}"
+        for element in where
+        if "value" in element
+    ]
+
+    current_datetime_string = ""
+    if "update_datetime" not in dataframe.columns:
+        current_datetime_string = f"update_datetime = {BQ_CURRENT_DATETIME},"
+
+    # A key with a missing value can't match any row with '=', its statement would update nothing
+    complete_keys = dataframe[key_fields].notna().all(axis="columns")
+    if not complete_keys.all():
+        print_info(
+            f"{(~complete_keys).sum()} rows with missing key values are ignored, they can't match any row."
+        )
+        dataframe = dataframe.loc[complete_keys]
+    # A row of the table is updated by the last row of the dataframe, like row by row
+    dataframe = dataframe.drop_duplicates(subset=key_fields, keep="last")
+    set_fields = dataframe.apply(
+        lambda row: _generate_set_field(
+            row.drop(_unchanged_fields(changed, row.name)), where, set_and_where
+        ),
+        axis="columns",
+    )
+
+    queries = []
+    for (set_field, *scalar_values), group in dataframe.groupby(
+        [set_fields] + [dataframe[key] for key in scalar_keys], sort=False
+    ):
+        keys = group[array_key].tolist()
+        parameters = [("keys", get_parameter_type(keys[0]), keys)]
+        conditions = [f"{array_key} IN UNNEST(@keys)"] + literal_conditions
+        for position, (key, value) in enumerate(zip(scalar_keys, scalar_values)):
+            if hasattr(value, "item"):
+                value = value.item()
+            parameters.append((f"key_{position}", get_parameter_type(value), value))
+            conditions.append(f"{key} = @key_{position}")
+        query = f"""
+        UPDATE {dataset}.{table}
+
+        SET {current_datetime_string}
+            {set_field}
+
+        WHERE {" AND ".join(conditions)}
+        """
+        queries.append((query, parameters))
+
+    print(f"{len(dataframe.index)} rows updated with {len(queries)} statements...")
+    with ThreadPoolExecutor(
+        max_workers=max(1, min(max_workers, len(queries)))
+    ) as executor:
+        return list(
+            executor.map(lambda query: update(query[0], parameters=query[1]), queries)
+        )
+
+
 def update_from_dataframe(
     *,
     dataset: str,
@@ -54,7 +341,11 @@ def update_from_dataframe(
     set_and_where: list = [],
     not_update: list = [],
     update_only: list = None,
-) -> list:
+    set_based: bool = False,
+    grouped: bool = False,
+    max_workers: int = MAX_UPDATE_WORKERS,
+    skip_unchanged: bool = False,
+) -> Union[list, int]:
     """Generate SQL queries and send them to the Google BigQuery database.
     ## Arguments
     -`dataset`: The name of the dataset to update
@@ -68,6 +359,18 @@ def update_from_dataframe(
     -`set_and_where`: A list of fields that will be updated even though they are used in the where clause.
     -`not_update`: List of fields that should not be updated
     -`update_only`: List of the only fields that should be updated
+    -`set_based`: Uploads the dataframe into a temporary table and updates every row with
+    a single UPDATE ... FROM statement, instead of one query per row.
+    The fields of `where` without a 'value' join the table with the dataframe,
+    so they can't use the 'IN' operators. If several rows of the dataframe match the
+    same row of the table, the last one is used.
+    -`grouped`: Groups the rows setting the same values and updates each group with a single
+    `UPDATE ... WHERE key IN UNNEST(@keys)` statement. The fields of `where` without a 'value'
+    must use the '=' operator.
+    -`max_workers`: Maximum number of grouped statements running at the same time.
+    -`skip_unchanged`: Fetches the current values of the keys in one query first, and only
+    updates the rows and fields whose value changes. The fields of `where` without a 'value'
+    must use the '=' operator. In set-based updates, only the unchanged rows are skipped.
 
     ## Examples
         >>> example_1 = pd.DataFrame(data={
@@ -100,10 +403,22 @@ def update_from_dataframe(
         #   UPDATE TestEnvironment.Refunds
         #   SET country_code = 'NL', city = 'Rotterdam', postal_code = '3012GD'
         #   WHERE location_id = 'receiver_location_id' AND country_code NOT IN ('FR')
+        >>> update_from_dataframe(..., set_based=True)
+        # Query sent to GBQ:
+        #
+        #   UPDATE TestEnvironment.Refunds AS target
+        #   SET update_datetime = CURRENT_DATETIME('Europe/Amsterdam'),
+        #       country_code = source.country_code, city = source.city, postal_code = source.postal_code
+        #   FROM `project.TestEnvironment.Refunds_update_...` AS source
+        #   WHERE target.location_id = source.location_id AND target.country_code NOT IN ('FR')
 
     ## Returns
     - The errors that occured while updating if there were some.
+    - The number of updated rows if `set_based` is set.
+    - The number of updated rows of every statement if `grouped` is set.
     """
+    if set_based and grouped:
+        raise ValueError("'set_based' and 'grouped' can't be used together.")
     print(f"Updating '{table}' table from the '{dataset}' dataset...")
 
     results = []
@@ -113,12 +428,32 @@ def update_from_dataframe(
             list(set(list(map(lambda x: x["field"], where + update_only))))
         ]
 
+    changed = None
+    if skip_unchanged:
+        dataframe = dataframe.reset_index(drop=True)
+        changed = _get_changed_values(dataset, table, dataframe, where, set_and_where)
+        is_changed = changed.any(axis="columns")
+        print_info(
+            f"{(~is_changed).sum()}/{len(dataframe.index)} rows already up to date, their updates are skipped."
+        )
+        dataframe, changed = dataframe.loc[is_changed], changed.loc[is_changed]
+        if dataframe.empty:
+            return 0 if set_based else []
+
+    if set_based:
+        return _update_set_based(dataset, table, dataframe, where, set_and_where)
+    if grouped:
+        return _update_grouped(
+            dataset, table, dataframe, where, set_and_where, max_workers, changed
+        )
+
     current_datetime_string = ""
     if "update_datetime" not in dataframe.columns:
         current_datetime_string = f"update_datetime = {BQ_CURRENT_DATETIME},"
 
     for index, row in dataframe.iterrows():
         print(f"Updating {index+1}/{dataframe.shape[0]} ...")
+        row = row.drop(_unchanged_fields(changed, index))
         query = f"""
         UPDATE {dataset}.{table}
 
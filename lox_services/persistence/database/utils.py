@@ -1,15 +1,25 @@
 """All utils functions used in GoogleBigQuery module only."""
 import os
 import re
-from datetime import datetime, timedelta, timezone
-from typing import Callable, Literal, Sequence, Union
+from datetime import date, datetime, timedelta, timezone
+from typing import Any, Callable, List, Literal, Optional, Sequence, Union
 
 from tabulate import tabulate
+import farmhash
+import numpy as np
 import pandas as pd
 import pycountry
-from google.cloud.bigquery import Client, DatasetReference, LoadJobConfig
+from google.cloud.bigquery import Client, DatasetReference, LoadJobConfig, SchemaField
 
 from lox_services.persistence.config import SERVICE_ACCOUNT_PATH
+from lox_services.persistence.database.data_quality import (
+    allowed,
+    evaluate_quality_rules,
+    raise_for_violations,
+    required,
+)
+from lox_services.persistence.database.exceptions import DataQualityException
+from lox_services.utils.enums import BQParameterType
 from lox_services.utils.general_python import print_error
 
 
@@ -21,25 +31,21 @@ def quality_check_package_info(df: pd.DataFrame) -> None:
         - `df`: Dataframe that we want to check
 
     ## Raises
-        - `Exception`: If one of the columns is missing, or if the country codes are not valid
+        - `MissingColumnsException`: If one of the columns is missing, it is a `KeyError`
+        - `DataQualityException`: If one of the columns contains null values
     """
-    df = df.copy()
-
-    required_columns = [
-        "carrier",
-        "company",
-        "tracking_number",
-        "label_creation_datetime",
-        "insert_datetime",
-    ]
-
-    # Check that required columns are present and there are no null values
-    for column in required_columns:
-        if column not in df.columns:
-            raise KeyError(f"Required column: {column} is missing")
-
-        if df[column].isnull().any():
-            raise ValueError(f"Column {column} contains null values")
+    raise_for_violations(
+        evaluate_quality_rules(
+            df,
+            required(
+                "carrier",
+                "company",
+                "tracking_number",
+                "label_creation_datetime",
+                "insert_datetime",
+            ),
+        )
+    )
 
 
 def generate_id(columns: list) -> str:
@@ -64,6 +70,77 @@ def generate_id(columns: list) -> str:
         raise Exception("You can't pass empty list as parameter")
 
 
+def generate_id_series(
+    dataframe: pd.DataFrame,
+    columns: List[str],
+    hashed: Union[bool, Literal[64, 128]] = False,
+) -> pd.Series:
+    """Generates the ids of every row of a dataframe, column-wise.
+    Same result as calling `generate_id` on the values of each row.
+    ## Arguments
+    - `dataframe`: Dataframe containing the columns.
+    - `columns`: Columns that we want to concatenate to create the ids
+    - `hashed`: Returns compact hashes of the ids instead of the ids themselves.
+        - `64` (or `True`): int64 fingerprints, equal to `FARM_FINGERPRINT(id)` in BigQuery.
+        - `128`: 128-bit fingerprints, as 32-character hexadecimal strings.
+
+    ## Example
+        >>> generate_id_series(deliveries_df, ["tracking_number", "status"])
+        # 0    1Z1234_Delivered
+        # 1    1Z5678_null
+        >>> generate_id_series(deliveries_df, ["tracking_number", "status"], hashed=64)
+        # 0    -4150737682703077695
+        # 1     354434529120677709
+
+    ## Returns
+    A series of ids, with the same index as the dataframe
+    """
+    if len(columns) == 0:
+        raise Exception("You can't pass empty list as parameter")
+    # 0 and 1 compare equal to False and True, only the booleans and the sizes are accepted
+    if not isinstance(hashed, bool) and (
+        not isinstance(hashed, (int, np.integer)) or hashed not in (64, 128)
+    ):
+        raise ValueError("'hashed' must be False, 64 or 128.")
+
+    parts = [
+        dataframe[column].astype(str).where(dataframe[column].notna(), "null")
+        for column in columns
+    ]
+    ids = parts[0].str.cat(parts[1:], sep="_")
+    if hashed is False:
+        return ids
+    if hashed is True or hashed == 64:
+        return fingerprint_series(ids)
+    return pd.Series(
+        ["{1:016x}{0:016x}".format(*farmhash.fingerprint128(new_id)) for new_id in ids],
+        index=ids.index,
+    )
+
+
+def fingerprint_series(keys: pd.Series) -> pd.Series:
+    """Computes the 64-bit fingerprint of every key, the same value as `FARM_FINGERPRINT` in BigQuery.
+    Comparing fingerprints instead of the keys themselves only moves integers between the database
+    and the dataframes.
+    ## Arguments
+    - `keys`: The string keys, built like the keys given to `FARM_FINGERPRINT` in the query.
+
+    ## Example
+        >>> fingerprint_series(pd.Series(["1Z1234Delivered"]))
+        # 0    -3129622437161561817
+
+    ## Returns
+    A series of int64 fingerprints, with the same index as `keys`
+    """
+    fingerprints = np.fromiter(
+        (farmhash.fingerprint64(key) for key in keys.astype(str)),
+        dtype=np.uint64,
+        count=len(keys.index),
+    )
+    # FARM_FINGERPRINT returns a signed INT64
+    return pd.Series(fingerprints.view(np.int64), index=keys.index)
+
+
 def replace_nan_with_none_in_dataframe(df: pd.DataFrame) -> pd.DataFrame:
     """Replace Nans with Nones in a csv file given
     ## Arguments
@@ -117,6 +194,21 @@ def format_datetime(date: datetime.date, time: datetime.time):
         return date + "T" + time
 
 
+def get_parameter_type(value: Any) -> BQParameterType:
+    """Gets the type of the query parameter holding a python value."""
+    if isinstance(value, bool):
+        return BQParameterType.BOOL
+    if isinstance(value, int):
+        return BQParameterType.INT64
+    if isinstance(value, float):
+        return BQParameterType.FLOAT64
+    if isinstance(value, datetime):
+        return BQParameterType.DATETIME
+    if isinstance(value, date):
+        return BQParameterType.DATE
+    return BQParameterType.STRING
+
+
 def equal_condition_handle_none_value(key: str, value: str):
     """Generates the good 'equal' condition for a sql query by handling None values."""
     if value is None:
@@ -134,6 +226,7 @@ def make_temporary_table(
     write_disposition: Literal[
         "WRITE_TRUNCATE", "WRITE_APPEND", "WRITE_EMPTY"
     ] = "WRITE_TRUNCATE",
+    schema: Optional[List[SchemaField]] = None,
 ) -> None:
     """
     Make the table out of a dataframe and set it to be temporary. Avoids race condition
@@ -153,6 +246,7 @@ def make_temporary_table(
     Each action is atomic and only occurs if BigQuery is able to complete the job
     successfully. Creation, truncation and append actions occur as one atomic update
     upon job completion.
+    - `schema`: The schema of the table. It is detected from the dataframe if not given.
     """
 
     table = ".".join((project, dataset_id, table_name))
@@ -160,7 +254,9 @@ def make_temporary_table(
     os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = SERVICE_ACCOUNT_PATH
     client = Client()
     query_job = client.load_table_from_dataframe(
-        df, table, job_config=LoadJobConfig(write_disposition=write_disposition)
+        df,
+        table,
+        job_config=LoadJobConfig(write_disposition=write_disposition, schema=schema),
     )
     query_job.result()
     if query_job.errors is not None:
@@ -174,6 +270,39 @@ def make_temporary_table(
     client.update_table(table_ref, ["expires"])  # API request
 
 
+def cast_dataframe_to_schema(
+    df: pd.DataFrame, schema: Sequence[SchemaField]
+) -> pd.DataFrame:
+    """Casts the columns of a dataframe to the pandas types matching a BigQuery schema,
+    so that it can be loaded with this schema. Columns that are not in the schema are left as is.
+    Values that cannot be converted become null.
+    ## Arguments
+    - `df`: The dataframe to cast.
+    - `schema`: The BigQuery schema fields.
+
+    ## Returns
+    A casted copy of the dataframe.
+    """
+    df = df.copy()
+    for field in schema:
+        if field.name not in df.columns:
+            continue
+        column = df[field.name]
+        if field.field_type in ("DATETIME", "TIMESTAMP"):
+            df[field.name] = pd.to_datetime(column, errors="coerce")
+        elif field.field_type == "DATE":
+            df[field.name] = pd.to_datetime(column, errors="coerce").dt.date
+        elif field.field_type in ("INTEGER", "INT64"):
+            df[field.name] = pd.to_numeric(column, errors="coerce").astype("Int64")
+        elif field.field_type in ("FLOAT", "FLOAT64", "NUMERIC", "BIGNUMERIC"):
+            df[field.name] = pd.to_numeric(column, errors="coerce")
+        elif field.field_type in ("BOOLEAN", "BOOL"):
+            df[field.name] = column.astype("boolean")
+        elif field.field_type == "STRING":
+            df[field.name] = column.where(column.isna(), column.astype(str))
+    return df
+
+
 def make_validate_country_code() -> Callable[[pd.DataFrame, str], None]:
     """Namespace for all the valid country codes."""
     valid_codes = {country.alpha_2 for country in pycountry.countries}
@@ -205,21 +334,17 @@ def make_validate_country_code() -> Callable[[pd.DataFrame, str], None]:
         if isinstance(country_code_col, str):
             country_code_col = [country_code_col]
 
-        error_mask = (
-            df[country_code_col]
-            .apply(lambda col: (col.notna()) & ~(col.isin(valid_codes)))
-            .any(axis="columns")
+        report = evaluate_quality_rules(
+            df[country_code_col],
+            [allowed(column, valid_codes) for column in country_code_col],
         )
-        if error_mask.any():
+        if report["violations"]:
             print(
-                df.loc[error_mask, country_code_col].pipe(
+                df.loc[report["invalid_rows"], country_code_col].pipe(
                     tabulate, headers="keys", tablefmt="psql"
                 )
             )
-            raise ValueError(
-                "The following populated rows do not contain "
-                "a valid ISO 3166-2 country code."
-            )
+            raise DataQualityException(report["violations"])
 
     return inner_validate_country_code
 
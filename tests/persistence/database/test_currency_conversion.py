@@ -0,0 +1,99 @@
+import unittest
+from datetime import date, timedelta
+
+import numpy as np
+import pandas as pd
+
+from lox_services.persistence.database.currency_conversion import (
+    CurrencyRates,
+    convert_dataframe_amounts,
+)
+
+RATES = pd.DataFrame(
+    {
+        "date": [
+            date(2024, 1, 1),
+            date(2024, 1, 3),
+            date(2024, 1, 1),
+            date(2024, 1, 1),
+        ],
+        "currency_code_from": ["USD", "USD", "EUR", "JPY"],
+        "currency_code_to": ["EUR", "EUR", "GBP", "EUR"],
+        "rate": [0.9, 0.8, 0.85, None],
+    }
+)
+
+
+class TestCurrencyConversion(unittest.TestCase):
+    def setUp(self):
+        self.rates = CurrencyRates(RATES)
+
+    def test_convert(self):
+        result = self.rates.convert(
+            pd.Series([10, 10, 10, 8.5, 10, 10, 10, None], index=list("abcdefgh")),
+            pd.Series(["USD", "USD", "EUR", "GBP", "JPY", None, "USD", "USD"]),
+            pd.Series(
+                [
+                    "2024-01-02",
+                    "2024-01-05",
+                    "2024-01-02",
+                    "2024-01-01",
+                    "2024-01-02",
+                    "2024-01-02",
+                    "2023-12-31",
+                    "2024-01-02",
+                ]
+            ),
+        )
+        np.testing.assert_allclose(
+            result.amounts.to_numpy(),
+            [9, 8, 10, 10, np.nan, np.nan, np.nan, np.nan],
+        )
+        self.assertEqual(list(result.amounts.index), list("abcdefgh"))
+        # No rate for JPY, and no rate published before the 2023-12-31
+        self.assertEqual(
+            result.missing_rate.tolist(),
+            [False, False, False, False, True, False, True, False],
+        )
+
+    def test_missing_and_invalid_dates(self):
+        currencies = pd.Series(["USD", "USD", "USD", "EUR"])
+        dates = pd.Series(["2024-01-05", None, "not a date", None])
+        for max_rate_age in [None, timedelta(days=7)]:
+            rates = self.rates.get_rates(currencies, dates, max_rate_age=max_rate_age)
+            self.assertEqual(rates[0], 0.8)
+            self.assertTrue(rates[[1, 2]].isna().all())
+            # No rate is needed for the amounts already in the target currency
+            self.assertEqual(rates[3], 1.0)
+
+    def test_max_rate_age(self):
+        currencies = pd.Series(["USD"])
+        dates = pd.Series([date(2024, 2, 1)])
+        self.assertTrue(np.isnan(self.rates.get_rates(currencies, dates).iloc[0]))
+        self.assertEqual(
+            self.rates.get_rates(currencies, dates, max_rate_age=None).iloc[0], 0.8
+        )
+
+    def test_convert_dataframe_amounts(self):
+        df = pd.DataFrame(
+            {
+                "net_amount": [10, 20],
+                "amount": ["12", None],
+                "original_currency_code": ["USD", "CHF"],
+                "invoice_date": ["2024-01-03", "2024-01-03"],
+            }
+        )
+        df, missing_rate = convert_dataframe_amounts(
+            df,
+            ["net_amount", "amount"],
+            "original_currency_code",
+            "invoice_date",
+            rates=self.rates,
+        )
+        self.assertAlmostEqual(df["net_amount"].iloc[0], 8)
+        self.assertAlmostEqual(df["amount"].iloc[0], 9.6)
+        self.assertEqual(missing_rate.tolist(), [False, True])
+
+
+if __name__ == "__main__":
+    unittest.main()
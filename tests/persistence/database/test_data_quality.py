@@ -0,0 +1,104 @@
+import unittest
+
+import pandas as pd
+
+from lox_services.persistence.database.data_quality import (
+    allowed,
+    evaluate_quality_rules,
+    numeric_range,
+    raise_for_violations,
+    required,
+    starts_with,
+)
+from lox_services.persistence.database.exceptions import (
+    DataQualityException,
+    MissingColumnsException,
+)
+from lox_services.persistence.database.quality_checks import (
+    client_invoice_data_quality_check,
+)
+from lox_services.persistence.database.utils import quality_check_package_info
+
+
+class TestDataQuality(unittest.TestCase):
+    def setUp(self):
+        self.df = pd.DataFrame(
+            {
+                "company": ["Lox", None, "Lox", "Lox"],
+                "is_return": [True, False, "maybe", None],
+                "url": ["https://a/1", "http://b/2", None, "https://a/4"],
+                "weight": [1.5, -2, "heavy", None],
+            }
+        )
+
+    def test_evaluate_quality_rules(self):
+        report = evaluate_quality_rules(
+            self.df,
+            [
+                *required("company", "carrier"),
+                allowed("is_return", [True, False]),
+                starts_with("url", "https://"),
+                numeric_range("weight", minimum=0),
+            ],
+        )
+        self.assertEqual(
+            [
+                (violation["rule"], violation["rows"], violation["examples"])
+                for violation in report["violations"]
+            ],
+            [
+                ("not_null(company)", 1, []),
+                ("required(carrier)", 4, []),
+                ("allowed(is_return)", 1, ["maybe"]),
+                ("prefix(url)", 1, ["http://b/2"]),
+                ("range(weight)", 2, [-2, "heavy"]),
+            ],
+        )
+        self.assertEqual(report["invalid_rows"].tolist(), [False, True, True, False])
+        self.assertRaises(MissingColumnsException, raise_for_violations, report)
+
+    def test_raise_for_violations(self):
+        report = evaluate_quality_rules(self.df, [allowed("is_return", [True, False])])
+        self.assertRaises(DataQualityException, raise_for_violations, report)
+        # Data quality exceptions are value errors
+        self.assertRaises(ValueError, raise_for_violations, report)
+        raise_for_violations(evaluate_quality_rules(self.df, required("url")[:1]))
+
+    def test_client_invoice_data_quality_check(self):
+        df = pd.DataFrame(
+            {
+                "company": ["Lox"],
+                "carrier": ["UPS"],
+                "tracking_number": ["1Z1"],
+                "data_source": ["api"],
+                "is_original_invoice": [True],
+                "quantity": ["0"],
+                "net_amount": ["12.5"],
+                "invoice_url": ["https://storage.cloud.google.com/bucket/1.pdf"],
+            }
+        )
+        result = client_invoice_data_quality_check(df.copy())
+        self.assertEqual(result["quantity"].tolist(), [1])
+        self.assertEqual(result["original_currency_code"].tolist(), ["EUR"])
+
+        df["invoice_url"] = "https://example.com/1.pdf"
+        self.assertRaises(ValueError, client_invoice_data_quality_check, df.copy())
+        self.assertRaises(
+            MissingColumnsException,
+            client_invoice_data_quality_check,
+            df.drop(columns=["data_source"]),
+        )
+
+    def test_missing_column_is_a_key_error(self):
+        df = pd.DataFrame({"carrier": ["UPS"], "company": ["Lox"]})
+        with self.assertRaises(KeyError) as context:
+            quality_check_package_info(df)
+        self.assertIsInstance(context.exception, MissingColumnsException)
+        self.assertEqual(
+            str(context.exception),
+            "Missing required columns: 'tracking_number, label_creation_datetime, insert_datetime'.",
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
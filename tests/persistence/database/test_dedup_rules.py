@@ -0,0 +1,195 @@
+import unittest
+from unittest import mock
+
+import pandas as pd
+
+from lox_services.persistence.database.datasets import (
+    CarrierData_dataset,
+    InvoicesData_dataset,
+    Mapping_dataset,
+)
+from lox_services.persistence.database.dedup_rules import (
+    build_delivery_keys,
+    build_lookup_query,
+    remove_saved_rows,
+)
+from lox_services.persistence.database.insert import get_insert_checks
+from lox_services.persistence.database.utils import fingerprint_series
+
+
+def check_names(*args, **kwargs):
+    return [name for name, _ in get_insert_checks(*args, **kwargs)[1]]
+
+
+class TestDedupRules(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch(
+            "lox_services.persistence.database.partitioning.is_partitioned_by",
+            return_value=True,
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_get_insert_checks(self):
+        self.assertEqual(
+            check_names(InvoicesData_dataset.Deliveries),
+            ["remove_duplicate_headers_dataframe", "remove_duplicate_deliveries"],
+        )
+        # Append-only table
+        self.assertEqual(
+            check_names(InvoicesData_dataset.Deliveries, idempotent=True),
+            ["remove_duplicate_headers_dataframe"],
+        )
+        self.assertEqual(
+            check_names(
+                CarrierData_dataset.PackageInformation, server_side_deduplication=True
+            ),
+            ["quality_check_package_info"],
+        )
+        self.assertEqual(
+            check_names(InvoicesData_dataset.Invoices, duplicates_removed=True),
+            ["remove_duplicate_headers_dataframe"],
+        )
+        # The refund check is not replaced by a lookup
+        self.assertEqual(
+            check_names(InvoicesData_dataset.Refunds, duplicates_removed=True),
+            ["remove_duplicate_headers_dataframe", "remove_duplicate_refunds"],
+        )
+        self.assertEqual(
+            get_insert_checks(Mapping_dataset.ClaimStatuses), ("Mapping", [])
+        )
+        self.assertRaises(TypeError, get_insert_checks, "Invoices")
+
+    def test_build_delivery_keys(self):
+        df = pd.DataFrame(
+            {
+                "tracking_number": ["1Z1", "1Z2"],
+                "status": ["Delivered", None],
+                "date_time": ["2024-03-10T08:00:00", "2024-03-10T09:00:00"],
+            }
+        )
+        keys = build_delivery_keys(df)
+        self.assertEqual(keys[0], "1Z1Delivered2024-03-10 08:00:00")
+        self.assertTrue(pd.isna(keys[1]))
+
+    @mock.patch("lox_services.persistence.database.dedup_rules.select")
+    def test_remove_saved_rows(self, mock_select):
+        invoices_df = pd.DataFrame(
+            {
+                "company": ["Lox", "Lox"],
+                "carrier": ["UPS", "UPS"],
+                "invoice_number": ["INV1", "INV2"],
+                "invoice_date": ["2024-03-01", "2024-03-02"],
+            }
+        )
+        package_information_df = pd.DataFrame(
+            {"carrier": ["UPS"], "company": ["Lox"], "tracking_number": ["1Z1"]}
+        )
+        refunds_df = pd.DataFrame({"tracking_number": ["1Z1"]})
+        mock_select.return_value = pd.DataFrame(
+            {
+                "frame_position": [0, 1],
+                "fingerprint": fingerprint_series(pd.Series(["LoxUPSINV2", "other"])),
+            }
+        )
+
+        frames = remove_saved_rows(
+            [
+                (invoices_df, InvoicesData_dataset.Invoices),
+                (refunds_df, InvoicesData_dataset.Refunds),
+                (package_information_df, CarrierData_dataset.PackageInformation),
+            ]
+        )
+
+        # A single query for both lookups
+        mock_select.assert_called_once()
+        self.assertEqual(mock_select.call_args.args[0].count("UNION ALL"), 1)
+        self.assertEqual(frames[0][0]["invoice_number"].tolist(), ["INV1"])
+        self.assertIs(frames[1][0], refunds_df)
+        self.assertEqual(len(frames[2][0].index), 1)
+
+    @mock.patch("lox_services.persistence.database.dedup_rules.CHUNK_SIZE", 2)
+    @mock.patch("lox_services.persistence.database.dedup_rules.select")
+    def test_remove_saved_rows_by_chunks(self, mock_select):
+        package_information_df = pd.DataFrame(
+            {
+                "carrier": ["UPS", "UPS", "UPS", None],
+                "company": ["Lox", "Lox", "Lox", "Lox"],
+                "tracking_number": ["1Z1", "1Z2", "1Z3", "1Z4"],
+            }
+        )
+        mock_select.side_effect = [
+            pd.DataFrame(
+                {
+                    "frame_position": [0],
+                    "fingerprint": fingerprint_series(pd.Series(["UPSLox1Z1"])),
+                }
+            ),
+            pd.DataFrame(
+                {
+                    "frame_position": [0],
+                    "fingerprint": fingerprint_series(pd.Series(["UPSLox1Z3"])),
+                }
+            ),
+        ]
+        frames = remove_saved_rows(
+            [(package_information_df, CarrierData_dataset.PackageInformation)]
+        )
+
+        self.assertEqual(mock_select.call_count, 2)
+        self.assertIn("SELECT DISTINCT", mock_select.call_args.args[0])
+        self.assertEqual(
+            mock_select.call_args.kwargs["parameters"][0][2], ["1Z3", "1Z4"]
+        )
+        # The row with an incomplete key is kept
+        self.assertEqual(frames[0][0]["tracking_number"].tolist(), ["1Z2", "1Z4"])
+
+    @mock.patch("lox_services.persistence.database.dedup_rules.select")
+    def test_remove_saved_rows_incomplete_deliveries(self, mock_select):
+        deliveries_df = pd.DataFrame(
+            {
+                "tracking_number": ["1Z1", "1Z2", "1Z3"],
+                "status": ["Delivered", "Delivered", "Delivered"],
+                "date_time": ["2024-03-10T08:00:00", None, "2024-03-10T09:00:00"],
+            }
+        )
+        mock_select.return_value = pd.DataFrame(
+            {
+                "frame_position": [0],
+                "fingerprint": fingerprint_series(
+                    pd.Series(["1Z3Delivered2024-03-10 09:00:00"])
+                ),
+            }
+        )
+        ((dataframe, table),) = remove_saved_rows(
+            [(deliveries_df, InvoicesData_dataset.Deliveries)]
+        )
+        for _, check in get_insert_checks(table, duplicates_removed=True)[1]:
+            dataframe = check(dataframe)
+
+        # The row without date time is dropped, like remove_duplicate_deliveries does
+        self.assertEqual(dataframe["tracking_number"].tolist(), ["1Z1"])
+
+    def test_build_lookup_query(self):
+        df = pd.DataFrame(
+            {
+                "tracking_number": ["1Z1", "1Z1"],
+                "status": ["Delivered", "Delivered"],
+                "date_time": ["2024-03-10T08:00:00", "2024-03-11T08:00:00"],
+            }
+        )
+        query, parameters = build_lookup_query([(df, InvoicesData_dataset.Deliveries)])
+        self.assertIn("FROM InvoicesData.Deliveries", query)
+        self.assertEqual(
+            [name for name, _, _ in parameters],
+            [
+                "frame_0_lookup_values",
+                "frame_0_partition_start",
+                "frame_0_partition_end",
+            ],
+        )
+        self.assertEqual(parameters[0][2], ["1Z1"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,105 @@
+import unittest
+from unittest import mock
+
+import pandas as pd
+
+from lox_services.persistence.database.datasets import InvoicesData_dataset
+from lox_services.persistence.database.delete import delete_by_keys
+from lox_services.persistence.database.temporary_tables import (
+    close_temporary_table_managers,
+)
+from lox_services.utils.enums import BQParameterType
+
+
+class TestDeleteByKeys(unittest.TestCase):
+    def tearDown(self):
+        close_temporary_table_managers()
+
+    @mock.patch("lox_services.persistence.database.delete.delete", return_value=3)
+    def test_single_column_keys(self, mock_delete):
+        df = pd.DataFrame({"tracking_number": ["1Z1", "1Z2", "1Z1", None]})
+        deleted_rows = delete_by_keys(
+            InvoicesData_dataset.Deliveries, df, ["tracking_number"]
+        )
+        self.assertEqual(deleted_rows, 3)
+        query = " ".join(mock_delete.call_args.args[0].split())
+        self.assertEqual(
+            query,
+            "DELETE FROM InvoicesData.Deliveries AS target "
+            "WHERE target.tracking_number IN UNNEST(@keys_0)",
+        )
+        self.assertEqual(
+            mock_delete.call_args.kwargs["parameters"],
+            [("keys_0", BQParameterType.STRING, ["1Z1", "1Z2"])],
+        )
+
+    @mock.patch("lox_services.persistence.database.delete.delete", return_value=2)
+    def test_int_and_bool_keys(self, mock_delete):
+        df = pd.DataFrame({"invoice_id": [12, 13], "is_credit": [True, False]})
+        delete_by_keys(InvoicesData_dataset.Invoices, df, ["invoice_id", "is_credit"])
+        self.assertEqual(
+            mock_delete.call_args.kwargs["parameters"],
+            [
+                ("keys_0", BQParameterType.INT64, [12, 13]),
+                ("keys_1", BQParameterType.BOOL, [True, False]),
+            ],
+        )
+        self.assertIsInstance(mock_delete.call_args.kwargs["parameters"][0][2][0], int)
+
+    @mock.patch("lox_services.persistence.database.delete.select")
+    def test_composite_keys_dry_run(self, mock_select):
+        mock_select.return_value = pd.DataFrame({"rows_to_delete": [2]})
+        df = pd.DataFrame(
+            {"tracking_number": ["1Z1", "1Z2"], "reason_refund": ["Lost", "Late"]}
+        )
+        count = delete_by_keys(
+            InvoicesData_dataset.Refunds,
+            df,
+            ["tracking_number", "reason_refund"],
+            dry_run=True,
+        )
+        self.assertEqual(count, 2)
+        query = " ".join(mock_select.call_args.args[0].split())
+        self.assertIn("SELECT COUNT(*) AS rows_to_delete", query)
+        self.assertIn(
+            "JOIN UNNEST(@keys_1) AS key_1 WITH OFFSET AS offset_1 ON offset_1 = offset_0",
+            query,
+        )
+        self.assertIn(
+            "WHERE target.tracking_number = key_0 AND target.reason_refund = key_1",
+            query,
+        )
+
+    @mock.patch("lox_services.persistence.database.delete.delete", return_value=2)
+    @mock.patch("lox_services.persistence.database.delete.Client")
+    def test_temporary_table_keys(self, mock_client, mock_delete):
+        mock_client.return_value.load_table_from_dataframe.return_value.errors = None
+        mock_client.return_value.project = "project"
+        df = pd.DataFrame(
+            {"tracking_number": ["1Z1", "1Z2"], "status": ["Delivered", "Delivered"]}
+        )
+        delete_by_keys(
+            InvoicesData_dataset.Deliveries,
+            df,
+            ["tracking_number", "status"],
+            max_array_keys=1,
+        )
+        # The schema of the keys comes from the schema registry
+        mock_client.return_value.get_table.assert_not_called()
+        uploaded = mock_client.return_value.load_table_from_dataframe.call_args.args[0]
+        self.assertEqual(len(uploaded.index), 2)
+        query = " ".join(mock_delete.call_args.args[0].split())
+        self.assertIn(
+            "WHERE target.tracking_number = deleted_key.tracking_number "
+            "AND target.status = deleted_key.status",
+            query,
+        )
+        self.assertEqual(mock_delete.call_args.kwargs["parameters"], [])
+        # The temporary table is pooled, and deleted when the process exits
+        mock_client.return_value.delete_table.assert_not_called()
+        close_temporary_table_managers()
+        mock_client.return_value.delete_table.assert_called_once()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,152 @@
+import tempfile
+import unittest
+from datetime import datetime
+from unittest import mock
+
+import pandas as pd
+
+from lox_services.persistence.database.datasets import InvoicesData_dataset
+from lox_services.persistence.database.key_index import KeyIndex
+from lox_services.persistence.database.utils import fingerprint_series
+
+
+def mock_query_job(rows: pd.DataFrame) -> mock.Mock:
+    query_job = mock.Mock(total_bytes_processed=1024)
+    query_job.result.return_value.to_dataframe.return_value = rows
+    return query_job
+
+
+class TestKeyIndex(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        patcher = mock.patch(
+            "lox_services.persistence.database.partitioning.is_partitioned_by",
+            return_value=True,
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @mock.patch("lox_services.persistence.database.key_index.raw_query")
+    def test_sync_and_contains(self, mock_raw_query):
+        mock_raw_query.return_value = mock_query_job(
+            pd.DataFrame(
+                {
+                    "existing_key": fingerprint_series(pd.Series(["INV1", "INV2"])),
+                    "insert_datetime": [datetime(2024, 1, 1), datetime(2024, 1, 2)],
+                }
+            )
+        )
+        index = KeyIndex(
+            InvoicesData_dataset.Invoices,
+            company="Lox",
+            carrier="UPS",
+            folder=self.folder,
+        )
+        self.assertEqual(index.sync(), 2)
+        self.assertEqual(index.watermark, datetime(2024, 1, 2))
+        # First sync downloads everything
+        parameter_names = [p[0] for p in mock_raw_query.call_args.kwargs["parameters"]]
+        self.assertEqual(parameter_names, ["company", "carrier"])
+
+        keys = pd.Series(["INV1", "INV3", "INV2"], index=[10, 11, 12])
+        pd.testing.assert_series_equal(
+            index.contains(keys), pd.Series([True, False, True], index=[10, 11, 12])
+        )
+        self.assertEqual(index.stats["keys_found"], 2)
+
+        # The index is reloaded from disk and synced from its watermark
+        mock_raw_query.return_value = mock_query_job(
+            pd.DataFrame(
+                {
+                    "existing_key": fingerprint_series(pd.Series(["INV3"])),
+                    "insert_datetime": [datetime(2024, 1, 3)],
+                }
+            )
+        )
+        reloaded_index = KeyIndex(
+            InvoicesData_dataset.Invoices,
+            company="Lox",
+            carrier="UPS",
+            folder=self.folder,
+        )
+        self.assertEqual(reloaded_index.watermark, datetime(2024, 1, 2))
+        reloaded_index.sync()
+        parameter_names = [p[0] for p in mock_raw_query.call_args.kwargs["parameters"]]
+        self.assertIn("watermark", parameter_names)
+        self.assertTrue(reloaded_index.contains(keys).all())
+
+    @mock.patch("lox_services.persistence.database.key_index.raw_query")
+    def test_missing_keys_are_confirmed(self, mock_raw_query):
+        index = KeyIndex(InvoicesData_dataset.Deliveries, folder=self.folder)
+        rows = pd.DataFrame(
+            {
+                "tracking_number": ["1Z1", "1Z2", "1Z2"],
+                "date_time": ["2024-03-10", "2024-03-11", "2024-03-12"],
+            },
+            index=[5, 6, 7],
+        )
+        keys = pd.Series(["LATE", "NEW", "KNOWN"], index=rows.index)
+        index._add_keys(fingerprint_series(pd.Series(["KNOWN"])).to_numpy())
+        # A late row, inserted with an `insert_datetime` older than the watermark
+        mock_raw_query.return_value = mock_query_job(
+            pd.DataFrame(
+                {"existing_key": fingerprint_series(pd.Series(["LATE", "OTHER"]))}
+            )
+        )
+        found = index.contains(keys, rows)
+        self.assertEqual(found.tolist(), [True, False, True])
+        self.assertEqual(index.stats["keys_confirmed"], 1)
+        self.assertEqual(index.stats["confirm_bytes_processed"], 1024)
+        # Looked up by tracking number, in the partitions of the missing rows
+        query = mock_raw_query.call_args.args[0]
+        self.assertIn("tracking_number IN UNNEST(@lookup_values)", query)
+        self.assertIn("date_time BETWEEN @partition_start AND @partition_end", query)
+        parameters = mock_raw_query.call_args.kwargs["parameters"]
+        self.assertEqual(parameters[0][0], "lookup_values")
+        self.assertEqual(parameters[0][2], ["1Z1", "1Z2"])
+
+        # The confirmed key is saved, and no longer looked up
+        mock_raw_query.reset_mock()
+        reopened = KeyIndex(InvoicesData_dataset.Deliveries, folder=self.folder)
+        self.assertTrue(reopened.contains(pd.Series(["LATE"])).all())
+        self.assertTrue(index.contains(keys[[5]], rows).all())
+        mock_raw_query.assert_not_called()
+
+    @mock.patch("lox_services.persistence.database.key_index.raw_query")
+    def test_sync_keeps_keys_of_other_processes(self, mock_raw_query):
+        first = KeyIndex(InvoicesData_dataset.Deliveries, folder=self.folder)
+        second = KeyIndex(InvoicesData_dataset.Deliveries, folder=self.folder)
+        mock_raw_query.return_value = mock_query_job(
+            pd.DataFrame(
+                {
+                    "existing_key": fingerprint_series(pd.Series(["A"])),
+                    "insert_datetime": [datetime(2024, 1, 2)],
+                }
+            )
+        )
+        first.sync()
+        mock_raw_query.return_value = mock_query_job(
+            pd.DataFrame(
+                {
+                    "existing_key": fingerprint_series(pd.Series(["B"])),
+                    "insert_datetime": [datetime(2024, 1, 1)],
+                }
+            )
+        )
+        second.sync()
+        self.assertEqual(second.watermark, datetime(2024, 1, 2))
+
+        reopened = KeyIndex(InvoicesData_dataset.Deliveries, folder=self.folder)
+        self.assertTrue(reopened.contains(pd.Series(["A", "B"])).all())
+
+    def test_tenant_is_required(self):
+        self.assertRaises(
+            ValueError, KeyIndex, InvoicesData_dataset.Refunds, folder=self.folder
+        )
+        self.assertRaises(
+            ValueError, KeyIndex, InvoicesData_dataset.ContractData, folder=self.folder
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
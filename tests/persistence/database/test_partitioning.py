@@ -0,0 +1,105 @@
+import unittest
+from datetime import date, datetime, timedelta
+from unittest import mock
+
+import pandas as pd
+
+from lox_services.persistence.database.datasets import InvoicesData_dataset
+from lox_services.persistence.database.partitioning import (
+    TABLE_PARTITIONING,
+    build_partition_filter,
+    is_partitioned_by,
+)
+from lox_services.persistence.database.schema_registry import get_table_schema
+from lox_services.utils.enums import BQParameterType
+
+
+class TestPartitioning(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch(
+            "lox_services.persistence.database.partitioning.get_live_partition_column",
+            side_effect=lambda table: TABLE_PARTITIONING[table].partition_column,
+        )
+        self.mock_get_live_partition_column = patcher.start()
+        self.addCleanup(patcher.stop)
+        is_partitioned_by.cache_clear()
+        self.addCleanup(is_partitioned_by.cache_clear)
+
+    def test_registry_matches_schema_files(self):
+        for table, partitioning in TABLE_PARTITIONING.items():
+            fields = {field.name: field for field in get_table_schema(table).fields}
+            self.assertIn(partitioning.partition_column, fields, table.name)
+            self.assertEqual(
+                fields[partitioning.partition_column].field_type,
+                partitioning.partition_type.value,
+                table.name,
+            )
+            for column in partitioning.cluster_columns:
+                self.assertIn(column, fields, table.name)
+
+    def test_datetime_partition_filter(self):
+        df = pd.DataFrame({"date_time": ["2024-03-10 08:00:00", "2024-03-12 17:30:00"]})
+        condition, parameters = build_partition_filter(
+            InvoicesData_dataset.Deliveries, df, alias="existing"
+        )
+        self.assertEqual(
+            condition,
+            "AND existing.date_time BETWEEN @partition_start AND @partition_end",
+        )
+        self.assertEqual(
+            parameters,
+            [
+                ("partition_start", BQParameterType.DATETIME, datetime(2024, 3, 8, 8)),
+                (
+                    "partition_end",
+                    BQParameterType.DATETIME,
+                    datetime(2024, 3, 14, 17, 30),
+                ),
+            ],
+        )
+
+    def test_date_partition_filter(self):
+        df = pd.DataFrame({"invoice_date": [date(2024, 3, 10)]})
+        _, parameters = build_partition_filter(
+            InvoicesData_dataset.Invoices, df, slack=timedelta(days=1)
+        )
+        self.assertEqual(parameters[0][2], date(2024, 3, 9))
+        self.assertEqual(parameters[1][2], date(2024, 3, 11))
+
+    def test_no_pruning(self):
+        dated_df = pd.DataFrame({"invoice_date": [date(2024, 3, 10)]})
+        # The key of a refund doesn't depend on its invoice date
+        self.assertEqual(
+            build_partition_filter(InvoicesData_dataset.Refunds, dated_df), ("", [])
+        )
+        # Unknown table
+        self.assertEqual(
+            build_partition_filter(InvoicesData_dataset.ContractData, dated_df),
+            ("", []),
+        )
+        # Missing dates
+        undated_df = pd.DataFrame({"invoice_date": [date(2024, 3, 10), None]})
+        self.assertEqual(
+            build_partition_filter(InvoicesData_dataset.Invoices, undated_df), ("", [])
+        )
+
+    def test_table_not_partitioned_by_the_column(self):
+        df = pd.DataFrame({"invoice_date": [date(2024, 3, 10)]})
+        self.mock_get_live_partition_column.side_effect = None
+        self.mock_get_live_partition_column.return_value = "insert_datetime"
+        self.assertEqual(
+            build_partition_filter(InvoicesData_dataset.Invoices, df), ("", [])
+        )
+        # The live table is only checked once
+        build_partition_filter(InvoicesData_dataset.Invoices, df)
+        self.mock_get_live_partition_column.assert_called_once()
+
+        is_partitioned_by.cache_clear()
+        self.mock_get_live_partition_column.side_effect = Exception("Not found")
+        self.assertEqual(
+            build_partition_filter(InvoicesData_dataset.Invoices, df), ("", [])
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
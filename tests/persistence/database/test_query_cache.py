@@ -0,0 +1,111 @@
+import os
+import tempfile
+import unittest
+from datetime import datetime
+from unittest import mock
+
+import pandas as pd
+
+from lox_services.persistence.database.query_cache import QueryCache, get_query_key
+from lox_services.utils.enums import BQParameterType
+
+QUERY = "SELECT * FROM InvoicesData.Invoices WHERE company = @company"
+PARAMETERS = [("company", BQParameterType.STRING, "Lox")]
+
+
+class TestQueryCache(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def test_get_query_key(self):
+        self.assertEqual(
+            get_query_key(QUERY, PARAMETERS), get_query_key(f"\n{QUERY} ", PARAMETERS)
+        )
+        self.assertNotEqual(
+            get_query_key(QUERY, PARAMETERS),
+            get_query_key(QUERY, [("company", BQParameterType.STRING, "Other")]),
+        )
+
+    @mock.patch("lox_services.persistence.database.query_cache.select")
+    @mock.patch("lox_services.persistence.database.query_cache.Client")
+    def test_select(self, mock_client, mock_select):
+        mock_client.return_value.query.return_value.referenced_tables = ["invoices"]
+        table = mock_client.return_value.get_table.return_value
+        table.full_table_id = "project:InvoicesData.Invoices"
+        table.modified = datetime(2024, 1, 1)
+        table.streaming_buffer = None
+        mock_select.return_value = pd.DataFrame({"invoice_number": ["1", "2"]})
+        cache = QueryCache(self.folder)
+
+        first = cache.select(QUERY, parameters=PARAMETERS)
+        # Another process reads the result written by the first one
+        second = QueryCache(self.folder).select(QUERY, parameters=PARAMETERS)
+        pd.testing.assert_frame_equal(first, second)
+        mock_select.assert_called_once()
+
+        # The result is computed again once the table is modified
+        table.modified = datetime(2024, 1, 2)
+        cache.select(QUERY, parameters=PARAMETERS)
+        self.assertEqual(mock_select.call_count, 2)
+        self.assertEqual(cache.stats["misses"], 2)
+
+        # Not cached while rows are in the streaming buffer
+        table.streaming_buffer = object()
+        cache.select(QUERY, parameters=PARAMETERS)
+        self.assertEqual(mock_select.call_count, 3)
+        self.assertEqual(cache.stats["uncacheable"], 1)
+
+    @mock.patch("lox_services.persistence.database.query_cache.select")
+    @mock.patch("lox_services.persistence.database.query_cache.Client")
+    def test_select_non_deterministic(self, mock_client, mock_select):
+        mock_select.return_value = pd.DataFrame({"invoice_number": ["1"]})
+        cache = QueryCache(self.folder)
+        for query in [
+            "SELECT * FROM InvoicesData.Invoices WHERE invoice_date = CURRENT_DATE()",
+            "SELECT *, current_timestamp() AS now FROM InvoicesData.Invoices",
+            "SELECT * FROM InvoicesData.Invoices WHERE RAND() < 0.1",
+            "SELECT GENERATE_UUID() AS id FROM InvoicesData.Invoices",
+        ]:
+            cache.select(query)
+            cache.select(query)
+        self.assertEqual(mock_select.call_count, 8)
+        self.assertEqual(cache.stats["uncacheable"], 8)
+        mock_client.return_value.query.assert_not_called()
+
+    @mock.patch("lox_services.persistence.database.query_cache.select")
+    @mock.patch("lox_services.persistence.database.query_cache.Client")
+    def test_evict(self, mock_client, mock_select):
+        mock_client.return_value.query.return_value.referenced_tables = ["invoices"]
+        table = mock_client.return_value.get_table.return_value
+        table.full_table_id = "project:InvoicesData.Invoices"
+        table.modified = datetime(2024, 1, 1)
+        table.streaming_buffer = None
+        mock_select.return_value = pd.DataFrame({"invoice_number": ["1"] * 1000})
+        cache = QueryCache(self.folder, max_size=10**9)
+        for company in ["A", "B", "C"]:
+            cache.select(
+                QUERY, parameters=[("company", BQParameterType.STRING, company)]
+            )
+        oldest_key = get_query_key(QUERY, [("company", BQParameterType.STRING, "A")])
+        os.utime(os.path.join(self.folder, f"{oldest_key}.parquet"), (0, 0))
+
+        cache.max_size = cache.get_size() - 1
+        self.assertEqual(cache.evict(), 1)
+        self.assertFalse(
+            os.path.exists(os.path.join(self.folder, f"{oldest_key}.parquet"))
+        )
+        self.assertFalse(
+            os.path.exists(os.path.join(self.folder, f"{oldest_key}.json"))
+        )
+        # One lock file per key prefix, not per cached result
+        self.assertFalse(
+            os.path.exists(os.path.join(self.folder, f"{oldest_key}.lock"))
+        )
+        lock_files = [
+            name for name in os.listdir(self.folder) if name.endswith(".lock")
+        ]
+        self.assertLessEqual(len(lock_files), 4)
+
+
+if __name__ == "__main__":
+    unittest.main()
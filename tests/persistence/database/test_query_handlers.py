@@ -0,0 +1,173 @@
+import os
+import tempfile
+import unittest
+from datetime import date, datetime
+from unittest import mock
+
+import pandas as pd
+import pyarrow as pa
+
+from lox_services.persistence.database.exceptions import (
+    BadQueryTypeException,
+    MissingUpdateDatetimeException,
+)
+from lox_services.persistence.database.query_handlers import (
+    dml_batch,
+    open_parquet_extract,
+    select_to_parquet,
+    select_windowed,
+)
+from lox_services.utils.enums import BQParameterType
+
+
+UPDATE_QUERY = """
+    UPDATE InvoicesData.Refunds
+    SET state = 'Credited', update_datetime = CURRENT_DATETIME()
+    WHERE tracking_number = @tracking_number
+"""
+
+
+class TestDMLBatch(unittest.TestCase):
+    @mock.patch("lox_services.persistence.database.query_handlers.Client")
+    @mock.patch("lox_services.persistence.database.query_handlers.raw_query")
+    def test_dml_batch(self, mock_raw_query, mock_client):
+        mock_client.return_value.list_jobs.return_value = [
+            mock.Mock(
+                statement_type="COMMIT_TRANSACTION", created=datetime(2024, 1, 4)
+            ),
+            mock.Mock(
+                statement_type="DELETE",
+                num_dml_affected_rows=3,
+                created=datetime(2024, 1, 3),
+            ),
+            mock.Mock(
+                statement_type="UPDATE",
+                num_dml_affected_rows=1,
+                created=datetime(2024, 1, 2),
+            ),
+            mock.Mock(statement_type="BEGIN_TRANSACTION", created=datetime(2024, 1, 1)),
+        ]
+        with dml_batch(print_query=False) as batch:
+            batch.update(
+                UPDATE_QUERY,
+                parameters=[("tracking_number", BQParameterType.STRING, "1Z1")],
+            )
+            batch.delete(
+                "DELETE FROM InvoicesData.ClaimHistory WHERE tracking_number = @tracking_number",
+                parameters=[("tracking_number", BQParameterType.STRING, "1Z2")],
+            )
+            mock_raw_query.assert_not_called()
+
+        self.assertEqual(batch.results, [1, 3])
+        mock_raw_query.assert_called_once()
+        script = mock_raw_query.call_args.args[0]
+        self.assertIn("BEGIN TRANSACTION;", script)
+        self.assertIn("WHERE tracking_number = @statement_0_tracking_number;", script)
+        self.assertIn("WHERE tracking_number = @statement_1_tracking_number;", script)
+        self.assertLess(
+            script.index("UPDATE InvoicesData.Refunds"),
+            script.index("COMMIT TRANSACTION;"),
+        )
+        self.assertEqual(
+            [
+                parameter[2]
+                for parameter in mock_raw_query.call_args.kwargs["parameters"]
+            ],
+            ["1Z1", "1Z2"],
+        )
+
+    @mock.patch("lox_services.persistence.database.query_handlers.raw_query")
+    def test_dml_batch_checks(self, mock_raw_query):
+        with self.assertRaises(MissingUpdateDatetimeException):
+            with dml_batch() as batch:
+                batch.update("UPDATE InvoicesData.Refunds SET state = 'A' WHERE TRUE")
+        with self.assertRaises(BadQueryTypeException):
+            with dml_batch() as batch:
+                batch.delete("SELECT 1")
+        # Nothing is executed when the block raises
+        mock_raw_query.assert_not_called()
+
+
+class TestSelectToParquet(unittest.TestCase):
+    @mock.patch("lox_services.persistence.database.query_handlers.raw_query")
+    def test_select_to_parquet(self, mock_raw_query):
+        batches = [
+            pa.record_batch({"tracking_number": ["1Z1", "1Z2"], "amount": [1.0, 2.0]}),
+            pa.record_batch({"tracking_number": ["1Z3"], "amount": [3.0]}),
+        ]
+        mock_raw_query.return_value.result.return_value.to_arrow_iterable.return_value = iter(
+            batches
+        )
+        path = os.path.join(tempfile.mkdtemp(), "deliveries.parquet")
+        select_to_parquet(
+            "SELECT tracking_number, amount FROM InvoicesData.Deliveries", path
+        )
+        mock_raw_query.return_value.result.assert_called_once_with(page_size=100_000)
+        self.assertFalse(os.path.exists(path + ".tmp"))
+
+        # Reopened by another process, one row group per page
+        extract = open_parquet_extract(path)
+        self.assertEqual(extract.fragments[0].metadata.num_row_groups, 2)
+        self.assertEqual(
+            extract.read().to_pandas()["tracking_number"].tolist(),
+            ["1Z1", "1Z2", "1Z3"],
+        )
+
+        with self.assertRaises(BadQueryTypeException):
+            select_to_parquet("DELETE FROM InvoicesData.Deliveries WHERE TRUE", path)
+
+
+class TestSelectWindowed(unittest.TestCase):
+    @mock.patch("lox_services.persistence.database.query_handlers.time.sleep")
+    @mock.patch("lox_services.persistence.database.query_handlers.select")
+    def test_select_windowed(self, mock_select, mock_sleep):
+        failures = {date(2024, 1, 11): 1}
+
+        def select_window(query, print_query, *, parameters, dtypes):
+            window_start = parameters[0][2]
+            if failures.get(window_start):
+                failures[window_start] -= 1
+                raise ValueError("Timeout")
+            return pd.DataFrame({"window_start": [window_start]})
+
+        mock_select.side_effect = select_window
+        windows = list(
+            select_windowed(
+                "SELECT * FROM InvoicesData.Deliveries WHERE date >= @window_start AND date < @window_end AND carrier = @carrier",
+                "2024-01-01",
+                "2024-01-30",
+                windows=3,
+                max_parallel=2,
+                parameters=[("carrier", BQParameterType.STRING, "UPS")],
+            )
+        )
+        self.assertEqual(
+            [(window.start, window.end) for window in windows],
+            [
+                (date(2024, 1, 1), date(2024, 1, 11)),
+                (date(2024, 1, 11), date(2024, 1, 21)),
+                (date(2024, 1, 21), date(2024, 1, 31)),
+            ],
+        )
+        self.assertEqual(
+            [window.dataframe["window_start"].iat[0] for window in windows],
+            [date(2024, 1, 1), date(2024, 1, 11), date(2024, 1, 21)],
+        )
+        # Only the failed window is run again
+        self.assertEqual(mock_select.call_count, 4)
+        self.assertEqual(
+            mock_select.call_args.kwargs["parameters"][2],
+            ("carrier", BQParameterType.STRING, "UPS"),
+        )
+
+        failures[date(2024, 1, 1)] = 3
+        with self.assertRaises(ValueError):
+            list(
+                select_windowed(
+                    "SELECT 1", "2024-01-01", "2024-01-30", windows=3, retries=2
+                )
+            )
+
+
+if __name__ == "__main__":
+    unittest.main()
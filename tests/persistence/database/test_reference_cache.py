@@ -0,0 +1,132 @@
+import os
+import tempfile
+import threading
+import unittest
+from datetime import datetime, timedelta
+from unittest import mock
+
+import pandas as pd
+
+from lox_services.persistence.database.datasets import (
+    InvoicesData_dataset,
+    UserData_dataset,
+)
+from lox_services.persistence.database.reference_cache import ReferenceTable
+
+NESTED_ACCOUNT_NUMBERS = pd.DataFrame(
+    {
+        "company": ["Lox", "Lox", "Other"],
+        "carrier": ["UPS", "UPS", "UPS"],
+        "account_number": ["A1", "A2", "B1"],
+    }
+)
+
+
+class TestReferenceTable(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    @mock.patch("lox_services.persistence.database.reference_cache.select")
+    @mock.patch("lox_services.persistence.database.reference_cache.Client")
+    def test_refresh_and_lookup(self, mock_client, mock_select):
+        mock_client.return_value.get_table.return_value.modified = datetime(2024, 1, 1)
+        mock_client.return_value.get_table.return_value.streaming_buffer = None
+        mock_select.return_value = NESTED_ACCOUNT_NUMBERS
+        table = ReferenceTable(
+            UserData_dataset.NestedAccountNumbers, folder=self.folder
+        )
+
+        rows = table.lookup(company="Lox", carrier="UPS")
+        self.assertEqual(rows["account_number"].tolist(), ["A1", "A2"])
+        self.assertTrue(table.lookup(company="Nobody").empty)
+        self.assertEqual(table.lookup_value("company", account_number="B1"), "Other")
+        self.assertIsNone(table.lookup_value("company", account_number="C1"))
+        mock_select.assert_called_once()
+
+        # Not downloaded again while the table is not modified
+        self.assertFalse(table.refresh())
+        mock_client.return_value.get_table.return_value.modified = datetime(2024, 1, 2)
+        mock_select.return_value = NESTED_ACCOUNT_NUMBERS.iloc[:1]
+        self.assertTrue(table.refresh())
+        self.assertEqual(len(table.lookup(company="Lox", carrier="UPS").index), 1)
+
+        # Streamed rows don't change the `modified` time of the table
+        mock_client.return_value.get_table.return_value.streaming_buffer = object()
+        mock_select.return_value = NESTED_ACCOUNT_NUMBERS
+        self.assertTrue(table.refresh())
+        self.assertEqual(len(table.lookup(company="Lox", carrier="UPS").index), 2)
+        mock_client.return_value.get_table.return_value.streaming_buffer = None
+
+        # A new process starts with the copy saved on disk
+        reopened = ReferenceTable(
+            UserData_dataset.NestedAccountNumbers, folder=self.folder
+        )
+        self.assertEqual(reopened.modified, datetime(2024, 1, 2))
+        self.assertEqual(
+            reopened.dataframe["account_number"].tolist(), ["A1", "A2", "B1"]
+        )
+
+    @mock.patch("lox_services.persistence.database.reference_cache.select")
+    @mock.patch("lox_services.persistence.database.reference_cache.Client")
+    def test_background_refresh(self, mock_client, mock_select):
+        mock_client.return_value.get_table.return_value.modified = datetime(2024, 1, 1)
+        mock_client.return_value.get_table.return_value.streaming_buffer = None
+        mock_select.return_value = NESTED_ACCOUNT_NUMBERS
+        ReferenceTable(
+            UserData_dataset.NestedAccountNumbers, folder=self.folder
+        ).refresh()
+
+        table = ReferenceTable(
+            UserData_dataset.NestedAccountNumbers,
+            folder=self.folder,
+            refresh_interval=timedelta(0),
+        )
+        # The copy on disk is used at once, and checked in the background
+        self.assertEqual(len(table.lookup(carrier="UPS").index), 3)
+        for thread in threading.enumerate():
+            if thread.name == "refresh_NestedAccountNumbers":
+                thread.join()
+        self.assertEqual(table.stats["checks"], 1)
+        self.assertEqual(table.stats["refreshes"], 0)
+
+    def test_concurrent_saves(self):
+        tables = [
+            ReferenceTable(UserData_dataset.NestedAccountNumbers, folder=self.folder)
+            for _ in range(2)
+        ]
+        for size, table in enumerate(tables, start=1):
+            table.dataframe = NESTED_ACCOUNT_NUMBERS.iloc[:size]
+            table.modified = datetime(2024, 1, size)
+
+        def save_repeatedly(table):
+            for _ in range(20):
+                table._save()
+
+        threads = [
+            threading.Thread(target=save_repeatedly, args=(table,)) for table in tables
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # The copy and its metadata come from the same save, without leftovers
+        reopened = ReferenceTable(
+            UserData_dataset.NestedAccountNumbers, folder=self.folder
+        )
+        self.assertEqual(len(reopened.dataframe.index), reopened.modified.day)
+        self.assertFalse(
+            [name for name in os.listdir(self.folder) if name.endswith(".tmp")]
+        )
+
+    def test_not_a_reference_table(self):
+        self.assertRaises(
+            ValueError,
+            ReferenceTable,
+            InvoicesData_dataset.Invoices,
+            folder=self.folder,
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,90 @@
+import threading
+import unittest
+
+import pandas as pd
+
+from lox_services.persistence.database.datasets import (
+    CarrierData_dataset,
+    InvoicesData_dataset,
+)
+from lox_services.persistence.database.remove_duplicates import (
+    build_server_side_deduplication_query,
+    split_by_tenant,
+)
+
+
+class TestSplitByTenant(unittest.TestCase):
+    def test_groups_are_checked_separately(self):
+        checked_tenants = []
+        lock = threading.Lock()
+
+        @split_by_tenant
+        def remove_first_row(dataframe):
+            with lock:
+                checked_tenants.append(
+                    (dataframe.iloc[0]["company"], dataframe.iloc[0]["carrier"])
+                )
+            return dataframe.iloc[1:]
+
+        df = pd.DataFrame(
+            {
+                "company": ["A", "B", "A", "B", "A"],
+                "carrier": ["UPS", "UPS", "UPS", "UPS", "DHL"],
+                "tracking_number": ["1", "2", "3", "4", "5"],
+            }
+        )
+        result = remove_first_row(df)
+        self.assertEqual(
+            sorted(checked_tenants), [("A", "DHL"), ("A", "UPS"), ("B", "UPS")]
+        )
+        # Rows are returned in their original order
+        self.assertEqual(result["tracking_number"].tolist(), ["3", "4"])
+
+    def test_single_tenant_is_not_split(self):
+        @split_by_tenant
+        def identity(dataframe):
+            return dataframe
+
+        df = pd.DataFrame({"company": ["A", "A"], "carrier": ["UPS", "UPS"]})
+        self.assertIs(identity(df), df)
+
+
+class TestServerSideDeduplication(unittest.TestCase):
+    def test_refunds_query(self):
+        query = build_server_side_deduplication_query(
+            InvoicesData_dataset.Refunds,
+            "project.InvoicesData.Refunds_tmp",
+            ["company", "carrier", "tracking_number", "reason_refund"],
+        )
+        self.assertIn("FROM `project.InvoicesData.Refunds_tmp` AS new", query)
+        self.assertIn("FROM InvoicesData.Refunds AS existing", query)
+        self.assertNotIn("new.carrier = 'UPS'", query)
+
+        # UPS refunds coming from the platform are allowed to be duplicated
+        query = build_server_side_deduplication_query(
+            InvoicesData_dataset.Refunds,
+            "project.InvoicesData.Refunds_tmp",
+            ["company", "carrier", "tracking_number", "reason_refund", "claim_number"],
+        )
+        self.assertIn("new.carrier = 'UPS'", query)
+
+    def test_package_information_query(self):
+        query = build_server_side_deduplication_query(
+            CarrierData_dataset.PackageInformation,
+            "project.CarrierData.PackageInformation_tmp",
+            ["carrier", "company", "tracking_number"],
+        )
+        self.assertIn("SELECT new.carrier, new.company, new.tracking_number", query)
+
+    def test_unsupported_table(self):
+        self.assertRaises(
+            ValueError,
+            build_server_side_deduplication_query,
+            InvoicesData_dataset.Invoices,
+            "project.InvoicesData.Invoices_tmp",
+            ["invoice_number"],
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
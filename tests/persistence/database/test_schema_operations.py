@@ -0,0 +1,114 @@
+import unittest
+from unittest import mock
+
+from lox_services.persistence.database.schemas.operations import (
+    ColumnDefinition,
+    TableMigration,
+    apply_schema_migrations,
+    compare_table_columns,
+    parse_table_columns,
+    plan_schema_migrations,
+    read_table_schema,
+)
+
+LIVE_TARGETS_DDL = """CREATE TABLE `project.LoxData.Targets`
+(
+  metric STRING NOT NULL,
+  month DATE NOT NULL,
+  target INT64 NOT NULL,
+  insert_datetime DATETIME NOT NULL,
+  update_datetime DATETIME
+)
+PARTITION BY month
+OPTIONS(description="Monthly targets");"""
+
+
+class TestSchemaOperations(unittest.TestCase):
+    def test_parse_table_columns(self):
+        columns = parse_table_columns(
+            """UserData.Example
+            (
+                company STRING NOT NULL OPTIONS(description="Company, not null."), --REQUIRED
+                amount FLOAT,-- NOT NULL, --REQUIRED NOT OK
+                emails ARRAY<struct<email_address STRING, is_main boolean NOT NULL>>,
+                price NUMERIC(10, 2)
+            )"""
+        )
+        self.assertEqual(
+            columns,
+            [
+                ColumnDefinition("company", "STRING", True, "Company, not null."),
+                ColumnDefinition("amount", "FLOAT64", False, None),
+                ColumnDefinition(
+                    "emails",
+                    "ARRAY<STRUCT<email_address STRING, is_main BOOL NOT NULL>>",
+                    False,
+                    None,
+                ),
+                ColumnDefinition("price", "NUMERIC(10, 2)", False, None),
+            ],
+        )
+
+    def test_sql_file_matches_live_ddl(self):
+        self.assertEqual(
+            compare_table_columns(
+                parse_table_columns(read_table_schema("LoxData", "Targets")),
+                parse_table_columns(LIVE_TARGETS_DDL),
+            ),
+            [],
+        )
+        changed_ddl = LIVE_TARGETS_DDL.replace("target INT64 NOT NULL", "target STRING")
+        self.assertEqual(
+            compare_table_columns(
+                parse_table_columns(read_table_schema("LoxData", "Targets")),
+                parse_table_columns(changed_ddl.replace("update_datetime", "comment")),
+            ),
+            [
+                "add update_datetime",
+                "drop comment",
+                "target: STRING -> INT64",
+                "target: NOT NULL",
+            ],
+        )
+
+    @mock.patch(
+        "lox_services.persistence.database.schemas.operations.get_creation_table_sql_queries"
+    )
+    def test_plan_schema_migrations(self, mock_get_ddls):
+        mock_get_ddls.return_value = {
+            "Targets": LIVE_TARGETS_DDL,
+            "Blacklist": "CREATE TABLE `project.LoxData.Blacklist` (company STRING)",
+        }
+        plan = plan_schema_migrations(["LoxData"])
+        mock_get_ddls.assert_called_once_with("LoxData")
+        actions = {migration.table: migration.action for migration in plan}
+        self.assertEqual(actions["Targets"], "unchanged")
+        self.assertEqual(actions["Blacklist"], "replace")
+        self.assertEqual(actions["Invoicing"], "create")
+
+    @mock.patch(
+        "lox_services.persistence.database.schemas.operations.create_table_with_schema"
+    )
+    @mock.patch(
+        "lox_services.persistence.database.schemas.operations.use_new_table_schema"
+    )
+    def test_apply_schema_migrations(self, mock_replace, mock_create):
+        mock_replace.side_effect = [None, ValueError("Bad schema")]
+        plan = [
+            TableMigration("LoxData", "Targets", "unchanged", []),
+            TableMigration("LoxData", "Blacklist", "replace", ["add reason"]),
+            TableMigration("LoxData", "Invoicing", "create", []),
+            TableMigration("LoxData", "DueInvoices", "replace", ["drop amount"]),
+        ]
+        with self.assertRaises(ValueError):
+            apply_schema_migrations(plan, max_workers=1)
+        self.assertEqual(mock_replace.call_count, 2)
+        mock_create.assert_called_once_with("LoxData", "Invoicing")
+
+        mock_replace.side_effect = None
+        durations = apply_schema_migrations(plan[:2])
+        self.assertEqual(list(durations), ["LoxData.Blacklist"])
+
+
+if __name__ == "__main__":
+    unittest.main()
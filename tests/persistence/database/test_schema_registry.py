@@ -0,0 +1,83 @@
+import unittest
+from unittest import mock
+
+import pyarrow as pa
+
+from lox_services.persistence.database.datasets import (
+    InvoicesData_dataset,
+    Mapping_dataset,
+    UserData_dataset,
+)
+from lox_services.persistence.database.schema_registry import (
+    get_csv_dtypes,
+    get_registered_schema,
+    get_table_schema,
+    get_table_with_schema,
+)
+
+
+class TestSchemaRegistry(unittest.TestCase):
+    def test_get_table_schema(self):
+        schema = get_table_schema(InvoicesData_dataset.Deliveries)
+        fields = {field.name: field for field in schema.fields}
+        self.assertEqual(
+            (fields["tracking_number"].field_type, fields["tracking_number"].mode),
+            ("STRING", "REQUIRED"),
+        )
+        self.assertEqual(fields["quantity"].field_type, "INTEGER")
+        self.assertEqual(
+            schema.arrow_schema.field("date_time").type, pa.timestamp("us")
+        )
+        self.assertFalse(schema.arrow_schema.field("status").nullable)
+        self.assertEqual(schema.dtypes["is_return"], "boolean")
+        self.assertIn("date_time", schema.date_columns)
+        self.assertNotIn("date_time", schema.dtypes)
+        # The SQL file is parsed once
+        self.assertIs(schema, get_registered_schema("InvoicesData", "Deliveries"))
+        self.assertIsNone(get_table_schema(Mapping_dataset.ClaimStatuses))
+
+    def test_nested_fields(self):
+        fields = {
+            field.name: field
+            for field in get_table_schema(UserData_dataset.Credentials).fields
+        }
+        self.assertEqual(
+            (
+                fields["no_claim_by_reasons"].field_type,
+                fields["no_claim_by_reasons"].mode,
+            ),
+            ("STRING", "REPEATED"),
+        )
+        self.assertEqual(
+            fields["no_claim_by_reasons"].description,
+            "An array of reasons that should not be claimed",
+        )
+
+    def test_get_csv_dtypes(self):
+        dtypes = get_csv_dtypes(InvoicesData_dataset.Refunds)
+        self.assertEqual(dtypes["tracking_number"], "str")
+        self.assertNotIn("total_price", dtypes)
+
+    def test_get_table_with_schema(self):
+        client = mock.Mock(project="project")
+        table = get_table_with_schema(
+            client, "InvoicesData", "Deliveries", ["tracking_number", "status"]
+        )
+        client.get_table.assert_not_called()
+        self.assertEqual(
+            (table.project, table.dataset_id, table.table_id),
+            ("project", "InvoicesData", "Deliveries"),
+        )
+        # Columns missing from the SQL file need the live schema
+        get_table_with_schema(client, "InvoicesData", "Deliveries", ["new_column"])
+        client.get_table.assert_called_once_with("project.InvoicesData.Deliveries")
+        # The modes of a load job schema must match the live table
+        client.get_table.reset_mock()
+        table = get_table_with_schema(
+            client, "InvoicesData", "Deliveries", ["tracking_number"], exact_modes=True
+        )
+        self.assertIs(table, client.get_table.return_value)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,114 @@
+import fcntl
+import os
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+import pandas as pd
+
+from lox_services.persistence.database.datasets import InvoicesData_dataset
+from lox_services.persistence.database.spool import InsertSpool
+
+
+class TestInsertSpool(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.df = pd.DataFrame(
+            {"tracking_number": ["1Z1", "1Z2"], "status": ["Delivered", "In transit"]}
+        )
+
+    @mock.patch(
+        "lox_services.persistence.database.spool.insert_dataframe_into_database"
+    )
+    def test_append_and_flush(self, mock_insert):
+        mock_insert.side_effect = lambda dataframe, table: len(dataframe.index)
+        spool = InsertSpool(self.folder)
+
+        self.assertEqual(spool.append(self.df, InvoicesData_dataset.Deliveries), 2)
+        self.assertEqual(spool.append(self.df, InvoicesData_dataset.Deliveries), 2)
+        self.assertEqual(len(spool.pending_segments()), 2)
+        mock_insert.assert_not_called()
+
+        report = spool.flush()
+        self.assertEqual(report, {"InvoicesData.Deliveries": 4})
+        mock_insert.assert_called_once()
+        self.assertEqual(spool.pending_segments(), [])
+
+    @mock.patch(
+        "lox_services.persistence.database.spool.insert_dataframe_into_database"
+    )
+    def test_failed_flush_is_replayed(self, mock_insert):
+        mock_insert.side_effect = Exception("BigQuery unavailable")
+        InsertSpool(self.folder).append(self.df, InvoicesData_dataset.Refunds)
+        InsertSpool(self.folder).flush()
+
+        # A new spool on the same folder picks the segment up again
+        mock_insert.side_effect = lambda dataframe, table: len(dataframe.index)
+        spool = InsertSpool(self.folder)
+        self.assertEqual(len(spool.pending_segments(InvoicesData_dataset.Refunds)), 1)
+        self.assertEqual(spool.flush(), {"InvoicesData.Refunds": 2})
+        self.assertEqual(spool.disk_usage(), 0)
+
+    def test_incomplete_segments_are_removed(self):
+        table_folder = os.path.join(self.folder, "InvoicesData.Deliveries")
+        os.makedirs(table_folder)
+        abandoned_path = os.path.join(table_folder, "0001-abcd.999999999.tmp")
+        stale_path = os.path.join(table_folder, f"0002-abcd.{os.getpid()}.tmp")
+        writing_path = os.path.join(table_folder, f"0003-abcd.{os.getpid()}.tmp")
+        for path in [abandoned_path, stale_path, writing_path]:
+            open(path, "w").close()
+        os.utime(stale_path, (0, 0))
+
+        spool = InsertSpool(self.folder)
+        # Only the segment being written by a live process is kept
+        self.assertEqual(os.listdir(table_folder), ["0003-abcd.%d.tmp" % os.getpid()])
+        self.assertEqual(spool.pending_segments(), [])
+
+    @mock.patch(
+        "lox_services.persistence.database.spool.insert_dataframe_into_database"
+    )
+    def test_failing_segment_is_quarantined(self, mock_insert):
+        spool = InsertSpool(self.folder, max_segment_failures=3)
+        spool.append(self.df.assign(status="Bad"), InvoicesData_dataset.Deliveries)
+        spool.append(self.df, InvoicesData_dataset.Deliveries)
+
+        def insert(dataframe, table):
+            if (dataframe["status"] == "Bad").any():
+                raise ValueError("Invalid row")
+            return len(dataframe.index)
+
+        mock_insert.side_effect = insert
+        self.assertEqual(spool.flush(), {"InvoicesData.Deliveries": 0})
+        self.assertEqual(spool.flush(), {"InvoicesData.Deliveries": 0})
+        # Retried alone, then moved aside so that the next segment goes through
+        self.assertEqual(spool.flush(), {"InvoicesData.Deliveries": 2})
+        self.assertEqual(spool.pending_segments(), [])
+        self.assertEqual(len(spool.quarantined_segments()), 1)
+
+    @mock.patch(
+        "lox_services.persistence.database.spool.insert_dataframe_into_database"
+    )
+    def test_table_flushed_by_another_process_is_skipped(self, mock_insert):
+        spool = InsertSpool(self.folder)
+        spool.append(self.df, InvoicesData_dataset.Deliveries)
+        table_folder = os.path.join(self.folder, "InvoicesData.Deliveries")
+        with open(os.path.join(table_folder, ".flush.lock"), "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            self.assertEqual(spool.flush(), {"InvoicesData.Deliveries": 0})
+        mock_insert.assert_not_called()
+        self.assertEqual(len(spool.pending_segments()), 1)
+
+    @mock.patch("lox_services.persistence.database.spool.InsertSpool.flush")
+    def test_flusher_survives_errors(self, mock_flush):
+        mock_flush.side_effect = [FileNotFoundError("segment"), {}, {}, {}]
+        spool = InsertSpool(self.folder, flush_interval=0.01)
+        spool.start()
+        time.sleep(0.1)
+        self.assertTrue(spool.is_running)
+        spool.close(flush=False)
+        self.assertGreater(mock_flush.call_count, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,106 @@
+import unittest
+from unittest import mock
+
+import pandas as pd
+
+from lox_services.persistence.database.exceptions import MissingColumnsException
+from lox_services.persistence.database.push_invoices_data import (
+    _get_status_normalization,
+    process_df,
+)
+from lox_services.persistence.database.status_normalization import (
+    StatusNormalizer,
+    get_status_normalizer,
+)
+
+STATUS_MAPPING = pd.DataFrame(
+    {
+        "carrier": ["UPS", "UPS", None, "DHL"],
+        "status": ["Delivered", "Out for  delivery", "Delivered", "Zugestellt"],
+        "final_status": ["delivered", "in_transit", "delivered_generic", "delivered"],
+    }
+)
+
+
+class TestStatusNormalization(unittest.TestCase):
+    def test_normalize(self):
+        normalizer = StatusNormalizer(STATUS_MAPPING)
+        statuses = pd.Series(
+            ["delivered", "OUT FOR DELIVERY", None, "Lost", "delivered"],
+            index=[10, 11, 12, 13, 14],
+        )
+        final_statuses = normalizer.normalize(statuses, "UPS", fallback="unknown")
+        self.assertEqual(
+            final_statuses.tolist(),
+            ["delivered", "in_transit", None, "unknown", "delivered"],
+        )
+        self.assertEqual(final_statuses.index.tolist(), [10, 11, 12, 13, 14])
+
+        # The generic rows apply to the carriers without their own status
+        self.assertEqual(
+            normalizer.normalize(statuses, "DHL", keep_unknown=True).tolist(),
+            [
+                "delivered_generic",
+                "OUT FOR DELIVERY",
+                None,
+                "Lost",
+                "delivered_generic",
+            ],
+        )
+
+    @mock.patch(
+        "lox_services.persistence.database.status_normalization.get_reference_table"
+    )
+    def test_get_status_normalizer(self, mock_get_reference_table):
+        mock_get_reference_table.return_value.get_dataframe.return_value = (
+            STATUS_MAPPING
+        )
+        normalizer = get_status_normalizer()
+        self.assertIs(get_status_normalizer(), normalizer)
+
+        mock_get_reference_table.return_value.get_dataframe.return_value = (
+            STATUS_MAPPING.copy()
+        )
+        self.assertIsNot(get_status_normalizer(), normalizer)
+
+    def test_mapping_columns_are_checked(self):
+        with self.assertRaises(MissingColumnsException):
+            StatusNormalizer(STATUS_MAPPING.rename(columns={"final_status": "final"}))
+
+    def test_process_df(self):
+        df = pd.DataFrame(
+            {"status": ["Delivered", "Lost"], "final_status": [None, "lost"]}
+        )
+        dtypes = {"status": str, "final_status": str}
+        na_values = {"status": "", "final_status": ""}
+        processed = process_df(
+            df.copy(),
+            dtypes,
+            na_values,
+            status_carrier="UPS",
+            status_normalizer=StatusNormalizer(STATUS_MAPPING),
+        )
+        self.assertEqual(processed["final_status"].tolist(), ["delivered", "lost"])
+
+        # Without normalizer the raw status is used, without carrier nothing is filled
+        processed = process_df(df.copy(), dtypes, na_values, status_carrier="UPS")
+        self.assertEqual(processed["final_status"].tolist(), ["Delivered", "lost"])
+        processed = process_df(df.copy(), dtypes, na_values)
+        self.assertEqual(processed["final_status"].tolist(), ["", "lost"])
+
+    @mock.patch(
+        "lox_services.persistence.database.push_invoices_data.get_status_normalizer"
+    )
+    def test_get_status_normalization(self, mock_get_status_normalizer):
+        self.assertEqual(_get_status_normalization("UPS", False), {})
+        mock_get_status_normalizer.assert_not_called()
+
+        mock_get_status_normalizer.side_effect = MissingColumnsException("carrier")
+        self.assertEqual(
+            _get_status_normalization("UPS", True),
+            {"status_carrier": "UPS", "status_normalizer": None},
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,116 @@
+import unittest
+from datetime import datetime, timezone
+from unittest import mock
+
+import pandas as pd
+from google.cloud.bigquery import SchemaField
+
+from lox_services.persistence.database.temporary_tables import (
+    MIN_REMAINING_LIFETIME,
+    TemporaryTableManager,
+    close_temporary_table_managers,
+    temporary_table,
+)
+
+
+class TestTemporaryTables(unittest.TestCase):
+    def setUp(self):
+        self.client = mock.Mock()
+        self.client.load_table_from_dataframe.return_value.errors = None
+        self.schema = [SchemaField("tracking_number", "STRING")]
+        self.df = pd.DataFrame({"tracking_number": ["1Z1", "1Z2"]})
+
+    def tearDown(self):
+        close_temporary_table_managers()
+
+    def test_temporary_table(self):
+        table_ids = []
+        for _ in range(2):
+            with temporary_table(
+                self.df,
+                self.schema,
+                "project",
+                "InvoicesData",
+                bigquery_client=self.client,
+                prefix="Refunds_update",
+            ) as table_id:
+                self.assertTrue(
+                    table_id.startswith("project.InvoicesData.Refunds_update_")
+                )
+                table_ids.append(table_id)
+
+        # The table of the first call is reused by the second one
+        self.assertEqual(table_ids[0], table_ids[1])
+        self.client.create_table.assert_called_once()
+        self.assertIsNotNone(self.client.create_table.call_args.args[0].expires)
+        self.assertEqual(
+            self.client.load_table_from_dataframe.call_args.args[1], table_ids[0]
+        )
+        self.client.delete_table.assert_not_called()
+
+        close_temporary_table_managers()
+        self.client.delete_table.assert_called_once_with(
+            table_ids[0], not_found_ok=True
+        )
+
+    def test_expiration_of_reused_tables(self):
+        manager = TemporaryTableManager(
+            "project", "InvoicesData", bigquery_client=self.client
+        )
+        with manager.table(self.df, self.schema) as table_id:
+            pass
+        now = datetime.now(timezone.utc)
+
+        # Half of the expiration has passed, it is pushed back
+        manager._expires[table_id] = now + manager.expiration / 3
+        with manager.table(self.df, self.schema) as reused_table_id:
+            self.assertEqual(reused_table_id, table_id)
+        updated_table = self.client.update_table.call_args.args[0]
+        self.assertGreater(updated_table.expires, now + manager.expiration / 2)
+
+        # Too close to its expiration, it is replaced
+        manager._expires[table_id] = now + MIN_REMAINING_LIFETIME / 2
+        with manager.table(self.df, self.schema) as new_table_id:
+            self.assertNotEqual(new_table_id, table_id)
+        self.client.delete_table.assert_called_once_with(table_id, not_found_ok=True)
+        self.assertEqual(self.client.create_table.call_count, 2)
+        manager.close()
+
+    def test_manager_reuses_released_tables(self):
+        other_schema = [SchemaField("company", "STRING")]
+        with TemporaryTableManager(
+            "project", "InvoicesData", bigquery_client=self.client
+        ) as manager:
+            with manager.table(self.df, self.schema) as first_table_id:
+                pass
+            with manager.table(self.df, self.schema) as second_table_id:
+                # Tables in use are never shared
+                third_table_id = manager.load(self.df, self.schema)
+            other_table_id = manager.load(
+                pd.DataFrame({"company": ["Lox"]}), other_schema
+            )
+
+        self.assertEqual(first_table_id, second_table_id)
+        self.assertEqual(len({first_table_id, third_table_id, other_table_id}), 3)
+        self.assertEqual(self.client.create_table.call_count, 3)
+        self.assertEqual(self.client.load_table_from_dataframe.call_count, 4)
+        self.assertEqual(self.client.delete_table.call_count, 3)
+
+    def test_load_error(self):
+        self.client.load_table_from_dataframe.return_value.errors = ["error"]
+        with self.assertRaises(ValueError):
+            with temporary_table(
+                self.df,
+                self.schema,
+                "project",
+                "InvoicesData",
+                bigquery_client=self.client,
+            ):
+                pass
+        # The table is deleted even if the load failed
+        close_temporary_table_managers()
+        self.client.delete_table.assert_called_once()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,250 @@
+import unittest
+from datetime import date
+from unittest import mock
+
+import pandas as pd
+from google.cloud.bigquery import SchemaField
+
+from lox_services.persistence.database.temporary_tables import (
+    close_temporary_table_managers,
+)
+from lox_services.persistence.database.update import update_from_dataframe
+
+
+class TestSetBasedUpdate(unittest.TestCase):
+    def tearDown(self):
+        close_temporary_table_managers()
+
+    @mock.patch("lox_services.persistence.database.update.update", return_value=2)
+    @mock.patch("lox_services.persistence.database.update.Client")
+    def test_set_based_update(self, mock_client, mock_update):
+        mock_client.return_value.load_table_from_dataframe.return_value.errors = None
+        mock_client.return_value.get_table.return_value = mock.Mock(
+            project="project",
+            dataset_id="TestEnvironment",
+            schema=[
+                SchemaField("location_id", "STRING", mode="REQUIRED"),
+                SchemaField("country_code", "STRING"),
+                SchemaField("city", "STRING"),
+                SchemaField("insert_datetime", "DATETIME", mode="REQUIRED"),
+            ],
+        )
+        df = pd.DataFrame(
+            {
+                "location_id": ["sender", "receiver", "receiver"],
+                "country_code": ["FR", "NL", "BE"],
+                "city": ["Montpellier", "Rotterdam", "Brussels"],
+            }
+        )
+
+        affected_rows = update_from_dataframe(
+            dataset="TestEnvironment",
+            table="Locations",
+            dataframe=df,
+            where=[
+                {"field": "location_id", "operator": "="},
+                {"field": "country_code", "operator": "NOT IN", "value": "('FR')"},
+            ],
+            set_and_where=["country_code"],
+            set_based=True,
+        )
+
+        self.assertEqual(affected_rows, 2)
+        mock_update.assert_called_once()
+        query = " ".join(mock_update.call_args.args[0].split())
+        self.assertIn(
+            "SET update_datetime = CURRENT_DATETIME('Europe/Amsterdam'), "
+            "country_code = source.country_code, city = source.city",
+            query,
+        )
+        self.assertIn(
+            "WHERE target.location_id = source.location_id "
+            "AND target.country_code NOT IN ('FR')",
+            query,
+        )
+        # One row per location, the last one wins
+        mock_load = mock_client.return_value.load_table_from_dataframe
+        uploaded = mock_load.call_args.args[0]
+        self.assertEqual(uploaded["city"].tolist(), ["Montpellier", "Brussels"])
+        # Every field of the temporary table is nullable
+        self.assertTrue(
+            all(
+                field.mode == "NULLABLE"
+                for field in mock_load.call_args.kwargs["job_config"].schema
+            )
+        )
+        # The temporary table is pooled, and deleted when the process exits
+        mock_client.return_value.delete_table.assert_not_called()
+        close_temporary_table_managers()
+        mock_client.return_value.delete_table.assert_called_once()
+
+    @mock.patch("lox_services.persistence.database.update.Client")
+    def test_set_based_update_without_value_in(self, mock_client):
+        mock_client.return_value.get_table.return_value = mock.Mock(
+            project="project",
+            dataset_id="TestEnvironment",
+            schema=[SchemaField("location_id", "STRING")],
+        )
+        self.assertRaises(
+            ValueError,
+            update_from_dataframe,
+            dataset="TestEnvironment",
+            table="Locations",
+            dataframe=pd.DataFrame({"location_id": ["('a', 'b')"]}),
+            where=[{"field": "location_id", "operator": "IN"}],
+            set_based=True,
+        )
+        mock_client.return_value.create_table.assert_not_called()
+
+
+class TestGroupedUpdate(unittest.TestCase):
+    @mock.patch("lox_services.persistence.database.update.update", return_value=1)
+    def test_grouped_update(self, mock_update):
+        df = pd.DataFrame(
+            {
+                "company": ["Lox", "Lox", "Lox", "Other"],
+                "tracking_number": ["1Z1", "1Z2", "1Z3", "1Z1"],
+                "state": ["Credited", "Credited", "Declined", "Credited"],
+            }
+        )
+        results = update_from_dataframe(
+            dataset="InvoicesData",
+            table="Refunds",
+            dataframe=df,
+            where=[
+                {"field": "company", "operator": "="},
+                {"field": "tracking_number", "operator": "="},
+                {"field": "carrier", "operator": "=", "value": "'UPS'"},
+            ],
+            grouped=True,
+        )
+
+        self.assertEqual(results, [1, 1, 1])
+        statements = {
+            tuple(call.kwargs["parameters"][1][2:])
+            + (tuple(call.kwargs["parameters"][0][2]),): " ".join(call.args[0].split())
+            for call in mock_update.call_args_list
+        }
+        self.assertEqual(
+            set(statements),
+            {("Lox", ("1Z1", "1Z2")), ("Lox", ("1Z3",)), ("Other", ("1Z1",))},
+        )
+        self.assertIn(
+            "SET update_datetime = CURRENT_DATETIME('Europe/Amsterdam'), state = 'Credited' "
+            "WHERE tracking_number IN UNNEST(@keys) AND carrier = 'UPS' AND company = @key_0",
+            statements[("Lox", ("1Z1", "1Z2"))],
+        )
+
+    @mock.patch("lox_services.persistence.database.update.print_info")
+    @mock.patch("lox_services.persistence.database.update.update", return_value=1)
+    def test_grouped_update_missing_keys(self, mock_update, mock_print_info):
+        df = pd.DataFrame(
+            {
+                "company": ["Lox", None, "Lox"],
+                "tracking_number": ["1Z1", "1Z2", None],
+                "state": ["Credited", "Credited", "Credited"],
+            }
+        )
+        results = update_from_dataframe(
+            dataset="InvoicesData",
+            table="Refunds",
+            dataframe=df,
+            where=[
+                {"field": "company", "operator": "="},
+                {"field": "tracking_number", "operator": "="},
+            ],
+            grouped=True,
+        )
+
+        self.assertEqual(results, [1])
+        self.assertEqual(mock_update.call_args.kwargs["parameters"][0][2], ["1Z1"])
+        self.assertIn(
+            "2 rows with missing key values", mock_print_info.call_args.args[0]
+        )
+
+    def test_grouped_update_needs_equal_keys(self):
+        self.assertRaises(
+            ValueError,
+            update_from_dataframe,
+            dataset="InvoicesData",
+            table="Refunds",
+            dataframe=pd.DataFrame({"tracking_number": ["1Z1"], "state": ["A"]}),
+            where=[{"field": "tracking_number", "operator": "!="}],
+            grouped=True,
+        )
+
+
+class TestSkipUnchanged(unittest.TestCase):
+    @mock.patch("lox_services.persistence.database.update.update", return_value=1)
+    @mock.patch("lox_services.persistence.database.update.select")
+    @mock.patch("lox_services.persistence.database.update.Client")
+    def test_skip_unchanged(self, mock_client, mock_select, mock_update):
+        mock_client.return_value.project = "project"
+        mock_select.return_value = pd.DataFrame(
+            {
+                "tracking_number": ["1Z1", "1Z2", "1Z3"],
+                "state": ["Credited", "Credited", "Pending"],
+                "credit_date": [date(2024, 3, 1), date(2024, 3, 1), None],
+            }
+        )
+        df = pd.DataFrame(
+            {
+                "tracking_number": ["1Z1", "1Z2", "1Z3", "1Z4"],
+                "state": ["Credited", "Credited", "Credited", "Credited"],
+                "credit_date": ["2024-03-01", "2024-03-02", "2024-03-01", "2024-03-01"],
+            }
+        )
+
+        results = update_from_dataframe(
+            dataset="InvoicesData",
+            table="Refunds",
+            dataframe=df,
+            where=[{"field": "tracking_number", "operator": "="}],
+            skip_unchanged=True,
+        )
+
+        # 1Z1 is up to date and 1Z4 is not in the table
+        self.assertEqual(results, [1, 1])
+        queries = [
+            " ".join(call.args[0].split()) for call in mock_update.call_args_list
+        ]
+        self.assertIn(
+            "credit_date = '2024-03-02' WHERE tracking_number = '1Z2'", queries[0]
+        )
+        self.assertNotIn("state =", queries[0])
+        self.assertIn(
+            "state = 'Credited', credit_date = '2024-03-01' WHERE tracking_number = '1Z3'",
+            queries[1],
+        )
+
+    @mock.patch("lox_services.persistence.database.update.update", return_value=1)
+    @mock.patch("lox_services.persistence.database.update.select")
+    @mock.patch("lox_services.persistence.database.update.Client")
+    def test_skip_unchanged_with_key_in_set_and_where(
+        self, mock_client, mock_select, mock_update
+    ):
+        mock_client.return_value.project = "project"
+        mock_select.return_value = pd.DataFrame(
+            {"tracking_number": ["1Z1", "1Z2"], "state": ["Credited", "Pending"]}
+        )
+        df = pd.DataFrame(
+            {"tracking_number": ["1Z1", "1Z2"], "state": ["Credited", "Credited"]}
+        )
+
+        results = update_from_dataframe(
+            dataset="InvoicesData",
+            table="Refunds",
+            dataframe=df,
+            where=[{"field": "tracking_number", "operator": "="}],
+            set_and_where=["tracking_number"],
+            skip_unchanged=True,
+        )
+
+        self.assertEqual(results, [1])
+        query = " ".join(mock_update.call_args.args[0].split())
+        self.assertIn("state = 'Credited'", query)
+        self.assertIn("WHERE tracking_number = '1Z2'", query)
+
+
+if __name__ == "__main__":
+    unittest.main()
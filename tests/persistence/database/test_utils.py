@@ -2,13 +2,17 @@ import unittest
 
 import numpy as np
 import pandas as pd
+from google.cloud.bigquery import SchemaField
 from pandas.testing import assert_frame_equal
 
 from lox_services.persistence.database.utils import (
+    cast_dataframe_to_schema,
     equal_condition_handle_none_value,
+    fingerprint_series,
     format_datetime,
     format_time,
     generate_id,
+    generate_id_series,
     replace_nan_with_none_in_dataframe,
 )
 
@@ -23,6 +27,47 @@ class TestUtilsDatabaseFunctions(unittest.TestCase):
         )
         self.assertRaises(Exception, generate_id, [])
 
+    def test_generate_id_series(self):
+        df = pd.DataFrame(
+            {
+                "invoice": ["A1", "A2", None],
+                "amount": [10.5, np.nan, 3.0],
+                "is_return": [True, False, True],
+            }
+        )
+        ids = generate_id_series(df, ["invoice", "amount", "is_return"])
+        self.assertEqual(
+            ids.tolist(),
+            [generate_id(row) for row in df.itertuples(index=False)],
+        )
+        self.assertEqual(ids.tolist()[2], "null_3.0_True")
+        self.assertRaises(Exception, generate_id_series, df, [])
+
+        hashed_ids = generate_id_series(df, ["invoice", "amount"], hashed=64)
+        self.assertEqual(hashed_ids.dtype, np.int64)
+        pd.testing.assert_series_equal(
+            hashed_ids,
+            fingerprint_series(generate_id_series(df, ["invoice", "amount"])),
+        )
+        long_ids = generate_id_series(df, ["invoice", "amount"], hashed=128)
+        self.assertEqual(long_ids.str.len().tolist(), [32, 32, 32])
+        self.assertEqual(long_ids.nunique(), 3)
+        for invalid_size in [32, 0, 1, 64.0, "64", None]:
+            self.assertRaises(
+                ValueError, generate_id_series, df, ["invoice"], hashed=invalid_size
+            )
+        self.assertEqual(
+            generate_id_series(df, ["invoice"], hashed=True).dtype, np.int64
+        )
+
+    def test_fingerprint_series(self):
+        keys = pd.Series(["", "1Z1234Delivered"], index=[3, 7])
+        fingerprints = fingerprint_series(keys)
+        self.assertEqual(fingerprints.dtype, np.int64)
+        self.assertEqual(fingerprints.index.tolist(), [3, 7])
+        # Same value as FARM_FINGERPRINT("") in BigQuery
+        self.assertEqual(fingerprints[3], -7286425919675154353)
+
     def test_replace_nan_with_none_in_dataframe(self):
         mock_df = pd.DataFrame(
             np.array([["1", np.NaN, None], ["5", "6", np.NaN], ["8", "9", np.NaN]]),
@@ -37,6 +82,30 @@ class TestUtilsDatabaseFunctions(unittest.TestCase):
 
         assert_frame_equal(df, mock_df_out)
 
+    def test_cast_dataframe_to_schema(self):
+        df = pd.DataFrame(
+            {
+                "tracking_number": pd.Series([123, None], dtype=object),
+                "date_time": ["2024-01-01T10:00:00", "not a date"],
+                "quantity": ["1", "2"],
+                "extra": ["a", "b"],
+            }
+        )
+        casted_df = cast_dataframe_to_schema(
+            df,
+            [
+                SchemaField("tracking_number", "STRING"),
+                SchemaField("date_time", "DATETIME"),
+                SchemaField("quantity", "INTEGER"),
+            ],
+        )
+        self.assertEqual(casted_df["tracking_number"].tolist()[0], "123")
+        self.assertTrue(pd.isna(casted_df["tracking_number"].tolist()[1]))
+        self.assertEqual(casted_df["date_time"][0], pd.Timestamp("2024-01-01 10:00:00"))
+        self.assertTrue(pd.isna(casted_df["date_time"][1]))
+        self.assertEqual(casted_df["quantity"].dtype, "Int64")
+        self.assertEqual(casted_df["extra"].tolist(), ["a", "b"])
+
     def test_format_time(self):
         # Case 1: Time is Na
         self.assertEqual(format_time(np.NaN), "00:00:00")
@@ -1,6 +1,7 @@
 import os
 import unittest
 import json
+from unittest import mock
 from datetime import datetime, timedelta, timezone
 
 import pandas as pd
@@ -12,7 +13,13 @@ from lox_services.persistence.database.utils import (
     make_temporary_table,
     validate_country_code,
 )
-from lox_services.persistence.database.insert import remove_duplicate_headers_dataframe
+from lox_services.persistence.database.datasets import InvoicesData_dataset
+from lox_services.persistence.database.insert import (
+    STREAMING_CHUNK_SIZE,
+    dry_run_insert_checks,
+    insert_rows_with_ids,
+    remove_duplicate_headers_dataframe,
+)
 
 
 class TestDatabaseFunctions(unittest.TestCase):
@@ -79,6 +86,76 @@ class TestDatabaseFunctions(unittest.TestCase):
             expected_output_middle.reset_index(drop=True),
         )
 
+    def test_insert_rows_with_ids(self):
+        client = mock.Mock()
+        client.insert_rows_from_dataframe.return_value = [[]]
+        df = pd.DataFrame({"A": range(STREAMING_CHUNK_SIZE + 10)})
+        row_ids = [f"id_{index}" for index in df["A"]]
+
+        self.assertEqual(insert_rows_with_ids(client, "table", df, row_ids), [])
+        self.assertEqual(client.insert_rows_from_dataframe.call_count, 2)
+        last_call = client.insert_rows_from_dataframe.call_args_list[1].kwargs
+        # Each chunk receives the ids of its own rows
+        self.assertEqual(last_call["row_ids"], row_ids[STREAMING_CHUNK_SIZE:])
+        self.assertEqual(len(last_call["dataframe"].index), 10)
+
+    def test_dry_run_insert_checks(self):
+        df = pd.DataFrame(
+            {
+                "tracking_number": ["tracking_number", "1Z1", "1Z2", "1Z3"],
+                "quantity": ["quantity", "0", "2", "3"],
+            }
+        )
+
+        def drop_1z2(dataframe):
+            return dataframe.loc[dataframe["tracking_number"] != "1Z2"]
+
+        def fix_quantity(dataframe):
+            dataframe["quantity"] = dataframe["quantity"].replace("0", "1")
+            return dataframe
+
+        def failing_check(dataframe):
+            raise ValueError("Invalid data")
+
+        report = dry_run_insert_checks(
+            df,
+            InvoicesData_dataset.Refunds,
+            [
+                (
+                    "remove_duplicate_headers_dataframe",
+                    remove_duplicate_headers_dataframe,
+                ),
+                ("drop_1z2", drop_1z2),
+                ("fix_quantity", fix_quantity),
+                ("validate", lambda dataframe: None),
+                ("failing_check", failing_check),
+            ],
+        )
+
+        self.assertEqual(report["table"], "InvoicesData.Refunds")
+        self.assertEqual(
+            report["rows_to_insert"]["tracking_number"].tolist(), ["1Z1", "1Z3"]
+        )
+        self.assertEqual(report["rows_to_insert"]["quantity"].tolist(), ["1", "3"])
+        self.assertEqual(
+            report["dropped_rows"]["dropped_by"].tolist(),
+            ["remove_duplicate_headers_dataframe", "drop_1z2"],
+        )
+        self.assertEqual(
+            report["errors"], {"failing_check": "ValueError: Invalid data"}
+        )
+        self.assertEqual(
+            set(report["timings"]),
+            {
+                "remove_duplicate_headers_dataframe",
+                "drop_1z2",
+                "fix_quantity",
+                "validate",
+            },
+        )
+        # The original dataframe is left untouched
+        self.assertEqual(df["quantity"].tolist(), ["quantity", "0", "2", "3"])
+
 
 class TestValidateISO31662(unittest.TestCase):
     def setUp(self):